@@ -1,5 +1,10 @@
 # -*- coding:utf-8 -*-
-from .downloader import main
 
 
 __version__ = '0.2.1'
+
+
+def main():
+    # 延迟导入，使只依赖标准库的客户端不需要加载aiohttp等依赖
+    from .downloader import main
+    main()
@@ -0,0 +1,234 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import asyncio
+
+
+class BufferPool(object):
+    """
+    预分配的定长缓冲区池，所有下载共用，限制内存占用并避免每个chunk都重新分配内存。
+    """
+    def __init__(self, buffer_size=1024000, count=2):
+        """
+        :param buffer_size: 每个缓冲区的大小
+        :param count: 缓冲区数量上限，需要时才分配
+        """
+        self.buffer_size = buffer_size
+        self.count = count
+        self.created = 0
+        self._free = None
+
+    @property
+    def free(self):
+        # 在事件循环中第一次使用时才创建队列
+        if self._free is None:
+            self._free = asyncio.Queue()
+        return self._free
+
+    async def acquire(self):
+        """
+        取得一个缓冲区，没有空闲且已达到数量上限时等待其它下载释放。
+        :return: memoryview
+        """
+        if self.free.empty() and self.created < self.count:
+            self.created += 1
+            return memoryview(bytearray(self.buffer_size))
+        return await self.free.get()
+
+    def release(self, buffer):
+        self.free.put_nowait(buffer)
+
+
+def _pwritev(fd, buffers, offset):
+    """
+    将连续的多个缓冲区一次写入文件的指定位置，处理写入不完整的情况。
+    :param fd: 文件描述符
+    :param buffers: memoryview列表
+    :param offset:
+    :return:
+    """
+    while buffers:
+        written = os.pwritev(fd, buffers, offset)
+        offset += written
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        if written:
+            buffers[0] = buffers[0][written:]
+
+
+def _write(fd, buffers, offset, pipeline=None, sync=False):
+    """
+    写入文件后将数据交给处理器链
+    :param sync: 写入后是否落盘
+    :return:
+    """
+    _pwritev(fd, list(buffers), offset)
+    if sync:
+        os.fdatasync(fd)
+    if pipeline is not None:
+        pipeline.feed(fd, offset, buffers)
+
+
+class FileWriter(object):
+    """
+    从aiohttp的StreamReader读取数据直接填入缓冲区，写满的缓冲区交给线程池按位置写入文件。
+    读取与写入并行，写入未完成时积压的缓冲区会在下一次提交时合并成一次pwritev。
+    """
+    def __init__(self, fd, offset, pool, callback=None, throttle=None,
+                 pipeline=None, sync_every=0, profiler=None):
+        """
+        :param fd: 文件描述符
+        :param offset: 开始写入的位置
+        :param pool: BufferPool
+        :param callback: 每次写入完成后调用，参数为写入的位置和长度
+        :param throttle: 每次从网络读取后调用的异步函数，参数为读取的字节数，用于限速
+        :param pipeline: 处理器链，与写入在同一个线程中按顺序处理数据
+        :param sync_every: 每写入多少字节落盘一次，0表示不落盘
+        :param profiler: 记录每次写入的耗时
+        """
+        self.fd = fd
+        self.pool = pool
+        self.callback = callback
+        self.throttle = throttle
+        self.pipeline = pipeline
+        # 已提交写入的数据的结束位置
+        self.offset = offset
+        self.buffer = None
+        self.filled = 0
+        self.pending = []
+        self.flushing = None
+        self.sync_every = sync_every
+        self.profiler = profiler
+        # 上次落盘后写入的字节数
+        self.unsynced = 0
+
+    @property
+    def position(self):
+        """
+        已经从网络读取到的数据的结束位置，写入器关闭后这些数据全部写入文件。
+        :return:
+        """
+        return self.offset + self.filled
+
+    async def read(self, stream, n=None):
+        """
+        从stream中读取数据填满一个缓冲区，或者读取n个字节。
+        :param stream: aiohttp.StreamReader
+        :param n: 最多读取的字节数
+        :return: 读取到的字节数，为0表示读取完毕
+        """
+        if stream.exception() is not None:
+            raise stream.exception()
+        self.check()
+        if self.buffer is None:
+            self.buffer = await self.pool.acquire()
+        size = len(self.buffer) - self.filled
+        if n is not None:
+            size = min(n, size)
+        received = 0
+        while received < size:
+            block = await stream.read(size - received)
+            if not block:
+                break
+            self.buffer[self.filled:self.filled + len(block)] = block
+            self.filled += len(block)
+            received += len(block)
+            if self.throttle:
+                await self.throttle(len(block))
+        if self.filled == len(self.buffer):
+            self.submit()
+        return received
+
+    def submit(self):
+        if self.buffer is None:
+            pass
+        elif self.filled:
+            self.pending.append((self.offset, self.buffer, self.filled))
+            self.offset += self.filled
+            self.buffer, self.filled = None, 0
+        else:
+            self.pool.release(self.buffer)
+            self.buffer = None
+        self.check()
+        if self.pending and self.flushing is None:
+            self.flushing = asyncio.ensure_future(self._flush())
+
+    def check(self):
+        """
+        后台写入失败时不再继续写入，归还缓冲区并抛出写入的异常。
+        :return:
+        """
+        if self.flushing is not None and self.flushing.done():
+            flushing, self.flushing = self.flushing, None
+            if not flushing.cancelled() and flushing.exception() is not None:
+                self.discard()
+                flushing.result()
+
+    async def _flush(self):
+        loop = asyncio.get_event_loop()
+        while self.pending:
+            # 积压的缓冲区是连续的，合并成一次写入
+            pending, self.pending = self.pending, []
+            written = sum(length for _, _, length in pending)
+            self.unsynced += written
+            sync = self.sync_every and self.unsynced >= self.sync_every
+            started_at = time.monotonic()
+            try:
+                await loop.run_in_executor(
+                    None, _write, self.fd,
+                    [buffer[:length] for _, buffer, length in pending],
+                    pending[0][0], self.pipeline, sync)
+            except BaseException:
+                # 写入期间积压的缓冲区也不会再写入了，马上归还，
+                # 否则等待缓冲区的读取可能永远等不到
+                for _, buffer, _ in self.pending:
+                    self.pool.release(buffer)
+                self.pending = []
+                raise
+            finally:
+                for _, buffer, _ in pending:
+                    self.pool.release(buffer)
+            if sync:
+                self.unsynced = 0
+            if self.profiler is not None:
+                self.profiler.add("write", started_at, time.monotonic(),
+                                  bytes=written, sync=bool(sync))
+            if self.callback:
+                self.callback(pending[0][0], written)
+
+    async def close(self):
+        """
+        将剩余数据写入文件，并归还所有缓冲区。
+        :return:
+        """
+        self.submit()
+        if self.flushing is not None:
+            flushing, self.flushing = self.flushing, None
+            try:
+                await flushing
+            except Exception:
+                self.discard()
+                raise
+
+    def discard(self):
+        """
+        丢弃未写入的数据，归还缓冲区。
+        :return:
+        """
+        for _, buffer, _ in self.pending:
+            self.pool.release(buffer)
+        self.pending = []
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer, self.filled = None, 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            # 出错时已读取的数据依然有效，写入文件以便断点续传
+            await self.close()
+        except Exception:
+            if exc_type is None:
+                raise
@@ -0,0 +1,261 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import shutil
+import sqlite3
+import asyncio
+
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Entry(object):
+    """
+    缓存中一个已下载文件的元信息
+    """
+    __slots__ = ("url", "etag", "last_modified", "size", "mtime", "md5",
+                 "sha256", "path", "checked_at", "fresh")
+
+    def __init__(self, url, etag, last_modified, size, mtime=None, md5=None,
+                 sha256=None, path=None, checked_at=0, fresh=False):
+        """
+        :param url:
+        :param etag:
+        :param last_modified:
+        :param size: 文件大小
+        :param mtime: 保存时文件的修改时间，用于发现本地被修改过的文件，None表示不检查
+        :param md5:
+        :param sha256:
+        :param path: 文件保存的位置
+        :param checked_at: 最近一次下载或者验证的时间
+        :param fresh: 本次运行中下载或者验证过，或者内容与任务中的哈希值一致，可以直接使用
+        """
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.mtime = mtime
+        self.md5 = md5
+        self.sha256 = sha256
+        self.path = path
+        self.checked_at = checked_at
+        self.fresh = fresh
+
+    @property
+    def headers(self):
+        """
+        :return: 与响应头相同格式的校验值，用于Journal
+        """
+        return {"ETag": self.etag, "Last-Modified": self.last_modified}
+
+    def conditions(self):
+        """
+        :return: 条件请求头，远端文件没有变化时服务器返回304
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def valid(self):
+        """
+        :return: 文件是否还在，并且没有在本地被修改过
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_size == self.size and \
+               (self.mtime is None or stat.st_mtime == self.mtime)
+
+    def __repr__(self):
+        return f"<Entry {self.path} of {self.url}>"
+
+
+def link(src, dst):
+    """
+    使用硬链接复用已下载的文件，不支持时(如跨文件系统)复制
+    :param src:
+    :param dst:
+    :return:
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    # 已经是同一个文件的硬链接时，rename不会删除临时文件
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = dst + ".tmp"
+    try:
+        os.path.lexists(tmp) and os.unlink(tmp)
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class Cache(object):
+    """
+    下载元信息缓存，在sqlite中保存url到ETag、Last-Modified、大小、内容哈希和保存位置的映射。
+    重新运行时使用条件请求，远端文件没有变化(304)时不再下载；本次运行中重复的url，
+    或者任务中的哈希值与已下载文件一致时，使用硬链接或复制代替下载。
+    淘汰只删除缓存中的记录，不会删除已下载的文件。
+    """
+    columns = ("url", "etag", "last_modified", "size", "mtime", "md5",
+               "sha256", "path", "checked_at")
+
+    def __init__(self, path, max_size=0, max_age=0):
+        """
+        :param path: sqlite文件
+        :param max_size: 记录的文件总大小上限，超过时淘汰最久没有验证的记录，0表示不限制
+        :param max_age: 超过多少秒没有验证的记录会被淘汰，0表示不限制
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.started_at = time.time()
+        self.db = None
+        self._executor = None
+        # url: [锁, 使用者数量]，相同url的任务依次执行，后面的任务直接使用前面下载的文件
+        self.locks = {}
+
+    @classmethod
+    def load(cls, path, max_size=0, max_age=0):
+        """
+        :return: 没有指定缓存文件时返回None
+        """
+        return path and cls(path, max_size, max_age)
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            # 多进程模式下各进程共用缓存文件
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, "
+                "etag TEXT, last_modified TEXT, size INTEGER, mtime REAL, "
+                "md5 TEXT, sha256 TEXT, path TEXT, checked_at REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_md5 "
+                            "ON entries (md5)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_sha256 "
+                            "ON entries (sha256)")
+            self._evict()
+        return self.db
+
+    @property
+    def executor(self):
+        # sqlite连接只在这一个线程中使用，避免在事件循环中进行同步IO，
+        # 关闭后再次使用(如嵌入使用时多次运行)时重新创建
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        return self._executor
+
+    async def call(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, func, *args)
+
+    def _select(self, column, value):
+        rows = self._connect().execute(
+            f"SELECT {', '.join(self.columns)} FROM entries "
+            f"WHERE {column} = ? AND checked_at >= ?",
+            (value, time.time() - self.max_age if self.max_age else 0))
+        for row in rows.fetchall():
+            entry = Entry(*row)
+            if entry.valid():
+                return entry
+            # 文件已经被删除或者修改
+            self._connect().execute(
+                "DELETE FROM entries WHERE url = ?", (entry.url,))
+
+    def _lookup(self, url, hashes):
+        for algorithm, digest in hashes.items():
+            entry = digest and self._select(algorithm, digest.lower())
+            if entry:
+                entry.fresh = True
+                return entry
+        entry = self._select("url", url)
+        if entry:
+            entry.fresh = entry.checked_at >= self.started_at
+        return entry
+
+    async def lookup(self, url, hashes):
+        """
+        :param url:
+        :param hashes: 任务中期望的哈希值，{"md5": "", "sha256": ""}
+        :return: 内容一致或者同一url的Entry，没有时返回None
+        """
+        return await self.call(self._lookup, url, hashes)
+
+    def _put(self, entry):
+        entry.mtime = os.stat(entry.path).st_mtime
+        self._connect().execute(
+            f"INSERT OR REPLACE INTO entries ({', '.join(self.columns)}) "
+            f"VALUES ({', '.join('?' * len(self.columns))})",
+            tuple(getattr(entry, column) for column in self.columns))
+
+    async def put(self, entry):
+        """
+        记录下载或者验证完成的文件
+        :param entry:
+        :return:
+        """
+        entry.checked_at = time.time()
+        await self.call(self._put, entry)
+
+    @asynccontextmanager
+    async def lock(self, url):
+        """
+        同一url的任务依次执行
+        :param url:
+        :return:
+        """
+        item = self.locks.setdefault(url, [asyncio.Lock(), 0])
+        item[1] += 1
+        try:
+            async with item[0]:
+                yield
+        finally:
+            item[1] -= 1
+            if not item[1]:
+                del self.locks[url]
+
+    def _evict(self):
+        if self.max_age:
+            self.db.execute("DELETE FROM entries WHERE checked_at < ?",
+                            (time.time() - self.max_age,))
+        if self.max_size:
+            # 从最近验证的记录开始累计大小，删除超过上限的记录
+            self.db.execute(
+                "DELETE FROM entries WHERE url IN (SELECT url FROM ("
+                "SELECT url, SUM(size) OVER (ORDER BY checked_at DESC) AS kept "
+                "FROM entries) WHERE kept > ?)", (self.max_size,))
+
+    def _close(self):
+        if self.db is not None:
+            self._evict()
+            self.db.close()
+            self.db = None
+
+    async def close(self):
+        if self._executor is not None:
+            await self.call(self._close)
+            executor, self._executor = self._executor, None
+            executor.shutdown()
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--cache",
+            help="Sqlite file to cache meta of downloaded files in, "
+                 "unchanged files are not downloaded again and duplicated "
+                 "files are linked, default engine only. ")
+        parser.add_argument(
+            "--cache-max-size", type=int, default=0,
+            help="Max total size in bytes of files recorded in cache, "
+                 "0 for unlimited. ")
+        parser.add_argument(
+            "--cache-max-age", type=float, default=0,
+            help="Seconds to keep cache entries after last checked, "
+                 "0 for unlimited. ")
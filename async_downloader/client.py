@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+"""
+daemon模式的客户端，只依赖标准库，启动开销很小：
+    a-download-client --socket /tmp/downloader.sock --url URL --filename FILENAME
+    a-download-client --port 8700 --path tasks.jsonl
+"""
+import sys
+import json
+import socket
+
+from http.client import HTTPConnection
+from argparse import ArgumentParser
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """
+    通过unix socket连接的HTTPConnection
+    """
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client(object):
+    """
+    向daemon提交任务
+    """
+    def __init__(self, socket_path=None, port=8700):
+        self.socket_path = socket_path
+        self.port = port
+
+    def connection(self):
+        if self.socket_path:
+            return UnixHTTPConnection(self.socket_path)
+        return HTTPConnection("127.0.0.1", self.port)
+
+    def submit(self, tasks, wait=True):
+        """
+        :param tasks: 任务列表，[{"url": "", "filename": ""}, ...]
+        :param wait: 是否等待任务结束
+        :return: wait时为各任务事件的迭代器，否则为任务id列表
+        """
+        conn = self.connection()
+        conn.request("POST", "/tasks" if wait else "/tasks?wait=0",
+                     json.dumps(tasks), {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            conn.close()
+            raise RuntimeError(f"Submit failed: {resp.status} "
+                               f"{resp.read().decode()}")
+        if not wait:
+            try:
+                return json.loads(resp.read())["ids"]
+            finally:
+                conn.close()
+        return self.events(conn, resp)
+
+    @staticmethod
+    def events(conn, resp):
+        try:
+            for line in resp:
+                yield json.loads(line)
+        finally:
+            conn.close()
+
+
+def main():
+    parser = ArgumentParser(description="Submit tasks to downloader daemon. ")
+    parser.add_argument("--socket", help="Unix socket of daemon. ")
+    parser.add_argument("--port", type=int, default=8700,
+                        help="Port of daemon if socket not specified. ")
+    parser.add_argument("--url", help="Download url. ")
+    parser.add_argument("--filename", help="Filename to save file. ")
+    parser.add_argument(
+        "--path", help="Path of file which store download meta in json lines, "
+                       "- for stdin. ")
+    parser.add_argument("--no-wait", action="store_true",
+                        help="Return after submitted. ")
+    args = parser.parse_args()
+    if args.url and args.filename:
+        tasks = [{"url": args.url, "filename": args.filename}]
+    elif args.path:
+        f = sys.stdin if args.path == "-" else open(args.path)
+        with f:
+            tasks = [json.loads(line) for line in f if line.strip()]
+    else:
+        parser.error("--url and --filename, or --path is required. ")
+    client = Client(args.socket, args.port)
+    if args.no_wait:
+        for id in client.submit(tasks, False):
+            print(id)
+        return
+    failed = 0
+    for event in client.submit(tasks):
+        print(json.dumps(event), flush=True)
+        failed += event["event"] in ("failed", "cancelled")
+    exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+import time
+import asyncio
+
+
+class AdaptiveConcurrency(object):
+    """
+    按AIMD方式自动调整worker数：出错率或事件循环延迟超过阈值时按比例减少；
+    worker都在工作且吞吐量没有下降时逐个增加；增加后吞吐量明显下降则退回。
+    """
+    def __init__(self, limit, min_limit=1, max_limit=None, interval=2,
+                 max_error_rate=0.05, max_lag=0.2, decrease=0.75,
+                 tolerance=0.05):
+        """
+        :param limit: 初始worker数
+        :param min_limit: worker数下限
+        :param max_limit: worker数上限，None表示不调整
+        :param interval: 调整间隔(秒)
+        :param max_error_rate: 出错(重试和失败)占请求的比例上限
+        :param max_lag: 事件循环延迟上限(秒)
+        :param decrease: 减少时乘以的比例
+        :param tolerance: 吞吐量波动在此比例以内视为没有变化
+        """
+        self.limit = limit
+        self.min_limit = min(min_limit, limit)
+        self.max_limit = max(max_limit or limit, limit)
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.max_lag = max_lag
+        self.decrease = decrease
+        self.tolerance = tolerance
+
+    async def measure_lag(self, tick=0.1):
+        """
+        在一个调整间隔内定时检查事件循环的延迟
+        :param tick: 检查间隔(秒)
+        :return: 最大延迟(秒)
+        """
+        lag, deadline = 0, time.monotonic() + self.interval
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(tick)
+            now = time.monotonic()
+            lag = max(lag, now - started_at - tick)
+            if now >= deadline:
+                return lag
+
+    @staticmethod
+    def sample(metrics):
+        """
+        :return: (时间, 下载字节数, 出错数, 请求数)
+        """
+        retries = metrics.total("retries_total")
+        return (time.monotonic(),
+                metrics.total("bytes_total"),
+                retries + metrics.total("downloads_total", result="retry") +
+                metrics.total("downloads_total", result="failed"),
+                retries + metrics.total("downloads_total"))
+
+    def decide(self, throughput, last_throughput, error_rate, lag, busy,
+               increased):
+        """
+        :return: (新的worker数, 原因)
+        """
+        if error_rate > self.max_error_rate:
+            return max(self.min_limit, int(self.limit * self.decrease)), \
+                f"error rate {error_rate:.2%}"
+        if lag > self.max_lag:
+            return max(self.min_limit, int(self.limit * self.decrease)), \
+                f"loop lag {lag:.3f}s"
+        if increased and throughput < last_throughput * (1 - self.tolerance):
+            return max(self.min_limit, self.limit - 1), "throughput dropped"
+        if busy and throughput >= last_throughput * (1 - self.tolerance):
+            return min(self.max_limit, self.limit + 1), "all workers busy"
+        return self.limit, None
+
+    async def adapt(self, metrics, logger):
+        """
+        根据统计数据定时调整worker数
+        :param metrics: Metrics
+        :param logger:
+        :return:
+        """
+        last, last_throughput, increased = self.sample(metrics), 0, False
+        metrics.set("workers_limit", self.limit)
+        while True:
+            lag = await self.measure_lag()
+            current = self.sample(metrics)
+            elapsed, recv, errors, requests = (
+                c - l for c, l in zip(current, last))
+            last = current
+            throughput = recv / elapsed
+            error_rate = errors / requests if requests else 0
+            busy = metrics.total("workers_active") >= self.limit
+            limit, reason = self.decide(
+                throughput, last_throughput, error_rate, lag, busy, increased)
+            increased = limit > self.limit
+            last_throughput = throughput
+            if limit != self.limit:
+                logger.info(
+                    f"Workers {self.limit} -> {limit}: {reason}, "
+                    f"throughput {throughput / 1024 / 1024:.2f}MB/s. ")
+                self.limit = limit
+                metrics.set("workers_limit", limit)
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--adaptive", action="store_true",
+            help="Adjust worker count by throughput, errors and loop lag, "
+                 "starting from --workers. ")
+        parser.add_argument(
+            "--min-workers", type=int, default=1,
+            help="Min worker count in adaptive mode. ")
+        parser.add_argument(
+            "--max-workers", type=int, default=0,
+            help="Max worker count in adaptive mode, "
+                 "default: 4 * workers. ")
+        parser.add_argument(
+            "--adapt-interval", type=float, default=2,
+            help="Seconds between adjustments in adaptive mode. ")
+        parser.add_argument(
+            "--max-error-rate", type=float, default=0.05,
+            help="Error rate to reduce workers at in adaptive mode. ")
+        parser.add_argument(
+            "--max-loop-lag", type=float, default=0.2,
+            help="Event loop lag in seconds to reduce workers at "
+                 "in adaptive mode. ")
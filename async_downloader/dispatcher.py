@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+import math
+import time
+import heapq
+
+from urllib.parse import urlparse
+from collections import OrderedDict, defaultdict
+
+
+class Dispatcher(object):
+    """
+    按host分队列的任务调度：从source预读的任务放入各自host的队列，
+    优先分派优先级(priority字段，越大越优先)最高的任务，优先级相同时在各host之间轮流分派，
+    并限制每个host同时下载的任务数，避免一个慢host占满所有worker。
+    等待中的任务优先级随时间增长，避免低优先级的任务一直得不到执行。
+    """
+    def __init__(self, host_workers=0, aging=0):
+        """
+        :param host_workers: 每个host同时下载的任务数上限，0表示不限制
+        :param aging: 任务每等待一秒增加的优先级
+        """
+        self.host_workers = host_workers
+        self.aging = aging
+        self.queues = OrderedDict()
+        self.running = defaultdict(int)
+        self.size = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def host(data):
+        return urlparse(data.url).hostname
+
+    def put(self, raw, data):
+        """
+        :param raw: source返回的原始数据
+        :param data: 解析后的Task
+        :return:
+        """
+        # 当前优先级为priority + aging * (now - 加入时间)，
+        # 各任务之间的相对顺序不随时间变化，所以可以用不变的键排序，键越小越优先
+        key = self.aging * time.monotonic() - float(data.priority or 0)
+        self.count += 1
+        heapq.heappush(self.queues.setdefault(self.host(data), []),
+                       (key, self.count, raw, data))
+        self.size += 1
+
+    def get(self):
+        """
+        从没有达到并发上限的host中取出当前优先级最高的任务，没有可以分派的任务时返回None。
+        :return: (raw, data)
+        """
+        now, best, best_host = time.monotonic(), None, None
+        for host, queue in self.queues.items():
+            if self.host_workers and self.running[host] >= self.host_workers:
+                continue
+            # 按整数级别比较，同一级别时按顺序选择，保证在各host之间轮流分派
+            level = math.floor(self.aging * now - queue[0][0])
+            if best is None or level > best:
+                best, best_host = level, host
+        if best_host is None:
+            return
+        queue = self.queues[best_host]
+        _, _, raw, data = heapq.heappop(queue)
+        if queue:
+            # 轮到下一个host
+            self.queues.move_to_end(best_host)
+        else:
+            del self.queues[best_host]
+        self.running[best_host] += 1
+        self.size -= 1
+        return raw, data
+
+    def done(self, data):
+        """
+        任务结束后释放所属host的并发名额
+        :param data:
+        :return:
+        """
+        host = self.host(data)
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+
+    def clear(self):
+        """
+        清空所有未分派的任务
+        :return: 按优先级排序的[(raw, data), ...]
+        """
+        items = sorted(item for queue in self.queues.values()
+                       for item in queue)
+        self.queues.clear()
+        self.size = 0
+        return [(raw, data) for _, _, raw, data in items]
@@ -1,25 +1,95 @@
 # -*- coding:utf-8 -*-
 import os
 import re
-import json
+import asyncio
 import aiohttp
-import aiofiles
+import inspect
 import traceback
 
-from .utils import readexactly
+from urllib.parse import urlparse
+from .journal import Journal
+from .cache import Entry, link
+from .buffers import FileWriter
+from .retry import StatusError, classify
+from .pipeline import Pipeline, IntegrityError, current_pipeline
+from .utils import open_file, cache_property
 
 
 class DownloadWrapper(object):
+    # 用于校验和通知的任务字段，不传给下载方法，失败时保留在退回的任务中
+    fields = ("md5", "sha256", "id")
 
     def __init__(self, download_method, downloader):
         self.default_engine_cls = DownloaderEngine
         self.download_method = download_method
         self.downloader = downloader
 
+    @cache_property
+    def keywords(self):
+        """
+        下载方法接受的关键字参数，只有这些任务字段会传给下载方法，其它字段只保留在task.meta中
+        :return: 参数名的集合，接受任意关键字参数时返回None
+        """
+        parameters = inspect.signature(
+            self.download_method or self.default_engine_cls.run).parameters
+        if any(parameter.kind == parameter.VAR_KEYWORD
+               for parameter in parameters.values()):
+            return None
+        return {name for name, parameter in parameters.items()
+                if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD,
+                                      parameter.KEYWORD_ONLY)}
+
     async def close(self):
-        pass
+        # 所有下载方式共用downloader的连接池和缓存，在这里统一关闭
+        await self.downloader.pool.close()
+        self.downloader.cache and await self.downloader.cache.close()
+
+    async def __call__(self, task):
+        """
+        :param task: Task
+        :return: 失败时返回失败后的Task
+        """
+        pipeline = Pipeline.create(
+            self.downloader, task.url, task.filename,
+            {"md5": task.get("md5"), "sha256": task.get("sha256")})
+        # 任务中的其它字段传给接受它们的下载方法
+        kwargs = {k: v for k, v in task.meta.items()
+                  if k not in self.fields and
+                  (self.keywords is None or k in self.keywords)} \
+            if task.meta else {}
+        # 每个下载任务在自己的上下文中运行，互不影响
+        current_pipeline.set(pipeline)
+        try:
+            with self.downloader.profiler.task(
+                    "download", url=task.url, filename=task.filename):
+                rs = await self.run(
+                    task.url, task.filename, task.failed_times, **kwargs)
+                if not rs and pipeline and not pipeline.finished:
+                    rs = await self.process(pipeline, task.filename)
+        finally:
+            pipeline and pipeline.abort()
+        return rs and task.failed(rs)
+
+    async def process(self, pipeline, filename):
+        """
+        自定义的下载方法没有把数据交给处理器链时，从下载完成的文件中读取剩余的数据，
+        使校验、解压和tee对所有下载方法都有效
+        :param pipeline:
+        :param filename:
+        :return: 失败时返回失败结果
+        """
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, pipeline.finish, fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+        except Exception as e:
+            self.downloader.logger.error(f"{filename} got Error: {e}")
+            return {"error": classify(e)}
 
-    async def __call__(self, *args, **kwargs):
+    async def run(self, *args, **kwargs):
         if self.download_method:
             return await self.download_method(self.downloader, *args, **kwargs)
         else:
@@ -31,19 +101,27 @@ class DownloadWrapper(object):
 
 
 async def download(self, url, filename, failed_times=0):
-    """每次下载都重新开启一个新的session"""
-    async with aiohttp.ClientSession(
-            conn_timeout=10, read_timeout=3600) as session:
-        return await _download(self, url, filename, failed_times, session)
+    """使用downloader共享的连接池下载，不支持断点续传"""
+    return await _download(
+        self, url, filename, failed_times, self.pool.session)
+
+
+async def co_session_download(self, url, filename, failed_times=0):
+    """与download相同，保留以兼容通过--download指定该函数的用法"""
+    return await _download(
+        self, url, filename, failed_times, self.pool.session)
 
 
-async def co_session_download(self, url, filename, failed_times=0, sessions=[]):
-    """所有请求使用同一个session，但需要增加将session的close方法传递给download函数"""
-    if not sessions:
-        sessions.append(aiohttp.ClientSession(
-            conn_timeout=10, read_timeout=3600))
-        co_session_download.close = sessions[0].close
-    return await _download(self, url, filename, failed_times, sessions[0])
+def abandon(downloader, url, filename, failed_times):
+    """
+    失败次数超过上限的任务不再下载，返回失败结果，由调度器放弃并写入死信，
+    不能返回None，否则会被当作下载成功
+    :return: 失败后的任务
+    """
+    downloader.logger.error(
+        f"Abandon {filename} of {url} failed for {failed_times} times. ")
+    return {"url": url, "filename": filename, "failed_times": failed_times,
+            "error": "abandoned"}
 
 
 class DownloaderEngine(object):
@@ -51,96 +129,382 @@ class DownloaderEngine(object):
     支持断点续传
     """
     def __init__(self, downloader, conn_timeout=10, read_timeout=1800):
-        self.session = aiohttp.ClientSession(
-            conn_timeout=conn_timeout, read_timeout=read_timeout)
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, connect=conn_timeout, sock_read=read_timeout)
         self.downloader = downloader
         self.failed_times_max = 3
+        self.segment_tries_max = 3
         self.tries = 0
+        self.failed_routes = set()
+        # 使用了的缓存中的文件
+        self.reused = None
+
+    @property
+    def session(self):
+        return self.downloader.pool.session
+
+    def segmentable(self, total, ranged=True):
+        # 服务器不支持Range时只能使用一个连接下载，
+        # 处理器链需要按顺序接收数据，不能分段并发下载
+        return ranged and self.downloader.segments > 1 and \
+               total >= self.downloader.segment_threshold and \
+               current_pipeline.get() is None
 
     async def run(self, url, filename, failed_times=0):
         if failed_times > self.failed_times_max:
-            self.downloader.logger.error(
-                f"Abandon {filename} of {url} failed for {failed_times} times.")
+            return abandon(self.downloader, url, filename, failed_times)
+        cache = self.downloader.cache
+        if cache is None:
+            return await self.transfer(url, filename, failed_times)
+        # 相同url的任务等待前一个完成后直接使用其下载的文件
+        async with cache.lock(url):
+            return await self.transfer(url, filename, failed_times, cache)
+
+    async def transfer(self, url, filename, failed_times, cache=None):
+        """
+        :param url:
+        :param filename:
+        :param failed_times:
+        :param cache: 元信息缓存
+        :return: 失败时返回失败后的任务
+        """
+        journal = Journal.load(filename, url)
+        entry = None
+        if cache is not None and (journal.complete or not journal.received):
+            pipeline = current_pipeline.get()
+            entry = await cache.lookup(url, {
+                algorithm: pipeline.digest(algorithm)
+                for algorithm in ("sha256", "md5")} if pipeline else {})
+            if entry is None and journal.complete:
+                # 缓存之前下载完成的文件，使用日志中的校验值验证
+                entry = Entry(url, journal.etag, journal.last_modified,
+                              journal.total, path=filename)
+                entry = entry if entry.valid() else None
+            # 复用或者重新验证，不再使用之前的进度
+            journal = Journal(filename, url)
+        elif journal.complete:
+            self.downloader.logger.info(f"{filename} already downloaded. ")
             return
-        received, total, f = 0, 0, None
-        if os.path.exists(filename) and await self.conti_check(url):
-            f = await aiofiles.open(filename, "ab")
-            received = f.tell()
+        error = None
+        try:
+            while self.tries < 2:
+                try:
+                    await self.fetch(url, filename, journal, entry)
+                    self.downloader.logger.info(
+                        f"{filename} download finished. ")
+                    if cache is not None:
+                        await self.store(cache, url, filename, journal)
+                    break
+                except Exception as e:
+                    error = e
+                    self.downloader.logger.error(f"{filename} got Error: {e}")
+                    self.downloader.metrics.inc(
+                        "retries_total", host=urlparse(url).hostname)
+                    self.tries += 1
+            else:
+                failed_times += 1
+                self.downloader.logger.error(
+                    f"{filename} of {url} failed for {failed_times} times.")
+                return {"url": url, "filename": filename,
+                        "failed_times": failed_times, "error": classify(error)}
+        finally:
+            self.downloader.progress.finish(filename)
+            await journal.close()
 
-        while self.tries < 2:
-            headers = self.downloader.headers.copy()
-            try:
-                while True:
-                    headers["Range"] = f"bytes={received}-"
-                    self.downloader.logger.debug(
-                        f"{filename} got {received} bytes.")
+    async def fetch(self, url, filename, journal, entry=None):
+        """
+        下载日志中缺失的部分，远端文件变化时从头下载。
+        传输中断时从已写入的位置继续，连续多次没有进展时失败。
+        :param url:
+        :param filename:
+        :param journal: 断点续传日志
+        :param entry: 缓存中的文件，可以直接使用或者没有变化时使用
+        :return:
+        """
+        if entry is not None and entry.fresh:
+            return await self.reuse(filename, journal, entry, "fresh")
+        conditions = entry.conditions() if entry else {}
+        # 文件描述符只在这里打开和关闭，任何异常都不会泄露
+        fd, stalls = None, 0
+        try:
+            while not journal.complete:
+                start = journal.missing()[0][0]
+                received = journal.received
+                headers = self.downloader.headers.copy()
+                headers["Range"] = f"bytes={start}-"
+                if journal.validator:
+                    headers["If-Range"] = journal.validator
+                headers.update(conditions)
+                self.downloader.logger.debug(
+                    f"{filename} got {received} bytes.")
+                resp = route = None
+                try:
+                    route = self.route(url)
+                    resp = await self.session.request(
+                        "GET", url, headers=headers, timeout=self.timeout,
+                        **route.kwargs)
+                    route.responded()
+                    if resp.status == 304 and conditions:
+                        route.done()
+                        return await self.reuse(
+                            filename, journal, entry, "not_modified")
+                    conditions = {}
+                    if resp.status >= 300:
+                        raise StatusError(
+                            resp.status, f"Haven't got any data from {url}.")
+                    # 下载文件。
+                    if resp.status == 206:
+                        total = int(re.search(
+                            r'/(\d+)', resp.headers['Content-Range']).group(1))
+                    else:
+                        # 服务器不支持断点续传或者远端文件已经变化，返回了整个文件
+                        total, start = int(resp.headers["Content-Length"]), 0
+                    if not journal.matches(total, resp.headers) or \
+                            resp.status != 206:
+                        self.downloader.logger.debug(
+                            f"{filename} changed or not started, restart. ")
+                        journal.reset(total, resp.headers)
+                        received = 0
+                        pipeline = current_pipeline.get()
+                        pipeline and pipeline.reset()
+                        fd is not None and os.close(fd)
+                        fd = None
+                        if start:
+                            route.done()
+                            continue
+                    fd = fd or self.downloader.storage.open(
+                        filename, journal.received, total)
+                    self.downloader.progress.start(
+                        filename, total, journal.received)
+                    # 返回了206或者声明支持Range时才能分段下载
+                    await self.fetch_ranges(
+                        url, filename, fd, journal, journal.missing(), resp,
+                        route, resp.status == 206 or
+                        resp.headers.get("Accept-Ranges") == "bytes")
                     resp = None
-                    try:
-                        resp = await self.session.request(
-                            "GET", url, headers=headers, **self.get_proxy())
-                        # 下载文件。
-                        content_range = resp.headers['Content-Range']
-                        total = int(re.search(r'/(\d+)', content_range).group(1))
-                        total = total or content_range
-                        if content_range and resp.status < 300:
-                            f = f or await aiofiles.open(filename, "wb")
-                            chunk = await readexactly(resp.content, 1024000)
-                            while chunk:
-                                received += len(chunk)
-                                self.downloader.logger.debug(
-                                    f"Download {filename}: {len(chunk)} from {url}"
-                                    f", processing {round(received/total, 2)}. ")
-                                await f.write(chunk)
-                                chunk = await readexactly(resp.content, 1024000)
-                            self.downloader.logger.info(
-                                f"{filename} download finished. ")
-                            break
-                        else:
-                            raise RuntimeError(f"Haven't got any data from {url}.")
-                    except aiohttp.client_exceptions.ClientPayloadError:
-                        self.downloader.logger.error(
-                            f"{filename} download error, try to continue. ")
-                    finally:
-                        resp and resp.close()
-                break
-            except Exception as e:
-                self.downloader.logger.error(f"{filename} got Error: {e}")
-                self.tries += 1
-        else:
-            f and f.close()
-            failed_times += 1
-            self.downloader.logger.error(
-                f"{filename} of {url} failed for {failed_times} times.")
-            return json.dumps(
-                {"url": url, "filename": filename, "failed_times": failed_times})
-
-    def get_proxy(self):
-        if self.tries % 2:
-            return {
-                "proxy": self.downloader.proxy,
-                "proxy_auth": self.downloader.proxy_auth and
-                              aiohttp.BasicAuth(*self.downloader.proxy_auth)
-            }
-        else:
-            return {"proxy": None, "proxy_auth": None}
+                except aiohttp.client_exceptions.ClientPayloadError as e:
+                    # 中断前写入的数据已经记录在日志中，没有进展的中断计入失败
+                    stalls = 0 if journal.received > received else stalls + 1
+                    if stalls > self.segment_tries_max:
+                        route and self.failed(route, e)
+                        raise
+                    self.downloader.logger.error(
+                        f"{filename} download error, try to continue. ")
+                except Exception as e:
+                    route and self.failed(route, e)
+                    raise
+                finally:
+                    resp and resp.close()
+                    route and route.close()
+            await self.finish(filename, fd, journal)
+            with self.downloader.profiler.span("commit"):
+                await self.downloader.storage.commit(fd, filename)
+        finally:
+            fd is not None and os.close(fd)
 
-    async def conti_check(self, url):
+    async def reuse(self, filename, journal, entry, reason):
+        """
+        使用缓存中的文件代替下载，文件不在filename时使用硬链接或复制，
+        处理器链从文件中读取全部数据
+        :param filename:
+        :param journal:
+        :param entry:
+        :param reason: fresh: 本次运行中下载过或者内容一致，not_modified: 远端文件没有变化
+        :return:
+        """
+        if entry.path != filename:
+            await asyncio.get_event_loop().run_in_executor(
+                None, link, entry.path, filename)
+        self.downloader.logger.debug(
+            f"{filename} reused {entry.path} of {entry.url}: {reason}. ")
+        self.downloader.metrics.inc("cache_hits_total", reason=reason)
+        self.reused = entry
+        # 内容相同的其它url的校验值不能用于这个url
+        journal.reset(entry.size,
+                      entry.headers if entry.url == journal.url else {})
+        journal.mark(0, entry.size)
+        fd = open_file(filename, entry.size)
+        try:
+            await self.finish(filename, fd, journal)
+        finally:
+            os.close(fd)
+
+    async def store(self, cache, url, filename, journal):
+        """
+        下载或者验证完成后记录到缓存中
+        :return:
+        """
+        pipeline = current_pipeline.get()
+        # 复用的文件内容没有变化，保留之前记录的哈希值
+        digests = {algorithm: pipeline and pipeline.digest(algorithm) or
+                   self.reused and getattr(self.reused, algorithm)
+                   for algorithm in ("md5", "sha256")}
+        await cache.put(Entry(
+            url, journal.etag, journal.last_modified, journal.total,
+            path=filename, **digests))
+
+    async def finish(self, filename, fd, journal):
+        """
+        下载完成后结束处理器链，校验失败时清空日志，下次从头下载
+        :return:
+        """
+        pipeline = current_pipeline.get()
+        if pipeline is None:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, pipeline.finish, fd, journal.total)
+        except IntegrityError:
+            journal.reset(journal.total, {})
+            pipeline.reset()
+            raise
+
+    def split(self, ranges, total, ranged=True):
+        """
+        大文件将缺失的字节范围按数据块对齐分成多段，
+        范围可能从写了一部分的块中间开始，各段的分界仍然与数据块对齐。
+        :param ranges:
+        :param total:
+        :param ranged: 服务器是否支持Range
+        :return:
+        """
+        if not self.segmentable(total, ranged):
+            return ranges
+        block_size = Journal.block_size
+        size = sum(end - start for start, end in ranges)
+        size = -(-size // self.downloader.segments)
+        size = -(-size // block_size) * block_size
+        segments = []
+        for start, end in ranges:
+            while start < end:
+                stop = min(start // block_size * block_size + size, end)
+                segments.append((start, stop))
+                start = stop
+        return segments
+
+    async def fetch_ranges(self, url, filename, fd, journal, ranges, resp,
+                           route=None, ranged=True):
+        """
+        将缺失的字节范围按需分段，使用多个连接并发下载，
+        每段写入预分配文件的对应位置，失败时只重试该段。
+        :param url:
+        :param filename:
+        :param fd: 文件描述符
+        :param journal: 断点续传日志
+        :param ranges: 缺失的字节范围
+        :param resp: 已经打开的从第一段开始的响应，用于下载第一段
+        :param route: resp使用的线路
+        :param ranged: 服务器是否支持Range
+        :return:
+        """
+        ranges = self.split(ranges, journal.total, ranged)
+        if not self.segmentable(journal.total, ranged):
+            # 小文件逐段顺序下载
+            for start, end in ranges:
+                await self.fetch_segment(
+                    url, filename, fd, journal, start, end, resp, route)
+                resp = route = None
+            return
+        # 并发的各段在各自的时间线中记录
+        segments = [asyncio.ensure_future(self.downloader.profiler.run(
+            "segment", self.fetch_segment(
+                url, filename, fd, journal, start, end,
+                *((resp, route) if not i else ())), start=start, end=end))
+            for i, (start, end) in enumerate(ranges)]
+        try:
+            await asyncio.wait(segments, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # 有一段彻底失败了(或者任务被取消)，其它段也没有必要继续下载了
+            for task in segments:
+                task.cancel()
+            # 取出每一段的结果，不遗漏任何一段的异常
+            rs = await asyncio.gather(*segments, return_exceptions=True)
+        errors = [e for e in rs if isinstance(e, Exception)]
+        if errors:
+            raise errors[0]
+
+    async def fetch_segment(self, url, filename, fd, journal, start, end,
+                            resp=None, route=None):
+        """
+        下载[start, end)范围的数据，写入完成的数据块记录到日志中。
+        :return:
+        """
+        tries, begin, host = 0, start, urlparse(url).hostname
         while True:
             try:
-                headers = self.downloader.headers.copy()
-                headers['Range'] = 'bytes=0-4'
-                resp = await self.session.request(
-                    "GET", url, headers=headers, **self.get_proxy())
-                return bool(resp.headers.get('Content-Range'))
+                if resp is None:
+                    headers = self.downloader.headers.copy()
+                    headers["Range"] = f"bytes={start}-{end - 1}"
+                    if journal.validator:
+                        headers["If-Range"] = journal.validator
+                    route = self.route(url, tries)
+                    resp = await self.session.request(
+                        "GET", url, headers=headers, timeout=self.timeout,
+                        **route.kwargs)
+                    route.responded()
+                    if resp.status != 206:
+                        raise StatusError(
+                            resp.status,
+                            f"Range {start}-{end - 1} of {url} not supported.")
+                offset = start
+                with self.downloader.profiler.span(
+                        "body", start=start, end=end):
+                    async with FileWriter(
+                            fd, start, self.downloader.buffers,
+                            lambda offset, length:
+                            journal.mark(begin, offset + length),
+                            self.downloader.limiter.throttle_for(host),
+                            current_pipeline.get(),
+                            self.downloader.storage.sync_every,
+                            self.downloader.profiler) as writer:
+                        try:
+                            while writer.position < end:
+                                chunk = await writer.read(
+                                    resp.content, end - writer.position)
+                                if not chunk:
+                                    raise RuntimeError(
+                                        f"Connection closed at "
+                                        f"{writer.position} of {url}.")
+                                self.downloader.metrics.inc(
+                                    "bytes_total", chunk, host=host)
+                                self.downloader.progress.update(
+                                    filename, chunk)
+                        finally:
+                            start = writer.position
+                route.done(start - offset)
+                return
             except Exception as e:
-                self.downloader.logger.error(f"Failed to check: {e}")
-                if self.tries < 2:
-                    self.tries += 1
-                else:
-                    raise e
+                tries += 1
+                route and self.failed(route, e)
+                self.downloader.logger.error(
+                    f"{filename} segment at {start} got Error: {e}")
+                self.downloader.metrics.inc("retries_total", host=host)
+                if tries > self.segment_tries_max:
+                    raise
+            finally:
+                # 第一段可能使用的是到文件结尾的响应，只读到段尾，所以直接关闭连接
+                resp and resp.close()
+                route and route.close()
+                resp = route = None
+
+    def route(self, url, tries=None):
+        """
+        从代理池中选择线路，不再使用本次任务中失败过的线路
+        :param url:
+        :param tries: 第几次尝试，None表示使用任务的尝试次数
+        :return: Route
+        """
+        return self.downloader.proxies.choose(
+            urlparse(url).hostname, self.tries if tries is None else tries,
+            self.failed_routes)
+
+    def failed(self, route, exc):
+        route.fail(exc)
+        self.failed_routes.add(route.proxy)
 
     async def close(self):
-        return await self.session.close()
+        # session属于downloader的连接池，由DownloadWrapper负责关闭
+        pass
 
 
 async def _safe_download(self, url, filename, failed_times, session):
@@ -155,69 +519,84 @@ async def _safe_download(self, url, filename, failed_times, session):
         """
     failed_times_max = 3
     if failed_times > failed_times_max:
-        self.logger.error(
-            f"Abandon {filename} of {url} failed for {failed_times_max} times. ")
-        return
-    p = None
-    # 出现异常后最多尝试2次，其中一次使用代理。
+        return abandon(self, url, filename, failed_times)
+    host, failed_routes = urlparse(url).hostname, set()
+    # 出现异常后最多尝试2次，由代理池选择线路，默认第一次直连，第二次使用代理。
     recv = 0
     total = 0
-    f = None
-    if os.path.exists(filename):
-        f = await aiofiles.open(filename, "ab")
-        recv = f.tell()
+    fd = None
+    # 按临时文件的大小续传，所以不预分配
+    if os.path.exists(self.storage.temp(filename)):
+        recv = os.path.getsize(self.storage.temp(filename))
     for i in range(2):
         headers = self.headers.copy()
         headers["range"] = f"bytes={recv}-"
+        route = self.proxies.choose(host, i, failed_routes)
+        offset = recv
         try:
-            if p and self.proxy_auth:
-                proxy_auth = aiohttp.BasicAuth(*self.proxy_auth)
-            else:
-                proxy_auth = None
             while True:
                 headers["range"] = f"bytes={recv}-"
-                print(f"{filename} recv {recv}")
                 resp = None
                 try:
                     resp = await session.request(
                         "GET", url,
                         headers=headers,
-                        proxy=p,
-                        proxy_auth=proxy_auth)
+                        **route.kwargs)
+                    route.responded()
                     # 下载文件。
                     total = total or int(resp.headers.get("Content-Length", 0))
                     if int(resp.headers.get("Content-Length", 0)) and resp.status < 300:
-                        f = f or await aiofiles.open(filename, "wb")
-                        chunk = await readexactly(resp.content, 1024000)
-                        while chunk:
-                            recv += len(chunk)
-                            self.logger.debug(
-                                f"Download {filename}: {len(chunk)} from {url}"
-                                f", processing {round(recv/total, 2)}. ")
-                            await f.write(chunk)
-                            chunk = await readexactly(resp.content, 1024000)
+                        fd = fd or self.storage.open(filename, recv)
+                        self.progress.start(filename, total, recv)
+                        async with FileWriter(
+                                fd, recv, self.buffers,
+                                throttle=self.limiter.throttle_for(host),
+                                sync_every=self.storage.sync_every,
+                                profiler=self.profiler) as writer:
+                            try:
+                                chunk = await writer.read(resp.content)
+                                while chunk:
+                                    self.metrics.inc(
+                                        "bytes_total", chunk, host=host)
+                                    self.progress.update(filename, chunk)
+                                    chunk = await writer.read(resp.content)
+                            finally:
+                                recv = writer.position
                         self.logger.info("Download finished. ")
                         break
                     else:
-                        raise RuntimeError(f"Haven't got any data from {url}. ")
+                        raise StatusError(
+                            resp.status, f"Haven't got any data from {url}. ")
                 except aiohttp.client_exceptions.ClientPayloadError:
 
                     self.logger.error(f"{filename} download error, try to continue. ")
                     resp and resp.close()
+            route.done(recv - offset)
             break
         except Exception as e:
+            error = e
+            route.fail(e)
+            failed_routes.add(route.proxy)
             self.logger.error(f"Error: {e}")
-            p = self.proxy
+            self.metrics.inc("retries_total", host=host)
+        finally:
+            route.close()
     else:
-        f and f.close()
+        fd is not None and os.close(fd)
+        self.progress.finish(filename)
         failed_times += 1
-        if os.path.exists(filename):
-            os.unlink(filename)
+        # 保留临时文件，下次从已下载的位置继续
         self.logger.error(
             f"{filename} of {url} failed for {failed_times} times. push back.")
-        return json.dumps({"url": url,
-                    "filename": filename,
-                    "failed_times": failed_times})
+        return {"url": url,
+                "filename": filename,
+                "failed_times": failed_times,
+                "error": classify(error)}
+    try:
+        fd is not None and await self.storage.commit(fd, filename)
+    finally:
+        fd is not None and os.close(fd)
+        self.progress.finish(filename)
 
 
 async def _download(self, url, filename, failed_times, session):
@@ -232,47 +611,64 @@ async def _download(self, url, filename, failed_times, session):
     """
     failed_times_max = 3
     if failed_times > failed_times_max:
-        self.logger.error(
-            f"Abandon {filename} of {url} failed for {failed_times_max} times. ")
-        return
-    p = None
-    # 出现异常后最多尝试2次，其中一次使用代理。
+        return abandon(self, url, filename, failed_times)
+    host, failed_routes = urlparse(url).hostname, set()
+    # 出现异常后最多尝试2次，由代理池选择线路，默认第一次直连，第二次使用代理。
     for i in range(2):
+        route = self.proxies.choose(host, i, failed_routes)
         try:
-            if p and self.proxy_auth:
-                proxy_auth = aiohttp.BasicAuth(*self.proxy_auth)
-            else:
-                proxy_auth = None
             resp = await session.request(
                 "GET", url,
                 headers=self.headers,
-                proxy=p,
-                proxy_auth=proxy_auth)
+                **route.kwargs)
+            route.responded()
             # 下载文件。
             total = int(resp.headers.get("Content-Length", 0))
             if total and resp.status < 300:
-                recv = 0
-                async with aiofiles.open(filename, "wb") as f:
-                    chunk = await readexactly(resp.content, 1024000)
-                    while chunk:
-                        recv += len(chunk)
-                        self.logger.debug(
-                            f"Download {filename}: {len(chunk)} from {url}"
-                            f", processing {round(recv/total, 2)}. ")
-                        await f.write(chunk)
-                        chunk = await readexactly(resp.content, 1024000)
+                fd = self.storage.open(filename, 0, total)
+                self.progress.start(filename, total)
+                pipeline = current_pipeline.get()
+                try:
+                    # 每次都从头下载，处理器链也从头开始
+                    pipeline and pipeline.reset()
+                    async with FileWriter(
+                            fd, 0, self.buffers,
+                            throttle=self.limiter.throttle_for(host),
+                            pipeline=pipeline,
+                            sync_every=self.storage.sync_every,
+                            profiler=self.profiler) as writer:
+                        chunk = await writer.read(resp.content)
+                        while chunk:
+                            self.metrics.inc("bytes_total", chunk, host=host)
+                            self.progress.update(filename, chunk)
+                            chunk = await writer.read(resp.content)
+                    if pipeline:
+                        await asyncio.get_event_loop().run_in_executor(
+                            None, pipeline.finish, fd, writer.position)
+                    await self.storage.commit(fd, filename)
+                finally:
+                    os.close(fd)
+                    self.progress.finish(filename)
+                route.done(writer.position)
                 self.logger.info("Download finished. ")
 
             else:
-                raise RuntimeError(f"Haven't got any data from {url}. ")
+                raise StatusError(
+                    resp.status, f"Haven't got any data from {url}. ")
             break
-        except Exception:
+        except Exception as e:
+            error = e
+            route.fail(e)
+            failed_routes.add(route.proxy)
             self.logger.error("Error: " + "".join(traceback.format_exc()))
-            p = self.proxy
+            self.metrics.inc("retries_total", host=host)
+        finally:
+            route.close()
     else:
         failed_times += 1
-        if os.path.exists(filename):
-            os.unlink(filename)
-        return json.dumps({"url": url,
-                           "filename": filename,
-                           "failed_times": failed_times})
+        # 每次都从头下载，不完整的临时文件没有用处，已有的filename不受影响
+        self.storage.discard(filename)
+        return {"url": url,
+                "filename": filename,
+                "failed_times": failed_times,
+                "error": classify(error)}
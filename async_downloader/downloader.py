@@ -6,59 +6,281 @@
 """
 import sys
 import json
-import logging
+import time
+import signal
 import asyncio
+import traceback
 
 from functools import partial
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 
+from . import sources
 from .sources import *
+from .metrics import Metrics
+from .progress import Progress
+from .pipeline import Pipeline
+from .buffers import BufferPool
+from .concurrency import AdaptiveConcurrency
+from .dispatcher import Dispatcher
+from .retry import RetryScheduler, classify
+from .cache import Cache
+from .storage import Storage
+from .profiler import Profiler
+from .task import Task, codecs, get_codec
+from .supervisor import Supervisor
+from .proxies import ProxyPool
+from .ratelimit import RateLimiter
+from .sessions import SessionPool
 from .download_engines import DownloadWrapper
-from .utils import load_function, cache_property, ArgparseHelper, find_source
+from .utils import load_function, cache_property, ArgparseHelper, \
+    find_source, setup_logger, close_logger, parse_shard, new_event_loop
+
+
+class Result(object):
+    """
+    以编程方式使用时一个任务的最终结果
+    """
+    def __init__(self, task, event, result=None):
+        """
+        :param task: Task
+        :param event: done: 成功，failed: 失败后放弃，cancelled: 停止时还没有完成
+        :param result: 失败后的Task
+        """
+        self.task = task
+        self.event = event
+        # 失败的类型，见retry.classify
+        self.error = result and result.error
+        self.failed_times = result.failed_times if result else 0
+
+    @property
+    def url(self):
+        return self.task.url
+
+    @property
+    def filename(self):
+        return self.task.filename
+
+    @property
+    def ok(self):
+        return self.event == "done"
+
+    def __repr__(self):
+        return f"<Result {self.event} {self.filename}>"
 
 
 class AsyncDownloader(object):
     """
     异步多协程下载器
     """
+    # 调度使用的source参数及其默认值，idle: 没有任务时继续等待
+    source_options = {"idle": False}
+    # 以编程方式使用时与命令行不同的默认值，不在宿主程序的终端上输出进度
+    embedded_options = {"progress": "none"}
     headers = {
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
         'Accept-Language': 'en',
         'Accept-Encoding': 'deflate, gzip'
     }
 
-    def __init__(self):
+    def __init__(self, source=None, **kwargs):
+        """
+        :param source: 以编程方式使用时的任务来源，Source对象，
+        或者任务(dict或json字符串)的可迭代对象、异步可迭代对象，None表示从命令行读取参数
+        :param kwargs: 以编程方式使用时的参数，与命令行参数同名，-换成_
+        """
         super(AsyncDownloader, self).__init__()
         self.sources = [globals()[k] for k in globals() if k.endswith("Source")]
-        args = self.parse_args()
+        args = self.parse_args() if source is None \
+            else self.make_args(source, **kwargs)
+        # 以编程方式使用时不输出到stdout，由宿主程序配置日志
+        self.embedded = source is not None
         self.idle = getattr(args, "idle", False)
-        self.workers = args.workers
+        self.stopping = False
+        self.processes = args.processes
+        self.shard = args.shard
+        self.uvloop = args.uvloop
+        # 多进程模式下，worker进程向主进程发送统计数据的管道
+        self.conn = None
+        self.metrics = Metrics()
+        self.adaptive = args.adaptive
+        self.concurrency = AdaptiveConcurrency(
+            args.workers, args.min_workers,
+            (args.max_workers or args.workers * 4) if args.adaptive else None,
+            args.adapt_interval, args.max_error_rate, args.max_loop_lag)
+        self.readahead = args.readahead
+        self.dispatcher = Dispatcher(
+            args.host_workers, args.priority_aging / 60)
+        self.retries = RetryScheduler(
+            args.retry_delay, args.retry_max_delay, args.dead_letter)
         self.proxy_auth = args.proxy_auth
-        self.proxy = args.proxy
-        self.source = globals()[args.source.capitalize() + "Source"](**vars(args))
+        self.proxies = ProxyPool.load(
+            args.proxy, args.proxies_file, args.proxy_auth,
+            direct=args.direct, cooldown=args.proxy_cooldown,
+            max_failures=args.proxy_max_failures, metrics=self.metrics)
+        # 兼容自定义的下载函数
+        self.proxy = self.proxies.proxies[0] if self.proxies.proxies else None
+        self.segments = args.segments
+        self.segment_threshold = args.segment_threshold
+        self.storage = Storage(args.fsync, args.fsync_every)
+        self.cache = Cache.load(
+            args.cache, args.cache_max_size, args.cache_max_age)
+        self.hash_algorithms = args.hash
+        self.decompress = args.decompress
+        self.tee = args.tee
+        self.metrics_port = args.metrics_port
+        self.metrics_interval = args.metrics_interval
+        self.metrics_file = args.metrics_file
+        self.progress = Progress(
+            self.metrics, args.progress, args.progress_interval)
+        self.log_level = args.log_level
+        self.log_file = args.log_file
+        self.log_listener = None
+        trace = args.trace
+        # 分片运行时各分片分别导出
+        if trace and self.shard:
+            trace += ".%s-%s" % self.shard
+        self.profiler = Profiler(
+            args.profile, trace, args.block_threshold,
+            (args.profile or trace) and self.logger)
+        self.limiter = RateLimiter(
+            args.rate, args.host_rate, args.request_rate,
+            dict(args.host_rates),
+            args.shard[1] if args.shard else 1)
+        self.limits_file = args.limits_file
+        self.pool = SessionPool(
+            limit=args.conn_limit,
+            limit_per_host=args.conn_limit_per_host,
+            dns_cache_ttl=args.dns_cache_ttl,
+            keepalive_timeout=args.keepalive_timeout,
+            trace_configs=[self.limiter.trace_config(),
+                           self.metrics.trace_config()] +
+            ([self.profiler.trace_config()] if self.profiler.enabled else []))
+        # 每个worker两个缓冲区交替读写，分段下载时每段一个
+        self.buffers = BufferPool(args.buffer_size, self.concurrency.max_limit
+                                  * (max(self.segments, 1) + 1))
+        if source is None:
+            source = globals()[
+                args.source.capitalize() + "Source"](**vars(args))
+        elif not isinstance(source, sources.Source):
+            source = sources.IterableSource(source)
+        if self.shard:
+            source.shard(*self.shard)
+        self.codec = source.codec = get_codec(args.codec)
+        self.source = source
+        # as_completed中输出结果的队列
+        self.results = None
         self.generator = self.gen_task(self.source)
         self.download = DownloadWrapper(load_function(args.download), self)
 
+    @property
+    def workers(self):
+        """
+        当前的worker数，自适应模式下会在运行时调整
+        :return:
+        """
+        return self.concurrency.limit
+
     @cache_property
     def logger(self):
-        logger = logging.getLogger(self.__class__.__name__)
-        logger.setLevel(10)
-        logger.addHandler(logging.StreamHandler(sys.stdout))
+        logger, self.log_listener = setup_logger(
+            self.__class__.__name__, self.log_level, self.log_file,
+            stdout=not self.embedded)
         return logger
 
-    def parse_args(self):
+    def base_parser(self):
+        """
+        :return: 各source共用的参数
+        """
         base_parser = ArgumentParser(
             description=self.__class__.__doc__, add_help=False)
         base_parser.add_argument(
             "--workers", required=True, type=int, help="Worker count. ")
+        base_parser.add_argument(
+            "--host-workers", type=int, default=0,
+            help="Max workers per host, 0 for unlimited. ")
+        base_parser.add_argument(
+            "--readahead", type=int, default=0,
+            help="Count of tasks to read ahead from source for dispatching "
+                 "across hosts, default: 10 * current workers. ")
+        base_parser.add_argument(
+            "--priority-aging", type=float, default=1,
+            help="Priority gained per minute by waiting tasks, "
+                 "0 to disable. ")
+        base_parser.add_argument(
+            "--processes", type=int, default=1,
+            help="Processes to run, each with its own event loop and "
+                 "workers, reading a shard of the source. ")
+        base_parser.add_argument(
+            "--shard", type=parse_shard,
+            help="Only read the i-th(from 0) of N shards of the source: i/N. ")
+        base_parser.add_argument(
+            "--uvloop", action="store_true", help="Use uvloop. ")
+        base_parser.add_argument(
+            "--codec", default="json", choices=list(codecs),
+            help="Codec of tasks in source, tasks in json are always "
+                 "decodable. ")
         base_parser.add_argument(
             "--download", help="Download method, async needed. ")
         base_parser.add_argument(
-            "--proxy", default="http://127.0.0.1:8123", help="Proxy to use.")
+            "--proxy", nargs="*", default=["http://127.0.0.1:8123"],
+            help="Proxies to use.")
         base_parser.add_argument(
-            "--proxy-auth", type=partial(str.split, seq=":", maxsplit=1),
+            "--proxy-auth", type=partial(str.split, sep=":", maxsplit=1),
             help="Proxy auth: user:pass.")
+        ProxyPool.enrich_parser(base_parser)
+        base_parser.add_argument(
+            "--segments", type=int, default=1,
+            help="Download large file in segments concurrently. ")
+        base_parser.add_argument(
+            "--segment-threshold", type=int, default=64 * 1024 * 1024,
+            help="Min file size in bytes to download in segments. ")
+        base_parser.add_argument(
+            "--buffer-size", type=int, default=1024000,
+            help="Size of buffers to read chunks into. ")
+        base_parser.add_argument(
+            "--log-level", default="INFO",
+            choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Log level. ")
+        base_parser.add_argument(
+            "--log-file", help="File to write logs to, stdout by default. ")
+        SessionPool.enrich_parser(base_parser)
+        Metrics.enrich_parser(base_parser)
+        RateLimiter.enrich_parser(base_parser)
+        AdaptiveConcurrency.enrich_parser(base_parser)
+        RetryScheduler.enrich_parser(base_parser)
+        Progress.enrich_parser(base_parser)
+        Pipeline.enrich_parser(base_parser)
+        Cache.enrich_parser(base_parser)
+        Storage.enrich_parser(base_parser)
+        Profiler.enrich_parser(base_parser)
+        return base_parser
+
+    def make_args(self, source, **kwargs):
+        """
+        以编程方式使用时，由关键字参数构建参数，没有指定的使用命令行参数的默认值，
+        source的参数在构造source时指定，这里只接受调度使用的source参数，如idle
+        :param source:
+        :param kwargs:
+        :return:
+        """
+        args = Namespace(**{action.dest: action.default
+                            for action in self.base_parser()._actions})
+        # 调度使用的source参数默认值与source对应的子命令一致，如daemon默认为idle
+        parser = ArgumentParser(add_help=False)
+        if isinstance(source, sources.Source):
+            source.enrich_parser(parser)
+        for key, default in self.source_options.items():
+            value = parser.get_default(key)
+            setattr(args, key, default if value is None else value)
+        for key, value in dict(self.embedded_options, **kwargs).items():
+            if not hasattr(args, key):
+                raise TypeError(f"Unexpected argument: {key}. ")
+            setattr(args, key, value)
+        if args.workers is None:
+            raise TypeError("Argument workers is required. ")
+        return args
 
+    def parse_args(self):
+        base_parser = self.base_parser()
         parser = ArgumentParser(description="Async downloader", add_help=False)
         parser.add_argument('-h', '--help', action=ArgparseHelper,
                             help='show this help message and exit. ')
@@ -75,16 +297,77 @@ class AsyncDownloader(object):
         return parser.parse_args()
 
     def start(self):
-        loop = asyncio.get_event_loop()
+        if self.processes > 1:
+            return Supervisor(self).start()
+        loop = new_event_loop(self.uvloop)
+        asyncio.set_event_loop(loop)
+        # 与Ctrl-C相同，等待正在下载的任务结束后退出
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
         task = loop.create_task(self.process(loop))
         try:
             loop.run_until_complete(task)
         except KeyboardInterrupt:
             self.logger.info("Wait to close...")
-            # 发送一个False，使用异步生成器跳出循环
-            stop_task = loop.create_task(self.generator.asend(False))
-            loop.run_until_complete(asyncio.gather(task, stop_task))
+            # 生成器可能正在等待source返回任务，不能在这里并发asend，
+            # 由process在下一次取任务时发送False，使异步生成器跳出循环
+            self.stopping = True
+            loop.run_until_complete(task)
             loop.close()
+        finally:
+            # 输出队列中剩余的日志
+            close_logger(self.logger, self.log_listener)
+
+    async def as_completed(self, buffer=None):
+        """
+        在当前的事件循环中下载，按完成的顺序返回每个任务的最终结果，
+        结果没有被及时取走时暂停分派新任务。提前结束迭代时不再开始新任务，
+        等待正在下载的任务结束，此时需要aclose或者使用contextlib.aclosing。
+            downloader = AsyncDownloader(tasks, workers=8)
+            async for result in downloader.as_completed():
+                ...
+        :param buffer: 最多缓存多少个没有取走的结果，默认为worker数
+        :return: Result的异步迭代器
+        """
+        results = self.results = asyncio.Queue(buffer or self.workers)
+        process = asyncio.ensure_future(
+            self.process(asyncio.get_running_loop()))
+        try:
+            while not (process.done() and results.empty()):
+                getter = asyncio.ensure_future(results.get())
+                await asyncio.wait(
+                    {getter, process}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            process.result()
+        finally:
+            if not process.done():
+                self.stop()
+                # 不再输出结果，并取走已有的结果，使等待放入结果的调度继续
+                self.results = None
+                while not results.empty():
+                    results.get_nowait()
+                await process
+            close_logger(self.logger, self.log_listener)
+
+    def stop(self):
+        """
+        不再开始新的任务，正在下载的任务结束后退出
+        :return:
+        """
+        self.stopping = True
+
+    async def emit(self, data, event, result=None):
+        """
+        as_completed中输出任务的最终结果
+        :param data:
+        :param event:
+        :param result:
+        :return:
+        """
+        if self.results is not None and event != "retry":
+            await self.results.put(Result(data, event, result))
 
     @staticmethod
     async def gen_task(source):
@@ -92,59 +375,193 @@ class AsyncDownloader(object):
         yield
         async with source as iterable:
             async for data in iterable:
-                if not (yield data and json.loads(data)):
+                if data:
+                    # 同时返回原始数据，用于任务完成后向source确认
+                    raw, task = data if isinstance(data, tuple) \
+                        else (data, source.codec.loads(data))
+                    data = raw, task if isinstance(task, Task) \
+                        else Task.from_dict(task)
+                if not (yield data):
                     break
-        # 关闭时走到这，返回None
-        yield
-        yield "exit"
+            # 关闭时走到这，返回None，在生成器关闭时才关闭source，
+            # 使正在进行的任务结束后还能退回和确认
+            yield
+            yield "exit"
+
+    async def start_services(self):
+        """
+        按配置启动统计接口、定时快照和限速文件的监视
+        :return: 统计接口和后台任务
+        """
+        runner, services = None, []
+        if self.metrics_port:
+            runner = await self.metrics.serve("127.0.0.1", self.metrics_port)
+            self.logger.info(
+                f"Serve metrics at http://127.0.0.1:{self.metrics_port}/metrics. ")
+        if self.metrics_interval:
+            services.append(asyncio.ensure_future(self.metrics.report(
+                self.metrics_interval, self.write_snapshot)))
+        if self.limits_file:
+            services.append(asyncio.ensure_future(
+                self.limiter.watch(self.limits_file, self.logger)))
+        if self.adaptive:
+            services.append(asyncio.ensure_future(
+                self.concurrency.adapt(self.metrics, self.logger)))
+        services.append(asyncio.ensure_future(
+            self.progress.report(self.logger)))
+        if self.conn is not None:
+            services.append(asyncio.ensure_future(
+                Supervisor.report(self, self.conn)))
+        if self.profiler.enabled:
+            services.append(asyncio.ensure_future(
+                self.profiler.monitor(self.metrics)))
+        return runner, services
+
+    async def stop_services(self, runner, services):
+        for service in services:
+            service.cancel()
+        # 等待后台任务结束，使其可以在退出前输出最终结果
+        services and await asyncio.wait(services)
+        self.profiler.export()
+        if self.metrics_interval:
+            self.write_snapshot(json.dumps(self.metrics.snapshot()))
+        if runner is not None:
+            await runner.cleanup()
+
+    def write_snapshot(self, snapshot):
+        if self.metrics_file:
+            with open(self.metrics_file, "a") as f:
+                f.write(snapshot + "\n")
+        else:
+            self.logger.info(snapshot)
+
+    async def fetch(self):
+        """
+        从source中取一个任务
+        :return:
+        """
+        fetched_at = time.time()
+        with self.profiler.span("fetch", self.profiler.LANE_SOURCE):
+            data = await self.generator.asend(not self.stopping)
+        self.metrics.observe("source_fetch_seconds", time.time() - fetched_at)
+        return data
+
+    async def push_back(self, raw, task):
+        """
+        关闭时将任务退回source并确认原始数据，
+        失败过的编码任务重新编码后退回，保留失败次数和错误类型
+        :param raw: 原始数据
+        :param task: Task
+        :return:
+        """
+        data = raw
+        if task.failed_times and isinstance(raw, (str, bytes)):
+            data = self.codec.dumps(task.to_dict())
+        with self.profiler.span("push_back", self.profiler.LANE_PUSH_BACK):
+            await self.source.push_back(data)
+        await self.source.ack(raw)
 
     async def process(self, loop):
         self.logger.info("Start process tasks. ")
+        services = await self.start_services()
         # 预激
         await self.generator.asend(None)
-        free_workers, tasks, alive, got_task = self.workers, [], True, False
-        # 当没有关闭或者有任务时，会继续循环
-        while alive or tasks:
-            # 当任务未满且未关闭时，才会继续产生新任务
-            while free_workers > 0 and alive:
-                data = await self.generator.asend(True)
+        tasks, claims, alive, fetching = set(), {}, True, None
+        # 当没有关闭或者有任务(包括等待重试的任务)时，会继续循环
+        while alive or tasks or self.dispatcher or self.retries or fetching:
+            timeout = None
+            # 未关闭时预读任务放入各host的队列，直到达到预读上限
+            while alive and \
+                    len(self.dispatcher) < (self.readahead or self.workers * 10):
+                if fetching is None:
+                    fetching = asyncio.ensure_future(self.fetch())
+                # source会阻塞等待新任务时，有任务要下载则和下载任务一起等待，
+                # 避免任务完成后要等source超时才能处理
+                if self.source.blocking and (tasks or self.dispatcher) and \
+                        not fetching.done():
+                    break
+                data, fetching = await fetching, None
                 # 返回exit表示要退出了
                 if data == "exit":
-                    got_task = False
                     alive = False
                 # 有data证明有下载任务
                 elif data:
-                    free_workers -= 1
-                    self.logger.debug(f"Start task {data['filename']}. ")
-                    tasks.append(loop.create_task(self.download(**data)))
-                    got_task = True
-                # 否则休息一秒钟
+                    self.dispatcher.put(*data)
+                # 没有新任务时，有任务在运行则等待其完成后再取任务
                 else:
-                    got_task = False
-                    if not self.idle:
-                        break
-                    self.logger.debug("Haven't got tasks. ")
-                    await asyncio.sleep(1)
-            # 清除完成的任务
-            task_index = len(tasks) - 1
-            while task_index >= 0:
-                if tasks[task_index].done():
-                    # 默认成功没有返回值，否则为失败，退回source
-                    rs = tasks.pop(task_index).result()
-                    if rs:
-                        self.logger.info(f"Push back {rs}. ")
-                        await self.source.push_back(rs)
-                    free_workers += 1
-                task_index -= 1
-            # 任务队列是满的，休息一秒钟
-            if not free_workers:
-                await asyncio.sleep(1)
-            # 用来减缓任务队列有但不满且要关闭时产生的大量循环。
-            await asyncio.sleep(.1)
-            # 如果没有任务且不允许空转且上一次循环未发现任务，则停止程序。
-            if not (tasks or self.idle or got_task):
-                alive = False
+                    if self.idle:
+                        self.logger.debug("Haven't got tasks. ")
+                        # source自己会阻塞等待时，只处理已完成的任务
+                        timeout = 0 if self.source.blocking else 1
+                    elif not (tasks or self.dispatcher):
+                        alive = False
+                    break
+            if self.stopping:
+                # 关闭时不再开始新任务，预读的任务退回source，等待重试的任务也退回
+                for raw, data in self.dispatcher.clear():
+                    await self.push_back(raw, data)
+                    await self.emit(data, "cancelled")
+                for raw, task in self.retries.clear():
+                    self.metrics.inc("push_backs_total")
+                    await self.push_back(raw, task)
+                    await self.emit(task, "cancelled")
+            else:
+                # 重试的任务仍然使用原始数据，结束后才向source确认
+                for raw, task in self.retries.due():
+                    self.dispatcher.put(raw, task)
+            # 有空闲的worker时，在各host之间轮流分派任务
+            while len(tasks) < self.workers:
+                item = self.dispatcher.get()
+                if item is None:
+                    break
+                raw, data = item
+                self.logger.debug(f"Start task {data.filename}. ")
+                task = loop.create_task(self.download(data))
+                claims[task] = item
+                tasks.add(task)
+            self.metrics.set("workers_active", len(tasks))
+            self.metrics.set("workers_free", max(self.workers - len(tasks), 0))
+            self.metrics.set("tasks_queued", len(self.dispatcher))
+            self.metrics.set("tasks_retrying", len(self.retries))
+            # 有等待重试的任务时，最晚在其到期时唤醒
+            wait = self.retries.wait()
+            if wait is not None:
+                timeout = wait if timeout is None else min(timeout, wait)
+            if not tasks:
+                timeout and await asyncio.sleep(timeout)
+                continue
+            # 任意一个任务完成都会唤醒调度，空出的位置马上补充新任务
+            done, tasks = await asyncio.wait(
+                tasks | {fetching} if fetching else tasks, timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED)
+            tasks.discard(fetching)
+            for task in done:
+                if task is fetching:
+                    continue
+                raw, data = claims.pop(task)
+                self.dispatcher.done(data)
+                # 默认成功没有返回值，否则为失败，延迟重试或者放弃
+                try:
+                    rs = task.result()
+                except Exception as e:
+                    # 下载方法抛出的异常也按失败处理，不能中断整个调度
+                    self.logger.error(
+                        f"{data.filename} got Error: {traceback.format_exc()}")
+                    rs = data.failed({"error": classify(e)})
+                event = "done"
+                if rs:
+                    event = "retry"
+                    if not self.retries.schedule(rs, self.logger, raw):
+                        event = "failed"
+                        self.metrics.inc("dead_letters_total")
+                await self.source.notify(data, event, rs)
+                await self.emit(data, event, rs)
+                # 等待重试的失败计入retry，只有放弃时才计入failed
+                self.metrics.inc("downloads_total", result=event)
+                if event != "retry":
+                    await self.source.ack(raw)
         await self.download.close()
+        await self.stop_services(*services)
         self.logger.info("Process stopped. ")
         await self.generator.aclose()
 
@@ -0,0 +1,188 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import base64
+import asyncio
+
+from .storage import Storage
+
+
+class Journal(object):
+    """
+    断点续传日志，保存在下载文件旁边的<filename>.journal中。
+    记录url、ETag/Last-Modified、文件大小、已写入文件的数据块位图，
+    以及没有写完的数据块中已经连续写入到的位置，
+    重新下载时据此只请求缺失的部分，无需额外的探测请求。
+    """
+    suffix = ".journal"
+    block_size = 1024 * 1024
+    # 两次保存之间的最小间隔(秒)
+    save_interval = 1
+
+    def __init__(self, filename, url):
+        self.filename = filename
+        self.path = filename + self.suffix
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.total = None
+        self.blocks = bytearray()
+        # 数据块序号: 该块从开头连续写入到的位置，块完成后删除
+        self.partial = {}
+        self.saved_at = 0
+        self.saving = None
+
+    @classmethod
+    def load(cls, filename, url):
+        """
+        读取下载文件对应的日志，日志不存在、损坏、url不一致或下载文件已经不存在时，
+        返回一个空日志。下载完成前数据在临时文件中，完成后在filename中。
+        :param filename:
+        :param url:
+        :return: Journal
+        """
+        journal = cls(filename, url)
+        try:
+            with open(journal.path) as f:
+                meta = json.load(f)
+            if meta["url"] == url and \
+                    meta["block_size"] == journal.block_size:
+                journal.etag = meta["etag"]
+                journal.last_modified = meta["last_modified"]
+                journal.total = meta["total"]
+                journal.blocks = bytearray(base64.b64decode(meta["blocks"]))
+                journal.partial = {int(index): end for index, end
+                                   in meta.get("partial", {}).items()}
+                if not os.path.exists(filename if journal.complete
+                                      else Storage.temp(filename)):
+                    journal = cls(filename, url)
+        except (OSError, ValueError, KeyError):
+            pass
+        return journal
+
+    @property
+    def validator(self):
+        """
+        用于If-Range请求头的校验值，远端文件变化时服务器会返回整个文件。
+        :return:
+        """
+        return self.etag or self.last_modified
+
+    @property
+    def count(self):
+        return -(-self.total // self.block_size) if self.total else 0
+
+    def done(self, index):
+        return bool(self.blocks[index >> 3] & (1 << (index & 7)))
+
+    @property
+    def complete(self):
+        return self.total is not None and \
+               all(self.done(i) for i in range(self.count))
+
+    @property
+    def received(self):
+        if self.total is None:
+            return 0
+        received = sum(self.block_size for i in range(self.count)
+                       if self.done(i))
+        if self.count and self.done(self.count - 1):
+            received -= self.count * self.block_size - self.total
+        return received + sum(end - index * self.block_size
+                              for index, end in self.partial.items())
+
+    def matches(self, total, headers):
+        """
+        判断响应对应的远端文件是否与日志记录的是同一个版本。
+        :param total: 响应中的文件大小
+        :param headers: 响应头
+        :return:
+        """
+        return self.total == total and \
+               self.etag == headers.get("ETag") and \
+               self.last_modified == headers.get("Last-Modified")
+
+    def reset(self, total, headers):
+        """
+        远端文件变化或者没有日志时，重新开始记录。
+        :param total:
+        :param headers:
+        :return:
+        """
+        self.total = total
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.blocks = bytearray(-(-self.count // 8))
+        self.partial = {}
+
+    def missing(self):
+        """
+        返回所有没有下载的字节范围，结束位置不包含在内，
+        写了一部分的数据块从已写入的位置开始。
+        :return: [(start, end), ...]
+        """
+        if self.total is None:
+            return [(0, None)]
+        ranges = []
+        for i in range(self.count):
+            if self.done(i):
+                continue
+            start = self.partial.get(i, i * self.block_size)
+            end = min((i + 1) * self.block_size, self.total)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def mark(self, start, end):
+        """
+        标记[start, end)范围内完整写入的数据块，并记录最后一个没有写完的块写入到的位置。
+        start需要与数据块对齐，或者是missing返回的写了一部分的块的续传位置。
+        :param start:
+        :param end:
+        :return:
+        """
+        first = start // self.block_size
+        last = self.count if end >= self.total else end // self.block_size
+        for i in range(first, last):
+            self.blocks[i >> 3] |= 1 << (i & 7)
+            self.partial.pop(i, None)
+        if last < self.count and end > last * self.block_size:
+            self.partial[last] = end
+        if time.time() - self.saved_at > self.save_interval:
+            self.save()
+
+    def save(self):
+        """
+        在线程池中保存日志，同时只会有一次保存。
+        :return: 保存任务
+        """
+        if self.saving is None or self.saving.done():
+            self.saved_at = time.time()
+            self.saving = asyncio.get_event_loop().run_in_executor(
+                None, self._save, json.dumps({
+                    "url": self.url,
+                    "etag": self.etag,
+                    "last_modified": self.last_modified,
+                    "total": self.total,
+                    "block_size": self.block_size,
+                    "blocks": base64.b64encode(self.blocks).decode(),
+                    "partial": self.partial}))
+        return self.saving
+
+    def _save(self, meta):
+        with open(self.path + ".tmp", "w") as f:
+            f.write(meta)
+        os.replace(self.path + ".tmp", self.path)
+
+    async def close(self):
+        """
+        等待正在进行的保存完成后，保存最终状态。
+        :return:
+        """
+        if self.saving is not None:
+            await self.saving
+        if self.total is not None:
+            await self.save()
@@ -0,0 +1,229 @@
+# -*- coding:utf-8 -*-
+import json
+import time
+import asyncio
+import aiohttp
+
+from aiohttp import web
+from collections import defaultdict
+
+
+class Metrics(object):
+    """
+    下载统计，以Prometheus文本格式通过本地HTTP接口暴露，或者定时输出JSON快照。
+    """
+    prefix = "downloader_"
+    # 指标名: (类型, 说明)
+    descriptions = {
+        "bytes_total": ("counter", "Bytes downloaded."),
+        "downloads_total": ("counter",
+                            "Download attempts finished, by result: "
+                            "done, retry or failed."),
+        "retries_total": ("counter", "Requests retried after an error."),
+        "proxy_fallbacks_total": ("counter", "Requests sent through proxy."),
+        "proxy_cooldowns_total": ("counter", "Routes taken out of rotation."),
+        "push_backs_total": ("counter", "Tasks pushed back to source."),
+        "dead_letters_total": ("counter", "Tasks abandoned after failures."),
+        "cache_hits_total": ("counter", "Downloads served from cache, by reason."),
+        "connections_reused_total": ("counter", "Requests on reused connections."),
+        "connect_seconds": ("summary", "Time to open a connection."),
+        "ttfb_seconds": ("summary", "Time to first byte of response."),
+        "source_fetch_seconds": ("summary", "Time to fetch a task from source."),
+        "workers_active": ("gauge", "Workers downloading."),
+        "workers_free": ("gauge", "Workers waiting for tasks."),
+        "tasks_queued": ("gauge", "Tasks read ahead and waiting for workers."),
+        "workers_limit": ("gauge", "Current limit of concurrent workers."),
+        "tasks_retrying": ("gauge", "Failed tasks waiting to retry."),
+        "loop_lag_seconds": ("summary", "Delay of event loop in profile mode."),
+        "loop_lag_max_seconds": ("gauge", "Max delay of event loop in last second."),
+        "loop_blocks_total": ("counter", "Times event loop was blocked."),
+    }
+
+    def __init__(self):
+        self.values = defaultdict(float)
+        self.summaries = defaultdict(lambda: [0, 0.0])
+        self.started_at = self.reported_at = time.time()
+        self.reported = {}
+
+    def inc(self, name, value=1, **labels):
+        self.values[name, tuple(sorted(labels.items()))] += value
+
+    def set(self, name, value, **labels):
+        self.values[name, tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        summary = self.summaries[name, tuple(sorted(labels.items()))]
+        summary[0] += 1
+        summary[1] += value
+
+    def total(self, name, **labels):
+        """
+        :return: 指定指标所有包含labels的值之和
+        """
+        labels = set(labels.items())
+        return sum(value for (key, keys), value in self.values.items()
+                   if key == name and labels.issubset(keys))
+
+    def state(self):
+        """
+        :return: 可以在进程间传递的统计数据，用于多进程模式下汇总
+        """
+        return dict(self.values), dict(self.summaries)
+
+    def combine(self, states):
+        """
+        以各进程统计数据之和替换当前的统计数据
+        :param states: state()返回值的列表
+        :return:
+        """
+        self.values.clear()
+        self.summaries.clear()
+        for values, summaries in states:
+            for key, value in values.items():
+                self.values[key] += value
+            for key, (count, total) in summaries.items():
+                summary = self.summaries[key]
+                summary[0] += count
+                summary[1] += total
+
+    def trace_config(self):
+        """
+        统计建立连接和首字节时间的aiohttp.TraceConfig
+        :return:
+        """
+        async def on_request_start(session, ctx, params):
+            ctx.started_at = time.time()
+            ctx.host = params.url.host
+
+        async def on_request_end(session, ctx, params):
+            self.observe("ttfb_seconds", time.time() - ctx.started_at,
+                         host=params.url.host)
+
+        async def on_connection_create_start(session, ctx, params):
+            ctx.connect_started_at = time.time()
+
+        async def on_connection_create_end(session, ctx, params):
+            self.observe("connect_seconds",
+                         time.time() - ctx.connect_started_at, host=ctx.host)
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.inc("connections_reused_total", host=ctx.host)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_connection_create_start.append(
+            on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(
+            f'{k}="{Metrics._escape(v)}"' for k, v in labels)
+
+    @staticmethod
+    def _escape(value):
+        # Prometheus文本格式中标签值的转义
+        return str(value).replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")
+
+    def prometheus(self):
+        """
+        :return: Prometheus文本格式的统计数据
+        """
+        lines = []
+        for name, (kind, description) in self.descriptions.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == "summary":
+                for (key, labels), (count, total) in self.summaries.items():
+                    if key == name:
+                        labels = self._labels(labels)
+                        lines.append(f"{full_name}_count{labels} {count}")
+                        lines.append(f"{full_name}_sum{labels} {total}")
+            else:
+                for (key, labels), value in self.values.items():
+                    if key == name:
+                        lines.append(
+                            f"{full_name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, advance=True):
+        """
+        JSON快照，包括自上次定时快照以来的总体和各host下载速度。
+        :param advance: 是否作为下一次计算速度的起点
+        :return:
+        """
+        now = time.time()
+        elapsed = max(now - self.reported_at, 1e-6)
+        rates = {}
+        for (name, labels), value in self.values.items():
+            if name == "bytes_total":
+                host = dict(labels).get("host", "")
+                rates[host] = rates.get(host, 0) + \
+                    value - self.reported.get((name, labels), 0)
+                if advance:
+                    self.reported[name, labels] = value
+        if advance:
+            self.reported_at = now
+        values = defaultdict(dict)
+        for (name, labels), value in self.values.items():
+            values[name][",".join(f"{k}={v}" for k, v in labels)] = value
+        for (name, labels), (count, total) in self.summaries.items():
+            values[name][",".join(f"{k}={v}" for k, v in labels)] = {
+                "count": count, "avg": total / count}
+        return {
+            "time": now,
+            "uptime": now - self.started_at,
+            "bytes_per_second": sum(rates.values()) / elapsed,
+            "bytes_per_second_by_host": {
+                host: rate / elapsed for host, rate in rates.items()},
+            "metrics": values,
+        }
+
+    async def serve(self, host, port):
+        """
+        启动本地HTTP接口，/metrics返回Prometheus格式，/metrics.json返回JSON快照。
+        :return: web.AppRunner，用于关闭服务
+        """
+        async def prometheus(request):
+            return web.Response(text=self.prometheus())
+
+        async def snapshot(request):
+            return web.json_response(self.snapshot(False))
+
+        app = web.Application()
+        app.router.add_get("/metrics", prometheus)
+        app.router.add_get("/metrics.json", snapshot)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def report(self, interval, write):
+        """
+        定时输出JSON快照
+        :param interval: 间隔秒数
+        :param write: 接收一行JSON文本的函数
+        :return:
+        """
+        while True:
+            await asyncio.sleep(interval)
+            write(json.dumps(self.snapshot()))
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--metrics-port", type=int,
+            help="Serve metrics at http://127.0.0.1:port/metrics. ")
+        parser.add_argument(
+            "--metrics-interval", type=float, default=0,
+            help="Seconds between json snapshots of metrics, 0 to disable. ")
+        parser.add_argument(
+            "--metrics-file", help="File to append json snapshots to, "
+                                   "log them if not specified. ")
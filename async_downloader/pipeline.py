@@ -0,0 +1,288 @@
+# -*- coding:utf-8 -*-
+import os
+import bz2
+import zlib
+import lzma
+import shlex
+import hashlib
+import subprocess
+
+from contextvars import ContextVar
+
+
+# 当前下载任务的处理器链，由DownloadWrapper在每个任务中设置，下载引擎读取
+current_pipeline = ContextVar("pipeline", default=None)
+
+
+class IntegrityError(Exception):
+    """
+    下载的数据与任务中指定的哈希值不一致
+    """
+
+
+class Processor(object):
+    """
+    处理器基类，按顺序接收文件的全部数据，在线程池中调用
+    """
+    def feed(self, data):
+        """
+        :param data: bytes或memoryview
+        :return:
+        """
+        pass
+
+    def reset(self):
+        """
+        远端文件变化，从头开始接收数据
+        :return:
+        """
+        pass
+
+    def finish(self):
+        """
+        数据全部接收完毕，失败时抛出异常
+        :return:
+        """
+        pass
+
+    def abort(self):
+        """
+        下载失败，清理资源
+        :return:
+        """
+        pass
+
+
+class HashProcessor(Processor):
+    """
+    边下载边计算哈希值，指定了期望值时进行校验
+    """
+    def __init__(self, algorithm, expected, filename, logger):
+        self.algorithm = algorithm
+        self.expected = expected and expected.lower()
+        self.filename = filename
+        self.logger = logger
+        self.hash = hashlib.new(algorithm)
+        # 全部数据接收完毕后的哈希值
+        self.digest = None
+
+    def feed(self, data):
+        self.hash.update(data)
+
+    def reset(self):
+        self.hash = hashlib.new(self.algorithm)
+        self.digest = None
+
+    def finish(self):
+        digest = self.hash.hexdigest()
+        if self.expected and digest != self.expected:
+            raise IntegrityError(
+                f"{self.algorithm} of {self.filename} is {digest}, "
+                f"expect {self.expected}. ")
+        self.digest = digest
+        self.logger.info(f"{self.algorithm} of {self.filename}: {digest}. ")
+
+
+class DecompressProcessor(Processor):
+    """
+    边下载边解压，解压后的文件保存在去掉压缩后缀的文件名中
+    """
+    decompressors = {
+        ".gz": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+        ".bz2": bz2.BZ2Decompressor,
+        ".xz": lzma.LZMADecompressor,
+    }
+
+    def __init__(self, filename):
+        self.target, suffix = os.path.splitext(filename)
+        self.factory = self.decompressors[suffix]
+        self.decompressor = None
+        self.file = None
+
+    @classmethod
+    def supports(cls, filename):
+        return os.path.splitext(filename)[1] in cls.decompressors
+
+    def feed(self, data):
+        if self.file is None:
+            self.file = open(self.target, "wb")
+            self.decompressor = self.factory()
+        while data:
+            self.file.write(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            # 多个压缩流拼接在一起的情况
+            data = self.decompressor.unused_data
+            self.decompressor = self.factory()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def reset(self):
+        self.close()
+
+    def finish(self):
+        self.close()
+
+    def abort(self):
+        if self.file is not None:
+            self.close()
+            os.unlink(self.target)
+
+
+class TeeProcessor(Processor):
+    """
+    将数据同时写入外部命令的标准输入，用于转发到对象存储等，
+    命令中可以使用{url}和{filename}，如：aws s3 cp - s3://bucket/{filename}
+    """
+    def __init__(self, command, url, filename):
+        self.command = command.format(
+            url=shlex.quote(url), filename=shlex.quote(filename))
+        self.process = None
+
+    def feed(self, data):
+        if self.process is None:
+            self.process = subprocess.Popen(
+                self.command, shell=True, stdin=subprocess.PIPE)
+        self.process.stdin.write(data)
+
+    def reset(self):
+        self.abort()
+
+    def finish(self):
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        process.stdin.close()
+        code = process.wait()
+        if code:
+            raise RuntimeError(f"Tee command exited with {code}: "
+                               f"{self.command}")
+
+    def abort(self):
+        # 下载不完整，杀掉命令避免输出不完整的数据
+        if self.process is not None:
+            process, self.process = self.process, None
+            process.kill()
+            process.stdin.close()
+            process.wait()
+
+
+class Pipeline(object):
+    """
+    处理器链：文件数据写入磁盘的同时按顺序交给各处理器，避免下载完成后再读一遍文件。
+    断点续传时，从文件中读取已经下载的部分补给处理器，重复的数据会被跳过，
+    因此需要按顺序下载，启用处理器时不再分段并发下载。
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, processors):
+        self.processors = processors
+        # 已经交给处理器的数据的结束位置
+        self.position = 0
+        self.finished = False
+
+    @classmethod
+    def create(cls, downloader, url, filename, hashes):
+        """
+        根据命令行参数和任务中的哈希值创建处理器链
+        :param downloader:
+        :param url:
+        :param filename:
+        :param hashes: {算法: 期望的哈希值}
+        :return: 没有处理器时返回None
+        """
+        algorithms = dict.fromkeys(downloader.hash_algorithms)
+        algorithms.update(
+            (algorithm, expected) for algorithm, expected in hashes.items()
+            if expected)
+        processors = [HashProcessor(algorithm, expected, filename,
+                                    downloader.logger)
+                      for algorithm, expected in algorithms.items()]
+        if downloader.decompress and DecompressProcessor.supports(filename):
+            processors.append(DecompressProcessor(filename))
+        if downloader.tee:
+            processors.append(TeeProcessor(downloader.tee, url, filename))
+        return cls(processors) if processors else None
+
+    def _feed(self, data):
+        for processor in self.processors:
+            processor.feed(data)
+        self.position += len(data)
+
+    def catch_up(self, fd, end):
+        """
+        从文件中读取[position, end)范围内之前已经下载的数据
+        :param fd: 可读的文件描述符
+        :param end:
+        :return:
+        """
+        while self.position < end:
+            data = os.pread(
+                fd, min(self.chunk_size, end - self.position), self.position)
+            if not data:
+                raise RuntimeError(f"File truncated at {self.position}. ")
+            self._feed(data)
+
+    def feed(self, fd, offset, buffers):
+        """
+        写入文件的连续数据
+        :param fd:
+        :param offset: 数据的开始位置
+        :param buffers: memoryview列表
+        :return:
+        """
+        self.catch_up(fd, offset)
+        for buffer in buffers:
+            end = offset + len(buffer)
+            if end > self.position:
+                self._feed(buffer[self.position - offset:])
+            offset = end
+
+    def reset(self):
+        self.position, self.finished = 0, False
+        for processor in self.processors:
+            processor.reset()
+
+    def finish(self, fd, total):
+        """
+        下载完成，补齐剩余的数据后结束各处理器
+        :param fd:
+        :param total: 文件大小
+        :return:
+        """
+        self.catch_up(fd, total)
+        for processor in self.processors:
+            processor.finish()
+        self.finished = True
+
+    def digest(self, algorithm):
+        """
+        :param algorithm:
+        :return: 完成后为计算出的哈希值，完成前为任务中期望的哈希值，都没有时为None
+        """
+        for processor in self.processors:
+            if isinstance(processor, HashProcessor) and \
+                    processor.algorithm == algorithm:
+                return processor.digest or processor.expected
+
+    def abort(self):
+        if not self.finished:
+            for processor in self.processors:
+                processor.abort()
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--hash", nargs="+", default=[], choices=["md5", "sha1", "sha256"],
+            help="Hash files while downloading and log the digests, "
+                 "md5/sha256 fields in task are always verified. ")
+        parser.add_argument(
+            "--decompress", action="store_true",
+            help="Decompress .gz/.bz2/.xz files while downloading, "
+                 "into filename without the suffix. ")
+        parser.add_argument(
+            "--tee", help="Shell command to pipe file content to while "
+                          "downloading, {url} and {filename} are replaced. ")
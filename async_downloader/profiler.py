@@ -0,0 +1,279 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import json
+import time
+import heapq
+import asyncio
+import aiohttp
+import threading
+import traceback
+
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+
+# 当前协程所在的时间线，由Profiler.task在每个下载任务(或并发的分段)中设置
+current_lane = ContextVar("lane", default=None)
+
+
+class Span(object):
+    """
+    记录with块的开始和结束时间
+    """
+    __slots__ = ("profiler", "name", "lane", "args", "started_at")
+
+    def __init__(self, profiler, name, lane, args):
+        self.profiler = profiler
+        self.name = name
+        self.lane = lane
+        self.args = args
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args["error"] = repr(exc_val)
+        self.profiler.add(self.name, self.started_at, time.monotonic(),
+                          self.lane, **self.args)
+
+
+class Profiler(object):
+    """
+    性能分析模式：定时采样事件循环的延迟，后台线程发现事件循环被阻塞超过阈值时记录其调用栈；
+    记录从source取任务、建立连接、首字节、传输、写入、落盘和退回等阶段的耗时，
+    导出为Chrome(chrome://tracing)或Perfetto(ui.perfetto.dev)可以打开的trace文件。
+    """
+    # 时间线，下载任务按需占用LANE_WORKERS之后的时间线，结束后给下一个任务使用
+    LANE_LOOP, LANE_SOURCE, LANE_PUSH_BACK, LANE_WORKERS = 0, 1, 2, 3
+    # 最多记录的事件数，超过后不再记录
+    max_events = 1000000
+
+    def __init__(self, enabled=False, trace_file=None, block_threshold=0.1,
+                 logger=None):
+        """
+        :param enabled: 是否启用，指定了trace_file时总是启用
+        :param trace_file: 导出trace的文件，None表示只监控事件循环
+        :param block_threshold: 事件循环被阻塞多少秒时记录调用栈
+        :param logger:
+        """
+        self.enabled = enabled or bool(trace_file)
+        self.trace_file = trace_file
+        self.block_threshold = block_threshold
+        # 采样间隔，阈值的1/4，但不低于10ms以免采样本身占用事件循环，也不超过阈值
+        self.tick = min(max(block_threshold / 4, 0.01), block_threshold)
+        self.logger = logger
+        self.events = []
+        self.free_lanes = []
+        self.lanes = self.LANE_WORKERS
+        self.pid = os.getpid()
+        # 事件循环最近一次运行心跳的时间，由监视线程读取
+        self.beat = None
+        # (心跳时间, 调用栈)，监视线程发现的最近一次阻塞
+        self.blocked = None
+        self.thread_id = None
+        self.watching = False
+
+    def span(self, name, lane=None, **args):
+        """
+        :param name: 阶段名
+        :param lane: 时间线，None表示当前任务的时间线
+        :param args: 附加信息
+        :return: 记录with块耗时的上下文管理器
+        """
+        if not self.enabled:
+            return nullcontext()
+        return Span(self, name, lane, args)
+
+    def add(self, name, started_at, ended_at, lane=None, **args):
+        """
+        记录一个阶段
+        :param name:
+        :param started_at: time.monotonic()
+        :param ended_at:
+        :param lane: None表示当前任务的时间线，不在任务中时使用source的时间线
+        :param args:
+        :return:
+        """
+        if not self.enabled or len(self.events) >= self.max_events:
+            return
+        if lane is None:
+            lane = current_lane.get()
+            lane = self.LANE_SOURCE if lane is None else lane
+        self.events.append({
+            "name": name, "ph": "X", "pid": self.pid, "tid": lane,
+            "ts": started_at * 1e6, "dur": (ended_at - started_at) * 1e6,
+            "args": args})
+
+    def task(self, name, **args):
+        """
+        为下载任务或者并发的分段分配一条空闲的时间线，记录其整个过程
+        :param name:
+        :param args:
+        :return:
+        """
+        if not self.enabled:
+            return nullcontext()
+        return _Task(self, name, args)
+
+    async def run(self, name, coro, **args):
+        """
+        在单独的时间线中运行coro，用于并发运行的分段
+        :return: coro的返回值
+        """
+        with self.task(name, **args):
+            return await coro
+
+    def acquire(self):
+        if self.free_lanes:
+            return heapq.heappop(self.free_lanes)
+        self.lanes += 1
+        return self.lanes - 1
+
+    def release(self, lane):
+        heapq.heappush(self.free_lanes, lane)
+
+    def trace_config(self):
+        """
+        记录建立连接和首字节时间的aiohttp.TraceConfig
+        :return:
+        """
+        async def on_request_start(session, ctx, params):
+            ctx.request_started_at = time.monotonic()
+
+        async def on_request_end(session, ctx, params):
+            self.add("ttfb", ctx.request_started_at, time.monotonic(),
+                     url=str(params.url), status=params.response.status)
+
+        async def on_connection_create_start(session, ctx, params):
+            ctx.connect_started_at = time.monotonic()
+
+        async def on_connection_create_end(session, ctx, params):
+            self.add("connect", ctx.connect_started_at, time.monotonic())
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_connection_create_start.append(
+            on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def watch(self):
+        """
+        监视线程：心跳超过阈值没有更新时，事件循环正在执行阻塞的回调，记录此时的调用栈
+        :return:
+        """
+        while self.watching:
+            time.sleep(self.tick)
+            beat = self.beat
+            if time.monotonic() - beat < self.block_threshold or \
+                    self.blocked and self.blocked[0] == beat:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.blocked = beat, stack
+            self.logger.warning(
+                f"Event loop blocked for more than {self.block_threshold}s "
+                f"at:\n{stack}")
+
+    async def monitor(self, metrics):
+        """
+        定时采样事件循环的延迟，每秒更新最大延迟
+        :param metrics:
+        :return:
+        """
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.watching = True
+        thread = threading.Thread(target=self.watch, daemon=True)
+        thread.start()
+        lag, reported_at = 0, self.beat
+        try:
+            while True:
+                await asyncio.sleep(self.tick)
+                now = time.monotonic()
+                delay = max(now - self.beat - self.tick, 0)
+                lag = max(lag, delay)
+                metrics.observe("loop_lag_seconds", delay)
+                if self.blocked and self.blocked[0] == self.beat:
+                    metrics.inc("loop_blocks_total")
+                    self.add("blocked", self.beat, now, self.LANE_LOOP,
+                             stack=self.blocked[1])
+                self.beat = now
+                if now - reported_at >= 1:
+                    metrics.set("loop_lag_max_seconds", lag)
+                    self.counter("loop lag(ms)", now, lag * 1000)
+                    lag, reported_at = 0, now
+        finally:
+            self.watching = False
+            thread.join()
+
+    def counter(self, name, ts, value):
+        if len(self.events) < self.max_events:
+            self.events.append({
+                "name": name, "ph": "C", "pid": self.pid,
+                "tid": self.LANE_LOOP, "ts": ts * 1e6,
+                "args": {"value": value}})
+
+    def export(self):
+        """
+        将记录的事件写入trace文件
+        :return:
+        """
+        if not (self.enabled and self.trace_file):
+            return
+        names = {self.LANE_LOOP: "event loop", self.LANE_SOURCE: "source",
+                 self.LANE_PUSH_BACK: "push back"}
+        names.update((lane, f"worker {lane - self.LANE_WORKERS}")
+                     for lane in range(self.LANE_WORKERS, self.lanes))
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid,
+                     "tid": lane, "args": {"name": name}}
+                    for lane, name in names.items()]
+        with open(self.trace_file, "w") as f:
+            json.dump({"traceEvents": metadata + self.events,
+                       "displayTimeUnit": "ms"}, f)
+        self.logger.info(f"Trace with {len(self.events)} events saved to "
+                         f"{self.trace_file}. ")
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--profile", action="store_true",
+            help="Sample event loop lag and log stacks of callbacks "
+                 "blocking the loop. ")
+        parser.add_argument(
+            "--trace",
+            help="File to export phases of tasks to in Chrome trace format, "
+                 "viewable in ui.perfetto.dev, implies --profile. ")
+        parser.add_argument(
+            "--block-threshold", type=float, default=0.1,
+            help="Seconds of blocking to log the stack of event loop at. ")
+
+
+class _Task(object):
+    """
+    下载任务或分段占用的时间线
+    """
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.lane = None
+        self.token = None
+        self.span = None
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.lane = self.profiler.acquire()
+        self.token = current_lane.set(self.lane)
+        self.span = Span(self.profiler, self.name, self.lane, self.args)
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.__exit__(exc_type, exc_val, exc_tb)
+        current_lane.reset(self.token)
+        self.profiler.release(self.lane)
@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+import sys
+import time
+import asyncio
+
+
+MB = 1024 * 1024
+
+
+class Progress(object):
+    """
+    下载进度：下载引擎只更新计数，由定时任务统一输出总体和每个文件的进度，
+    在终端中原地刷新显示，否则按间隔输出一行日志。
+    """
+    def __init__(self, metrics, mode="auto", interval=None, max_files=10,
+                 stream=sys.stderr):
+        """
+        :param metrics: Metrics，用于统计完成和失败的任务数
+        :param mode: tty, log, none，auto表示输出到终端时使用tty，否则使用log
+        :param interval: 输出间隔(秒)，None表示tty为1秒，log为10秒
+        :param max_files: tty模式下最多显示的文件数
+        :param stream: tty模式的输出流
+        """
+        if mode == "auto":
+            mode = "tty" if stream.isatty() else "log"
+        self.mode = mode
+        self.interval = interval or (1 if mode == "tty" else 10)
+        self.metrics = metrics
+        self.max_files = max_files
+        self.stream = stream
+        # filename: [已接收字节数, 总字节数]
+        self.files = {}
+        self.received = 0
+        self.reported = 0
+        self.reported_at = time.time()
+        self.lines = 0
+
+    def start(self, filename, total, received=0):
+        self.files[filename] = [received, total]
+
+    def update(self, filename, length):
+        """
+        下载引擎每收到一个chunk调用一次，只更新计数
+        :param filename:
+        :param length:
+        :return:
+        """
+        self.received += length
+        entry = self.files.get(filename)
+        if entry is not None:
+            entry[0] += length
+
+    def finish(self, filename):
+        self.files.pop(filename, None)
+
+    def summary(self):
+        """
+        :return: 总体进度，包括自上次输出以来的速度
+        """
+        now = time.time()
+        speed = (self.received - self.reported) / max(now - self.reported_at, 1e-6)
+        self.reported, self.reported_at = self.received, now
+        return (f"{int(self.metrics.total('downloads_total', result='done'))} "
+                f"done, "
+                f"{int(self.metrics.total('downloads_total', result='failed'))} "
+                f"failed, {len(self.files)} downloading, "
+                f"{self.received / MB:.1f}MB received, {speed / MB:.2f}MB/s")
+
+    def render(self):
+        """
+        :return: 总体进度和各文件的进度，每行一条
+        """
+        lines = [self.summary()]
+        for filename, (received, total) in list(
+                self.files.items())[:self.max_files]:
+            percent = f"{received / total:7.1%}" if total else "      ?"
+            lines.append(f"{percent} {received / MB:9.1f}/{total / MB:.1f}MB "
+                         f"{filename}")
+        if len(self.files) > self.max_files:
+            lines.append(f"... and {len(self.files) - self.max_files} more")
+        return lines
+
+    def show(self, logger):
+        if self.mode == "tty":
+            lines = self.render()
+            # 光标移回上次输出的开头，清除后重新输出
+            self.stream.write(
+                (f"\x1b[{self.lines}F" if self.lines else "") + "\x1b[J" +
+                "\n".join(lines) + "\n")
+            self.stream.flush()
+            self.lines = len(lines)
+        elif self.mode == "log":
+            logger.info(f"Progress: {self.summary()}. ")
+
+    async def report(self, logger):
+        """
+        定时输出进度
+        :param logger:
+        :return:
+        """
+        if self.mode == "none":
+            return
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.show(logger)
+        finally:
+            # 结束时输出最终的进度
+            self.show(logger)
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--progress", default="auto",
+            choices=["auto", "tty", "log", "none"],
+            help="Show progress in place on terminal(tty) or as log lines, "
+                 "auto for tty if stderr is a terminal. ")
+        parser.add_argument(
+            "--progress-interval", type=float,
+            help="Seconds between progress updates, "
+                 "default: 1 for tty, 10 for log. ")
@@ -0,0 +1,211 @@
+# -*- coding:utf-8 -*-
+import time
+import random
+import aiohttp
+
+from .retry import StatusError
+
+
+MB = 1024 * 1024
+
+
+class RouteStats(object):
+    """
+    一个线路(直连或代理)访问一个host的统计，使用指数加权移动平均
+    """
+    alpha = 0.3
+
+    def __init__(self):
+        self.success = 1.0
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.inflight = 0
+        self.cooling_until = 0
+
+    def _average(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    def score(self):
+        """
+        成功率除以下载1MB的预计耗时，再按正在进行的请求数分摊，
+        没有统计数据的线路预计耗时很小，会被优先尝试
+        """
+        cost = (self.latency or 0) + \
+            (MB / self.throughput if self.throughput else 0)
+        return self.success / max(cost, 0.01) / (1 + self.inflight)
+
+
+class Route(object):
+    """
+    一次请求使用的线路，请求结束后向代理池报告结果
+    """
+    def __init__(self, pool, proxy, host):
+        self.pool = pool
+        self.proxy = proxy
+        self.host = host
+        self.stats = pool.stats_of(proxy, host)
+        self.stats.inflight += 1
+        self.started_at = self.responded_at = time.monotonic()
+        self.closed = False
+
+    @property
+    def kwargs(self):
+        """
+        :return: 传给aiohttp请求的代理参数
+        """
+        # url中已经包含认证信息的代理不能再指定proxy_auth
+        return {"proxy": self.proxy,
+                "proxy_auth": self.pool.auth if self.proxy and
+                "@" not in self.proxy else None}
+
+    def responded(self):
+        """
+        收到响应头时调用，统计延迟
+        """
+        self.responded_at = time.monotonic()
+        self.stats.latency = self.stats._average(
+            self.stats.latency, self.responded_at - self.started_at)
+
+    def done(self, received=0):
+        """
+        请求成功结束
+        :param received: 接收的字节数
+        """
+        if self.close():
+            return
+        stats = self.stats
+        stats.success = stats._average(stats.success, 1)
+        stats.failures = 0
+        elapsed = time.monotonic() - self.responded_at
+        # 数据太少时速度不准确
+        if received >= 64 * 1024 and elapsed > 0:
+            stats.throughput = stats._average(
+                stats.throughput, received / elapsed)
+
+    def fail(self, exc=None):
+        """
+        请求失败，源站明确返回的客户端错误不是线路的问题
+        :param exc:
+        """
+        if self.close():
+            return
+        if isinstance(exc, StatusError) and exc.status < 500 and \
+                exc.status not in (403, 407, 429):
+            return
+        self.pool.failed(self)
+
+    def close(self):
+        """
+        :return: 是否已经关闭过
+        """
+        if self.closed:
+            return True
+        self.closed = True
+        self.stats.inflight -= 1
+        return False
+
+
+class ProxyPool(object):
+    """
+    代理池：为每个线路和host的组合统计成功率、延迟和速度，
+    按得分加权随机选择线路以分摊负载，连续失败的线路冷却一段时间后再使用。
+    """
+    def __init__(self, proxies=(), auth=None, direct="first", cooldown=60,
+                 max_failures=3, metrics=None):
+        """
+        :param proxies: 代理列表
+        :param auth: aiohttp.BasicAuth，用于没有在url中指定认证信息的代理
+        :param direct: first: 第一次请求直连，失败后使用代理，
+        pool: 直连作为池中的一个线路，never: 只使用代理
+        :param cooldown: 冷却时间(秒)
+        :param max_failures: 连续失败多少次后冷却
+        :param metrics: Metrics
+        """
+        self.proxies = list(dict.fromkeys(proxies))
+        self.auth = auth
+        self.direct = direct if self.proxies else "pool"
+        self.cooldown = cooldown
+        self.max_failures = max_failures
+        self.metrics = metrics
+        # (线路, host): RouteStats，线路None表示直连
+        self.stats = {}
+
+    def stats_of(self, proxy, host):
+        key = proxy, host
+        if key not in self.stats:
+            self.stats[key] = RouteStats()
+        return self.stats[key]
+
+    def candidates(self, tries):
+        if self.direct == "first":
+            return [None] if not tries else self.proxies
+        if self.direct == "never":
+            return self.proxies
+        return [None] + self.proxies
+
+    def choose(self, host, tries=0, exclude=()):
+        """
+        :param host:
+        :param tries: 这是第几次尝试
+        :param exclude: 本次任务中已经失败过的线路，还有其它线路时不再使用
+        :return: Route
+        """
+        routes = self.candidates(tries)
+        routes = [route for route in routes if route not in exclude] or routes
+        now = time.monotonic()
+        healthy = [route for route in routes
+                   if self.stats_of(route, host).cooling_until <= now]
+        if healthy:
+            proxy, = random.choices(healthy, [
+                self.stats_of(route, host).score() for route in healthy])
+        else:
+            # 都在冷却中时，使用最先结束冷却的线路
+            proxy = min(routes, key=lambda route: self.stats_of(
+                route, host).cooling_until)
+        if proxy and self.metrics:
+            self.metrics.inc("proxy_fallbacks_total")
+        return Route(self, proxy, host)
+
+    def failed(self, route):
+        stats = route.stats
+        stats.success = stats._average(stats.success, 0)
+        stats.failures += 1
+        if stats.failures >= self.max_failures:
+            stats.failures = 0
+            stats.cooling_until = time.monotonic() + self.cooldown
+            if self.metrics:
+                self.metrics.inc("proxy_cooldowns_total",
+                                 proxy=route.proxy or "direct")
+
+    @classmethod
+    def load(cls, proxies, proxies_file=None, auth=None, **kwargs):
+        """
+        :param proxies: 命令行指定的代理
+        :param proxies_file: 每行一个代理的文件，#开头的行会被忽略
+        :param auth: (user, password)
+        :return:
+        """
+        proxies = [proxy for proxy in proxies if proxy]
+        if proxies_file:
+            with open(proxies_file) as f:
+                proxies.extend(line.strip() for line in f if
+                               line.strip() and not line.startswith("#"))
+        return cls(proxies, auth and aiohttp.BasicAuth(*auth), **kwargs)
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--proxies-file", help="File of proxies, one per line. ")
+        parser.add_argument(
+            "--direct", default="first", choices=["first", "pool", "never"],
+            help="first: connect directly first and fall back to proxies, "
+                 "pool: connect directly as one route of the pool, "
+                 "never: always use proxies. ")
+        parser.add_argument(
+            "--proxy-cooldown", type=float, default=60,
+            help="Seconds to take a route out of rotation after "
+                 "continuous failures. ")
+        parser.add_argument(
+            "--proxy-max-failures", type=int, default=3,
+            help="Continuous failures to cool a route down. ")
@@ -0,0 +1,170 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import asyncio
+import aiohttp
+
+from functools import partial
+
+from .utils import parse_host_rate
+
+
+class TokenBucket(object):
+    """
+    令牌桶，允许透支：消费后令牌为负时，等待补足透支的部分，
+    这样按chunk消费也能保证长期的速率，并发的消费者按顺序排队。
+    """
+    def __init__(self, rate=0):
+        """
+        :param rate: 每秒产生的令牌数，0表示不限制
+        """
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.rate = rate
+        self.tokens = self.burst
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        # 最多积攒一秒的令牌
+        self._rate = self.burst = rate
+        self.tokens = min(self.tokens, self.burst)
+
+    async def consume(self, amount):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class RateLimiter(object):
+    """
+    全局和每个host的带宽限制，以及每个host的请求频率限制，可以在运行时调整。
+    """
+    def __init__(self, rate=0, host_rate=0, request_rate=0, host_rates=None,
+                 shares=1):
+        """
+        :param rate: 全局带宽(字节/秒)，0表示不限制
+        :param host_rate: 每个host默认的带宽(字节/秒)，0表示不限制
+        :param request_rate: 每个host每秒的请求数，0表示不限制
+        :param host_rates: 指定host的带宽，{host: rate}
+        :param shares: 分片运行时的分片数，每个分片只使用各项限制的1/shares
+        """
+        self.shares = shares
+        self.total = TokenBucket(rate / shares)
+        self.host_rate = host_rate
+        self.request_rate = request_rate
+        self.host_rates = dict(host_rates or {})
+        self.hosts = {}
+        self.requests = {}
+        # 监视限制文件时，限制随时可能出现
+        self.watching = False
+
+    def _bucket(self, buckets, host, rate):
+        if host not in buckets:
+            buckets[host] = TokenBucket(rate / self.shares)
+        return buckets[host]
+
+    def throttle_for(self, host):
+        """
+        返回限制指定host带宽的函数，没有任何带宽限制时返回None，避免无谓的开销。
+        :param host:
+        :return: 接收字节数的异步函数
+        """
+        if self.watching or \
+                self.total.rate or self.host_rate or self.host_rates:
+            return partial(self.throttle, host)
+
+    async def throttle(self, host, amount):
+        await self.total.consume(amount)
+        await self._bucket(
+            self.hosts, host, self.host_rates.get(host, self.host_rate)
+        ).consume(amount)
+
+    def trace_config(self):
+        """
+        在发出请求前限制请求频率的aiohttp.TraceConfig
+        :return:
+        """
+        async def on_request_start(session, ctx, params):
+            if self.request_rate:
+                await self._bucket(
+                    self.requests, params.url.host, self.request_rate
+                ).consume(1)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        return trace_config
+
+    def update(self, rate=None, host_rate=None, request_rate=None,
+               host_rates=None):
+        """
+        运行时调整限制，没有指定的项保持不变。
+        :return:
+        """
+        if rate is not None:
+            self.total.rate = rate / self.shares
+        if host_rate is not None:
+            self.host_rate = host_rate
+        if host_rates is not None:
+            self.host_rates = dict(host_rates)
+        if host_rate is not None or host_rates is not None:
+            for host, bucket in self.hosts.items():
+                bucket.rate = self.host_rates.get(
+                    host, self.host_rate) / self.shares
+        if request_rate is not None:
+            self.request_rate = request_rate
+            for bucket in self.requests.values():
+                bucket.rate = request_rate / self.shares
+
+    async def watch(self, path, logger, interval=1):
+        """
+        监视json格式的限制文件，文件修改后调整限制，如：
+        {"rate": 10485760, "host_rate": 0, "request_rate": 10,
+         "host_rates": {"example.com": 1048576}}
+        :param path:
+        :param logger:
+        :param interval: 检查间隔(秒)
+        :return:
+        """
+        modified_at, self.watching = None, True
+        while True:
+            try:
+                mtime = os.stat(path).st_mtime
+                if mtime != modified_at:
+                    modified_at = mtime
+                    with open(path) as f:
+                        limits = json.load(f)
+                    self.update(**limits)
+                    logger.info(f"Rate limits updated: {limits}. ")
+            except (OSError, ValueError, TypeError) as e:
+                logger.error(f"Failed to load rate limits: {e}")
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--rate", type=int, default=0,
+            help="Max bytes per second in total, 0 for unlimited. ")
+        parser.add_argument(
+            "--host-rate", type=int, default=0,
+            help="Max bytes per second per host, 0 for unlimited. ")
+        parser.add_argument(
+            "--host-rates", action="append", default=[],
+            type=parse_host_rate,
+            help="Max bytes per second of specified host: host=rate. ")
+        parser.add_argument(
+            "--request-rate", type=float, default=0,
+            help="Max requests per second per host, 0 for unlimited. ")
+        parser.add_argument(
+            "--limits-file", help="Json file of rate limits, "
+                                  "reloaded when modified. ")
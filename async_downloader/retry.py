@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+import json
+import time
+import heapq
+import random
+import asyncio
+import aiohttp
+
+
+class StatusError(RuntimeError):
+    """
+    响应状态码表示请求失败
+    """
+    def __init__(self, status, message):
+        super(StatusError, self).__init__(message)
+        self.status = status
+
+
+def classify(exc):
+    """
+    按重试策略对异常分类
+    :param exc:
+    :return: 错误类型
+    """
+    if isinstance(exc, StatusError):
+        if exc.status in (404, 410):
+            return "not_found"
+        if exc.status in (408, 429) or exc.status >= 500:
+            return "server"
+        if exc.status >= 400:
+            return "client"
+        return "other"
+    # asyncio.TimeoutError在新版本python中是OSError的子类，需要先判断
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, (aiohttp.ClientError, OSError)):
+        return "connection"
+    return "other"
+
+
+class RetryScheduler(object):
+    """
+    失败任务的延迟重试队列：按到期时间排序的堆，延迟按失败次数指数增长并加入随机抖动，
+    不同的错误类型使用不同的策略，超过重试次数的任务写入死信文件。
+    """
+    failed_times_max = 3
+    # 错误类型: (最多失败次数，None表示使用failed_times_max, 延迟倍数)
+    policies = {
+        # 资源不存在，可能是还没有同步到源站，隔较长时间再试一次
+        "not_found": (1, 10),
+        # 其它客户端错误，重试也不会成功
+        "client": (0, 0),
+        "server": (None, 1),
+        "timeout": (None, 2),
+        "connection": (None, 1),
+        "other": (None, 1),
+        # 下载方法已经放弃的任务
+        "abandoned": (0, 0),
+    }
+
+    def __init__(self, delay=5, max_delay=600, dead_letter=None):
+        """
+        :param delay: 第一次重试的基础延迟(秒)
+        :param max_delay: 最大延迟(秒)
+        :param dead_letter: 死信文件，None表示只记录日志
+        """
+        self.delay = delay
+        self.max_delay = max_delay
+        self.dead_letter = dead_letter
+        self.heap = []
+        self.count = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def backoff(self, failed_times, factor):
+        """
+        :return: 第failed_times次失败后的延迟(秒)
+        """
+        delay = min(self.max_delay,
+                    self.delay * factor * 2 ** max(failed_times - 1, 0))
+        return random.uniform(delay / 2, delay)
+
+    def schedule(self, task, logger, raw=None):
+        """
+        :param task: 下载失败后的Task，包括failed_times和error
+        :param logger:
+        :param raw: source返回的原始数据，重试结束后才向source确认
+        :return: 是否会重试
+        """
+        error = task.error or "other"
+        max_times, factor = self.policies.get(error, self.policies["other"])
+        if max_times is None:
+            max_times = self.failed_times_max
+        failed_times = task.failed_times or 1
+        if failed_times > max_times:
+            self.abandon(task, logger)
+            return False
+        delay = self.backoff(failed_times, factor)
+        logger.info(f"Retry {task.filename} in {round(delay, 2)}s "
+                    f"after {error} error. ")
+        # count保证到期时间相同时按加入顺序出堆
+        self.count += 1
+        heapq.heappush(
+            self.heap, (time.time() + delay, self.count, task, raw))
+        return True
+
+    def abandon(self, task, logger):
+        rs = json.dumps(task.to_dict())
+        logger.error(f"Abandon {rs}. ")
+        if self.dead_letter:
+            with open(self.dead_letter, "a") as f:
+                f.write(rs + "\n")
+
+    def due(self):
+        """
+        :return: 到期的任务，[(原始数据, Task), ...]
+        """
+        now, tasks = time.time(), []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, task, raw = heapq.heappop(self.heap)
+            tasks.append((raw, task))
+        return tasks
+
+    def wait(self):
+        """
+        :return: 距离下一个任务到期的秒数，没有任务时返回None
+        """
+        if self.heap:
+            return max(self.heap[0][0] - time.time(), 0)
+
+    def clear(self):
+        """
+        清空所有等待重试的任务
+        :return: [(原始数据, Task), ...]
+        """
+        tasks = [(raw, task) for _, _, task, raw in sorted(
+            self.heap, key=lambda item: item[:2])]
+        self.heap.clear()
+        return tasks
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--retry-delay", type=float, default=5,
+            help="Seconds to wait before the first retry of a failed task, "
+                 "doubled on every failure. ")
+        parser.add_argument(
+            "--retry-max-delay", type=float, default=600,
+            help="Max seconds to wait before retrying a failed task. ")
+        parser.add_argument(
+            "--dead-letter",
+            help="File to append abandoned tasks to, log them if not specified. ")
@@ -0,0 +1,66 @@
+# -*- coding:utf-8 -*-
+import aiohttp
+
+
+class SessionPool(object):
+    """
+    所有下载引擎共享的长连接会话层，按host复用TCP/TLS连接，并缓存DNS解析结果。
+    """
+    def __init__(self, limit=0, limit_per_host=0, dns_cache_ttl=300,
+                 keepalive_timeout=30, conn_timeout=10, read_timeout=1800,
+                 trace_configs=None):
+        """
+        :param limit: 总连接数上限，0表示不限制
+        :param limit_per_host: 每个host的连接数上限，0表示不限制
+        :param dns_cache_ttl: DNS缓存时间(秒)，None表示永久缓存
+        :param keepalive_timeout: 空闲连接保活时间(秒)
+        :param conn_timeout: 建立连接超时时间(秒)
+        :param read_timeout: 两次读取之间的超时时间(秒)
+        :param trace_configs: aiohttp.TraceConfig列表，用于统计
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, connect=conn_timeout, sock_read=read_timeout)
+        self.trace_configs = trace_configs
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        第一次使用时才创建，保证session在事件循环中创建。
+        :return: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout,
+                trace_configs=self.trace_configs)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--conn-limit", type=int, default=0,
+            help="Max connections in total, 0 for unlimited. ")
+        parser.add_argument(
+            "--conn-limit-per-host", type=int, default=0,
+            help="Max connections per host, 0 for unlimited. ")
+        parser.add_argument(
+            "--dns-cache-ttl", type=int, default=300,
+            help="Seconds to cache dns lookups. ")
+        parser.add_argument(
+            "--keepalive-timeout", type=float, default=30,
+            help="Seconds to keep idle connections alive. ")
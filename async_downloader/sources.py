@@ -1,10 +1,19 @@
 # -*- coding:utf-8 -*-
+import os
 import json
+import time
+import uuid
+import asyncio
 import aiofiles
 import warnings
 
+from aiohttp import web
+from collections import deque
 
-__all__ = ["FileSource", "RedisSource", "CmdlineSource"]
+from .task import JsonCodec
+
+
+__all__ = ["FileSource", "RedisSource", "CmdlineSource", "DaemonSource"]
 
 
 class Source(object):
@@ -34,11 +43,17 @@ class Source(object):
 
     async def __anext__(self):
         """
-        返回'{"url": "", "filename": ""}'
+        返回编码后的任务'{"url": "", "filename": ""}'，
+        或者已经解析的(原始数据, {"url": "", "filename": ""})，原始数据用于确认和退回
         :return:
         """
         return NotImplemented
 
+    # 为True时表示__anext__在没有任务时会自己阻塞等待，调度器无需再休息
+    blocking = False
+    # 任务的编解码，由--codec指定
+    codec = JsonCodec()
+
     async def push_back(self, data):
         """
         下载失败后的回收下载任务的机制
@@ -47,6 +62,34 @@ class Source(object):
         """
         pass
 
+    async def ack(self, data):
+        """
+        任务处理完毕(成功、退回或放弃)后的确认机制
+        :param data: __anext__返回的原始数据
+        :return:
+        """
+        pass
+
+    def shard(self, index, count):
+        """
+        多进程或者多机分片运行时，只读取第index份任务(共count份)，
+        多个消费者共享的队列(如redis)不需要实现
+        :param index: 从0开始
+        :param count:
+        :return:
+        """
+        pass
+
+    async def notify(self, data, event, result=None):
+        """
+        每次下载结束后的通知
+        :param data: 解析后的任务，Task
+        :param event: done: 成功，retry: 失败后等待重试，failed: 失败后放弃
+        :param result: 失败后的Task
+        :return:
+        """
+        pass
+
     @staticmethod
     def enrich_parser(sub_parser):
         """
@@ -57,65 +100,534 @@ class Source(object):
         pass
 
 
+# 脚本中使用redis服务器的时间计算租约期限，避免各节点时钟不一致
+_NOW = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+"""
+
+# 取出一批任务，同时登记到processing有序集合中，分数为租约到期时间，
+# 租约以任务的编码为键，队列中相同的任务共用一个租约，需要重复下载的任务应带上不同的id
+_CLAIM = _NOW + """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for _, item in ipairs(items) do
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), item)
+    end
+end
+return items
+"""
+
+# 优先级模式下队列是有序集合，分数为任务的priority，先取分数最高的任务
+_CLAIM_PRIORITY = _NOW + """
+local items = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+-- unpack的参数个数有限制，分批删除
+for i = 1, #items, 1000 do
+    redis.call('ZREM', KEYS[1], unpack(items, i, math.min(i + 999, #items)))
+end
+for _, item in ipairs(items) do
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), item)
+end
+return items
+"""
+
+# 为本节点持有的任务续约
+_RENEW = _NOW + """
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[1]), ARGV[i])
+end
+"""
+
+# 将租约过期(所属节点已经挂掉)的任务退回队列
+_REAP = _NOW + """
+local items = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, item in ipairs(items) do
+    redis.call('ZREM', KEYS[2], item)
+    redis.call('RPUSH', KEYS[1], item)
+end
+return #items
+"""
+
+# 优先级模式下，过期的任务按其priority字段退回有序集合
+_REAP_PRIORITY = _NOW + """
+local items = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, item in ipairs(items) do
+    local ok, task = pcall(cjson.decode, item)
+    if not ok then
+        ok, task = pcall(cmsgpack.unpack, item)
+    end
+    redis.call('ZREM', KEYS[2], item)
+    redis.call('ZADD', KEYS[1],
+               type(task) == 'table' and tonumber(task['priority'] or 0) or 0,
+               item)
+end
+return #items
+"""
+
+
 class RedisSource(Source):
     """
     redis source
     """
+    # 队列为空时BLPOP阻塞等待的秒数
+    block_timeout = 1
 
-    def __init__(self, redis_host, redis_port, redis_key, **kwargs):
+    def __init__(self, redis_host, redis_port, redis_key,
+                 redis_batch_size=100, lease_timeout=0, idle=False,
+                 redis_priority=False, **kwargs):
         try:
-            from custom_redis.client import Redis
+            from redis.asyncio import Redis
         except ImportError:
-            try:
-                from redis import Redis
-            except ImportError:
-                warnings.warn(
-                    "RedisSource depends on redis, try: pip install redis. ")
-                exit(1)
+            warnings.warn(
+                "RedisSource depends on redis>=4.2, try: pip install -U redis. ")
+            exit(1)
         self.redis_key = redis_key
-        self.redis_conn = Redis(redis_host, redis_port)
+        self.redis_conn = Redis(host=redis_host, port=redis_port)
+        self.batch_size = redis_batch_size
+        # 空闲模式下由BLPOP阻塞等待任务，调度器不需要再休息
+        self.blocking = idle
+        self.tasks = deque()
+        self.pushed = []
+        self.acked = []
+        self.pushing = None
+        # 租约模式：取出的任务登记在processing中，完成后确认，
+        # 节点挂掉后租约过期的任务由其它节点退回队列
+        self.lease_timeout = lease_timeout
+        self.processing_key = f"{redis_key}:processing"
+        self.leases = set()
+        self.keeper = None
+        # 优先级模式：队列是以任务priority为分数的有序集合
+        self.priority = redis_priority
+        if lease_timeout:
+            self.claim = self.redis_conn.register_script(
+                _CLAIM_PRIORITY if redis_priority else _CLAIM)
+            self.renew = self.redis_conn.register_script(_RENEW)
+            self.reap = self.redis_conn.register_script(
+                _REAP_PRIORITY if redis_priority else _REAP)
+
+    async def __aenter__(self):
+        if self.lease_timeout:
+            self.keeper = asyncio.ensure_future(self.keep_leases())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.flush()
+        # 已经取出但还没有开始下载的任务退回队列头部
+        tasks, self.tasks = list(self.tasks), deque()
+        if tasks:
+            async with self.redis_conn.pipeline(transaction=True) as pipe:
+                self.put(pipe, tasks, True)
+                if self.lease_timeout:
+                    pipe.zrem(self.processing_key, *tasks)
+                await pipe.execute()
+            self.leases.difference_update(tasks)
+        if self.keeper is not None:
+            self.keeper.cancel()
+        # redis<5.0.1没有aclose
+        close = getattr(self.redis_conn, "aclose", None) or \
+            self.redis_conn.close
+        await close()
 
     async def __anext__(self):
         """
         异步迭代器需要实现这个方法，这是一个异步方法，最终返回一个迭代值。
         :return:
         """
-        return self.redis_conn.lpop(self.redis_key)
+        if not self.tasks:
+            await self.fetch()
+        return self.tasks.popleft() if self.tasks else None
+
+    async def fetch(self):
+        """
+        使用事务一次取出一批任务，队列为空时在空闲模式下阻塞等待。
+        :return:
+        """
+        if self.lease_timeout:
+            tasks = await self.claim(
+                keys=[self.redis_key, self.processing_key],
+                args=[self.batch_size, self.lease_timeout])
+            if len(set(tasks)) < len(tasks) or not self.leases.isdisjoint(tasks):
+                warnings.warn("Identical tasks share one lease, "
+                              "add unique ids to tasks to download twice. ")
+            self.leases.update(tasks)
+            # BLPOP无法同时登记租约，只能等待一段时间后再取
+            if not tasks and self.blocking:
+                await asyncio.sleep(self.block_timeout)
+        elif self.priority:
+            tasks = [task for task, _ in await self.redis_conn.zpopmax(
+                self.redis_key, self.batch_size)]
+            if not tasks and self.blocking:
+                rs = await self.redis_conn.bzpopmax(
+                    [self.redis_key], timeout=self.block_timeout)
+                tasks = rs and [rs[1]] or []
+        else:
+            async with self.redis_conn.pipeline(transaction=True) as pipe:
+                pipe.lrange(self.redis_key, 0, self.batch_size - 1)
+                pipe.ltrim(self.redis_key, self.batch_size, -1)
+                tasks, _ = await pipe.execute()
+            if not tasks and self.blocking:
+                rs = await self.redis_conn.blpop(
+                    [self.redis_key], timeout=self.block_timeout)
+                tasks = rs and [rs[1]] or []
+        self.tasks.extend(tasks)
+
+    async def keep_leases(self):
+        """
+        心跳：定时为本节点持有的任务续约，并回收其它节点过期的任务。
+        :return:
+        """
+        while True:
+            await asyncio.sleep(self.lease_timeout / 3)
+            try:
+                if self.leases:
+                    await self.renew(keys=[self.processing_key],
+                                     args=[self.lease_timeout, *self.leases])
+                await self.reap(keys=[self.redis_key, self.processing_key],
+                                args=[self.batch_size])
+            except Exception as e:
+                warnings.warn(f"Failed to keep leases: {e}")
 
     async def push_back(self, data):
-        self.redis_conn.rpush(self.redis_key, data)
+        """
+        失败的任务先缓存起来，由后台任务批量退回redis。
+        :param data:
+        :return:
+        """
+        self.pushed.append(data)
+        self.schedule()
+
+    async def ack(self, data):
+        """
+        确认任务已处理完毕，从processing中移除。
+        :param data:
+        :return:
+        """
+        if self.lease_timeout:
+            self.leases.discard(data)
+            self.acked.append(data)
+            self.schedule()
+
+    def schedule(self):
+        if self.pushing is None or self.pushing.done():
+            self.pushing = asyncio.ensure_future(self._push())
+            self.pushing.add_done_callback(self.pushed_done)
+
+    @staticmethod
+    def pushed_done(future):
+        # 失败的任务已经放回，下次提交或者关闭时再试
+        if not future.cancelled() and future.exception() is not None:
+            warnings.warn(f"Failed to push back tasks: {future.exception()}")
+
+    async def _push(self):
+        # 退回的任务与确认在一个事务中提交，避免节点挂掉时任务丢失或重复
+        while self.pushed or self.acked:
+            pushed, self.pushed = self.pushed, []
+            acked, self.acked = self.acked, []
+            try:
+                async with self.redis_conn.pipeline(transaction=True) as pipe:
+                    pushed and self.put(pipe, pushed)
+                    acked and pipe.zrem(self.processing_key, *acked)
+                    await pipe.execute()
+            except BaseException:
+                # 提交失败时放回，不丢失任务
+                self.pushed[:0] = pushed
+                self.acked[:0] = acked
+                raise
+
+    def put(self, pipe, tasks, head=False):
+        """
+        在事务中将任务放回队列
+        :param pipe:
+        :param tasks:
+        :param head: 是否放回队列头部，优先级模式下按任务的priority排序
+        :return:
+        """
+        if self.priority:
+            pipe.zadd(self.redis_key,
+                      {task: self.priority_of(task) for task in tasks})
+        elif head:
+            pipe.lpush(self.redis_key, *reversed(tasks))
+        else:
+            pipe.rpush(self.redis_key, *tasks)
+
+    def priority_of(self, data):
+        """
+        :param data: 编码后的任务
+        :return: 任务的优先级
+        """
+        try:
+            return float(self.codec.loads(data).get("priority") or 0)
+        except (ValueError, TypeError, AttributeError):
+            return 0
+
+    async def flush(self):
+        """
+        等待后台提交结束后提交剩下的任务，失败时抛出异常
+        :return:
+        """
+        if self.pushing is not None:
+            await asyncio.wait([self.pushing])
+        await self._push()
 
     @staticmethod
     def enrich_parser(sub_parser):
         sub_parser.add_argument("-rh", "--redis-host", default="0.0.0.0")
         sub_parser.add_argument("-rp", "--redis-port", default=6379)
         sub_parser.add_argument("-rk", "--redis-key", default="download_meta")
+        sub_parser.add_argument(
+            "-rbs", "--redis-batch-size", type=int, default=100,
+            help="Count of tasks to fetch from redis at once. ")
+        sub_parser.add_argument(
+            "--lease-timeout", type=float, default=0,
+            help="Seconds of lease on claimed tasks, expired tasks will "
+                 "be returned to the queue. 0 to disable. "
+                 "Leases are keyed by encoded tasks, so tasks must be unique. ")
+        sub_parser.add_argument(
+            "--redis-priority", action="store_true",
+            help="Redis key is a sorted set scored by task priority, "
+                 "tasks with higher score are fetched first. ")
         sub_parser.add_argument("--idle", action="store_true", help="Idle... ")
 
 
+class Lane(object):
+    """
+    FileSource中一个任务文件的读取状态
+    """
+    def __init__(self, path, priority, file, offset, end):
+        """
+        :param path:
+        :param priority: 没有priority字段的任务使用的优先级
+        :param file: 二进制模式打开的文件
+        :param offset: buffer在文件中的开始位置
+        :param end: 开始位置小于end的行属于本分片
+        """
+        self.path = path
+        self.priority = priority
+        self.file = file
+        self.offset = offset
+        self.end = end
+        # 读到的不完整的行
+        self.buffer = b""
+        # 已经读出还没有完成的任务，行开始位置: None，按位置顺序插入
+        self.pending = {}
+        # 退回的任务，下次运行时需要重新读取
+        self.pushed = set()
+
+    @property
+    def checkpoint(self):
+        """
+        :return: 此位置之前的任务都已经完成
+        """
+        return next(iter(self.pending), self.offset)
+
+    async def read(self, size):
+        """
+        读取一块数据，返回其中完整的行
+        :param size:
+        :return: [(行开始位置, 行), ...]，读完时返回None
+        """
+        if self.file is None:
+            return
+        block = await self.file.read(size)
+        if block:
+            lines = (self.buffer + block).split(b"\n")
+            self.buffer = lines.pop()
+        else:
+            # 读完时最后一行可能没有换行符
+            lines, self.buffer = [self.buffer] if self.buffer else [], b""
+        offset, rs = self.offset, []
+        for line in lines:
+            if offset >= self.end:
+                block = None
+                break
+            if line.strip():
+                rs.append((offset, line))
+            offset += len(line) + 1
+        self.offset = offset
+        if not block:
+            await self.close()
+        return rs if rs or block else None
+
+    async def close(self):
+        if self.file is not None:
+            await self.file.close()
+            self.file = None
+
+
 class FileSource(Source):
     """
     file source
     """
+    # 每次读取的字节数，读到的行批量解析，减少在线程池中读文件和解析json的次数
+    block_size = 1024 * 1024
+    # 保存检查点的间隔(秒)
+    checkpoint_interval = 1
 
-    def __init__(self, path, **kwargs):
-        self.path = path
+    def __init__(self, path=None, lanes=None, checkpoint=None, **kwargs):
+        """
+        :param path: 任务文件
+        :param lanes: 优先级通道，[(path, priority), ...]，
+        优先读取优先级高的文件，没有priority字段的任务使用所在通道的优先级
+        :param checkpoint: 保存各文件中已完成位置的文件，重新运行时跳过已经完成的任务
+        """
+        lanes = [(int(priority), lane) for lane, priority in lanes or []]
+        if path:
+            lanes.append((0, path))
+        if not lanes:
+            raise ValueError("--path or --lane is required. ")
+        self.lanes = sorted(lanes, key=lambda lane: -lane[0])
+        self.index, self.count = 0, 1
+        self.checkpoint = checkpoint
+        self.saved_at = 0
+        self.files = []
+        # 正在读取的通道
+        self.current = 0
+        # 已经解析还没有返回的任务
+        self.tasks = deque()
+
+    def shard(self, index, count):
+        """
+        每个文件按字节平分成count份，开始位置在第index份中的行属于本分片
+        """
+        self.index, self.count = index, count
+        if self.checkpoint and count > 1:
+            # 各分片的检查点分开保存
+            self.checkpoint = f"{self.checkpoint}.{index}-{count}"
+
+    def load(self):
+        """
+        :return: 检查点中各文件已经完成的位置
+        """
+        try:
+            with open(self.checkpoint) as f:
+                return json.load(f)
+        except (TypeError, FileNotFoundError):
+            return {}
+
+    def save(self, offsets):
+        """
+        先写入临时文件再替换，保证检查点文件总是完整的
+        :param offsets:
+        :return:
+        """
+        temp = self.checkpoint + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(offsets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.checkpoint)
+
+    async def persist(self, force=False):
+        now = time.time()
+        if not self.checkpoint or \
+                not force and now - self.saved_at < self.checkpoint_interval:
+            return
+        self.saved_at = now
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.save, {lane.path: lane.checkpoint for lane in self.files})
 
     async def __aenter__(self):
-        self.file = await aiofiles.open(self.path)
+        offsets = self.load()
+        for priority, path in self.lanes:
+            file = await aiofiles.open(path, "rb")
+            size = os.path.getsize(path)
+            start = size * self.index // self.count
+            # 最后一份读到文件结尾，包括运行中追加的任务
+            end = size * (self.index + 1) // self.count \
+                if self.index + 1 < self.count else float("inf")
+            if start:
+                # 跳过开始于上一份中的行
+                await file.seek(start - 1)
+                start += len(await file.readline()) - 1
+            if offsets.get(path, 0) > start:
+                start = offsets[path]
+                await file.seek(start)
+            self.files.append(Lane(path, priority, file, start, end))
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.file.close()
+        for lane in self.files:
+            await lane.close()
+        await self.persist(True)
+
+    async def read(self):
+        """
+        按优先级从高到低的顺序，从各通道中读取一批任务
+        :return:
+        """
+        while self.current < len(self.files):
+            lane = self.files[self.current]
+            lines = await lane.read(self.block_size)
+            if lines is None:
+                # 当前通道读完了，读取下一个通道
+                self.current += 1
+                continue
+            if not lines:
+                continue
+            try:
+                tasks = self.codec.loads_json(b"[" + b",".join(
+                    line for _, line in lines) + b"]")
+            except ValueError:
+                tasks = None
+            # 一行中有多个对象(如{...},{...})时批量解析也会成功，但任务与行对应不上
+            if tasks is None or len(tasks) != len(lines):
+                tasks = [self.loads_line(lane, offset, line)
+                         for offset, line in lines]
+            for (offset, _), data in zip(lines, tasks):
+                if lane.priority:
+                    data.setdefault("priority", lane.priority)
+                lane.pending[offset] = None
+                self.tasks.append(((self.current, offset), data))
+            return
+
+    def loads_line(self, lane, offset, line):
+        """
+        逐行解析，出错时报告所在的文件和位置
+        :return: 任务
+        """
+        try:
+            return self.codec.loads_json(line)
+        except ValueError as e:
+            raise ValueError(
+                f"Invalid task at {offset} of {lane.path}: {e}. ") from e
 
     async def __anext__(self):
-        return await self.file.readline()
+        """
+        :return: ((通道, 行开始位置), 任务)
+        """
+        if not self.tasks:
+            await self.read()
+        return self.tasks.popleft() if self.tasks else ""
+
+    async def push_back(self, data):
+        lane, offset = data
+        self.files[lane].pushed.add(offset)
+
+    async def ack(self, data):
+        lane, offset = data
+        lane = self.files[lane]
+        if offset not in lane.pushed:
+            lane.pending.pop(offset, None)
+        await self.persist()
 
     @staticmethod
     def enrich_parser(sub_parser):
         sub_parser.add_argument(
-            "--path", required=True, help="Path of file which store "
-                                          "download meta in json lines. ")
+            "--path", help="Path of file which store download meta "
+                           "in json lines. ")
+        sub_parser.add_argument(
+            "--lane", nargs=2, action="append", dest="lanes",
+            metavar=("PATH", "PRIORITY"),
+            help="Path of file which store download meta of the priority, "
+                 "files of higher priority are read first. ")
+        sub_parser.add_argument(
+            "--checkpoint",
+            help="File to save offsets of finished tasks to, "
+                 "tasks before the offsets are skipped on restart. ")
 
 
 class CmdlineSource(Source):
@@ -127,13 +639,190 @@ class CmdlineSource(Source):
         self.url = url
         self.fired = False
 
+    def shard(self, index, count):
+        # 只有一个任务，由第一个分片下载
+        self.fired = index > 0
+
     async def __anext__(self):
         if not self.fired:
             self.fired = True
-            return json.dumps({"url": self.url, "filename": self.filename})
+            task = {"url": self.url, "filename": self.filename}
+            return task, task
 
     @staticmethod
     def enrich_parser(sub_parser):
         sub_parser.add_argument(
             "--filename", required=True, help="Filename to save file. ")
         sub_parser.add_argument("--url", required=True, help="Download url. ")
+
+
+class IterableSource(Source):
+    """
+    以编程方式使用时的source，从可迭代对象或异步可迭代对象中读取任务(dict或json字符串)，
+    调度器需要时才取下一个任务，因此异步生产者会被下载速度限流
+    """
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.iterator = None
+        # 异步可迭代对象可能要等待生产者
+        self.blocking = hasattr(iterable, "__aiter__")
+
+    async def __aenter__(self):
+        self.iterator = self.iterable.__aiter__() if self.blocking \
+            else iter(self.iterable)
+        return self
+
+    async def __anext__(self):
+        if self.iterator is None:
+            return
+        try:
+            if self.blocking:
+                task = await self.iterator.__anext__()
+            else:
+                task = next(self.iterator)
+        except (StopIteration, StopAsyncIteration):
+            self.iterator = None
+            return
+        # 已经解析的任务不需要再编码，原始数据只用于确认
+        return task if isinstance(task, (str, bytes)) else (task, task)
+
+
+class DaemonSource(Source):
+    """
+    daemon source: 常驻进程，通过unix socket或本地http端口接收任务
+    """
+    # 没有任务时等待的秒数
+    block_timeout = 1
+    blocking = True
+
+    def __init__(self, socket=None, port=None, **kwargs):
+        """
+        :param socket: unix socket路径
+        :param port: 本地http端口，没有指定socket时使用
+        """
+        self.socket = socket
+        self.port = port
+        self.queue = None
+        self.runner = None
+        self.closing = False
+        # 任务id: 提交该任务的客户端的事件队列
+        self.clients = {}
+
+    async def __aenter__(self):
+        self.queue = asyncio.Queue()
+        app = web.Application()
+        app.router.add_post("/tasks", self.submit)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        if self.socket:
+            site = web.UnixSite(self.runner, self.socket)
+        else:
+            site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+        await site.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.closing = True
+        # 还没有开始的任务不会再执行，通知客户端已取消
+        while not self.queue.empty():
+            raw, _ = self.queue.get_nowait()
+            await self.notify(raw, "cancelled")
+        # 结束还在等待的事件流，否则关闭时要等到超时
+        for events in set(self.clients.values()):
+            events.put_nowait(None)
+        await self.runner.cleanup()
+        if self.socket and os.path.exists(self.socket):
+            os.unlink(self.socket)
+
+    async def __anext__(self):
+        try:
+            return await asyncio.wait_for(
+                self.queue.get(), self.block_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def submit(self, request):
+        """
+        POST /tasks，请求体为一个任务或任务列表，
+        默认以json lines的格式持续返回每个任务的事件，直到全部任务结束或者daemon关闭，
+        ?wait=0时只返回任务id。
+        :param request:
+        :return:
+        """
+        if self.closing:
+            raise web.HTTPServiceUnavailable(text="Daemon is stopping. ")
+        try:
+            tasks = await request.json()
+            if isinstance(tasks, dict):
+                tasks = [tasks]
+            for task in tasks:
+                task["url"], task["filename"]
+        except (ValueError, TypeError, KeyError):
+            raise web.HTTPBadRequest(
+                text="Tasks with url and filename expected. ")
+        wait = request.query.get("wait") != "0"
+        events = asyncio.Queue()
+        ids = []
+        for task in tasks:
+            task["id"] = str(task.get("id") or uuid.uuid4().hex)
+            ids.append(task["id"])
+            if wait:
+                self.clients[task["id"]] = events
+            self.queue.put_nowait((task, task))
+        if not wait:
+            return web.json_response({"ids": ids})
+        resp = web.StreamResponse(
+            headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        pending = set(ids)
+        try:
+            while pending:
+                event = await events.get()
+                # 关闭时结束事件流
+                if event is None:
+                    break
+                await resp.write((json.dumps(event) + "\n").encode())
+                if event["event"] != "retry":
+                    pending.discard(event["id"])
+            await resp.write_eof()
+        except ConnectionResetError:
+            # 客户端已断开(aiohttp.ClientConnectionResetError也是其子类)，
+            # 不再推送事件
+            pass
+        finally:
+            # 客户端断开后任务依然会继续执行，只是不再通知
+            for id in ids:
+                self.clients.pop(id, None)
+        return resp
+
+    async def notify(self, data, event, result=None):
+        events = self.clients.get(data.get("id"))
+        if events is not None:
+            event = {"id": data["id"], "url": data["url"],
+                     "filename": data["filename"], "event": event}
+            if result:
+                event["error"] = result.error
+                event["failed_times"] = result.failed_times
+            events.put_nowait(event)
+
+    def shard(self, index, count):
+        raise ValueError("Daemon source can not be sharded, "
+                         "use more workers instead. ")
+
+    async def push_back(self, data):
+        """
+        关闭时退回的任务无法保存，通知客户端任务已取消
+        :param data:
+        :return:
+        """
+        await self.notify(data, "cancelled")
+
+    @staticmethod
+    def enrich_parser(sub_parser):
+        sub_parser.add_argument(
+            "--socket", help="Path of unix socket to listen on. ")
+        sub_parser.add_argument(
+            "--port", type=int, default=8700,
+            help="Port of 127.0.0.1 to listen on if socket not specified. ")
+        # 常驻进程，没有任务时继续等待
+        sub_parser.set_defaults(idle=True)
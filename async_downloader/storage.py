@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+import os
+import asyncio
+
+from .utils import open_file, preallocate
+
+
+class Storage(object):
+    """
+    下载文件的存储：数据写入同一目录下的临时文件<filename>.part，第一次写入时按文件大小预分配空间，
+    下载完成后按fsync策略落盘，再原子地重命名为filename，读取方不会看到写了一半的文件。
+    失败时保留临时文件用于断点续传，已经存在的filename在新文件完成前不受影响。
+    """
+    suffix = ".part"
+
+    def __init__(self, fsync="none", fsync_every=64):
+        """
+        :param fsync: none: 不主动落盘，commit: 重命名前落盘，every: 另外每写入fsync_every MB落盘一次
+        :param fsync_every: every策略下落盘的间隔(MB)
+        """
+        self.fsync = fsync
+        self.sync_every = fsync_every * 1024 * 1024 if fsync == "every" else 0
+
+    @classmethod
+    def temp(cls, filename):
+        return filename + cls.suffix
+
+    def open(self, filename, offset=0, total=None):
+        """
+        打开临时文件用于写入
+        :param filename:
+        :param offset: 开始写入的位置，0表示从头写入
+        :param total: 文件大小，从头写入时预分配
+        :return: 文件描述符
+        """
+        fd = open_file(self.temp(filename), offset)
+        if not offset and total:
+            preallocate(fd, total)
+        return fd
+
+    def _commit(self, fd, filename):
+        if self.fsync != "none":
+            os.fsync(fd)
+        os.replace(self.temp(filename), filename)
+        if self.fsync != "none":
+            # 重命名也要落盘
+            dir_fd = os.open(os.path.dirname(filename) or ".", os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    async def commit(self, fd, filename):
+        """
+        下载完成，在线程池中落盘并将临时文件重命名为filename
+        :param fd: 临时文件的文件描述符
+        :param filename:
+        :return:
+        """
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._commit, fd, filename)
+
+    def discard(self, filename):
+        """
+        删除无法用于断点续传的临时文件
+        :param filename:
+        :return:
+        """
+        try:
+            os.unlink(self.temp(filename))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument(
+            "--fsync", default="none", choices=["none", "commit", "every"],
+            help="When to sync files to disk: none, commit: before renaming "
+                 "finished files into place, every: also every "
+                 "--fsync-every MB. ")
+        parser.add_argument(
+            "--fsync-every", type=int, default=64,
+            help="MB written between syncs in every mode. ")
@@ -0,0 +1,139 @@
+# -*- coding:utf-8 -*-
+import sys
+import signal
+import asyncio
+import multiprocessing
+
+from .utils import find_source, new_event_loop
+
+
+def work(argv, conn):
+    """
+    多进程模式下worker进程的入口
+    :param argv: 带有--shard的命令行参数
+    :param conn: 向主进程发送统计数据的管道
+    :return:
+    """
+    # Ctrl-C会发给整个进程组，由主进程统一通知各进程关闭
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.argv = argv
+    from . import downloader as module
+    vars(module).update(find_source() or {})
+    downloader = module.AsyncDownloader()
+    # 统计接口、快照和进度由主进程汇总后输出
+    downloader.metrics_port = None
+    downloader.metrics_interval = 0
+    downloader.progress.mode = "none"
+    downloader.conn = conn
+    downloader.start()
+
+
+class Supervisor(object):
+    """
+    多进程模式：启动多个worker进程，每个进程有自己的事件循环，读取source中的一份任务，
+    主进程汇总各进程的统计和进度，关闭时通知各进程在正在下载的任务结束后退出。
+    """
+    # worker进程发送统计数据的间隔(秒)
+    interval = 1
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.logger = downloader.logger
+        self.metrics = downloader.metrics
+        self.progress = downloader.progress
+        self.processes = []
+        self.conns = []
+        # 各进程最近一次发送的统计数据
+        self.states = {}
+
+    @staticmethod
+    async def report(downloader, conn):
+        """
+        worker进程定时向主进程发送统计数据
+        :param downloader:
+        :param conn:
+        :return:
+        """
+        def send():
+            conn.send((downloader.metrics.state(), downloader.progress.files,
+                       downloader.progress.received))
+        try:
+            while True:
+                send()
+                await asyncio.sleep(Supervisor.interval)
+        finally:
+            send()
+
+    def spawn(self):
+        count = self.downloader.processes
+        # 本身也是一个分片时，再平分为count份
+        index, total = self.downloader.shard or (0, 1)
+        # 避免fork带走主进程中的线程和事件循环
+        context = multiprocessing.get_context("spawn")
+        for i in range(count):
+            reader, writer = context.Pipe(duplex=False)
+            argv = sys.argv + ["--processes", "1", "--shard",
+                               f"{index * count + i}/{total * count}"]
+            process = context.Process(target=work, args=(argv, writer))
+            process.start()
+            # 关闭主进程中的写端，worker进程退出后才能读到EOF
+            writer.close()
+            self.processes.append(process)
+            self.conns.append(reader)
+        self.logger.info(f"Started {count} processes. ")
+
+    def collect(self):
+        """
+        读取各进程发送的统计数据并汇总
+        :return:
+        """
+        for index, conn in enumerate(self.conns):
+            try:
+                while conn is not None and conn.poll():
+                    self.states[index] = conn.recv()
+            except EOFError:
+                self.conns[index] = None
+        self.metrics.combine(state for state, _, _ in self.states.values())
+        self.progress.files = {
+            filename: entry for _, files, _ in self.states.values()
+            for filename, entry in files.items()}
+        self.progress.received = sum(
+            received for _, _, received in self.states.values())
+
+    def stop(self):
+        self.logger.info("Wait to close...")
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    async def process(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        self.spawn()
+        # 限速文件、自适应并发和性能分析由各进程自己处理
+        self.downloader.limits_file = None
+        self.downloader.adaptive = False
+        self.downloader.profiler.enabled = False
+        services = await self.downloader.start_services()
+        while any(process.is_alive() for process in self.processes):
+            self.collect()
+            await asyncio.sleep(0.2)
+        self.collect()
+        await self.downloader.stop_services(*services)
+        for index, process in enumerate(self.processes):
+            if process.exitcode:
+                self.logger.error(
+                    f"Process {index} exited with {process.exitcode}. ")
+        self.logger.info("Process stopped. ")
+
+    def start(self):
+        # 提前检查source能否分片，避免每个worker进程都报错
+        self.downloader.source.shard(0, self.downloader.processes)
+        loop = new_event_loop()
+        try:
+            loop.run_until_complete(self.process())
+        finally:
+            loop.close()
+            self.downloader.log_listener and \
+                self.downloader.log_listener.stop()
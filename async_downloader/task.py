@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+import json
+import warnings
+
+
+class Task(object):
+    """
+    下载任务，source中的任务解析后在调度、下载、重试中一直使用同一种对象，
+    url, filename, failed_times, priority以外的字段保存在meta中
+    """
+    __slots__ = ("url", "filename", "failed_times", "priority", "error", "meta")
+    fields = ("url", "filename", "failed_times", "priority", "error")
+
+    def __init__(self, url, filename, failed_times=0, priority=None,
+                 error=None, meta=None):
+        """
+        :param url:
+        :param filename:
+        :param failed_times: 已经失败的次数
+        :param priority: 越大越优先
+        :param error: 最近一次失败的错误类型，见retry.classify
+        :param meta: 其它字段，如md5, sha256, id，没有时为None
+        """
+        self.url = url
+        self.filename = filename
+        self.failed_times = failed_times
+        self.priority = priority
+        self.error = error
+        self.meta = meta
+
+    @classmethod
+    def from_dict(cls, data):
+        meta = {k: v for k, v in data.items() if k not in cls.fields}
+        return cls(data["url"], data["filename"], data.get("failed_times", 0),
+                   data.get("priority"), data.get("error"), meta or None)
+
+    def to_dict(self):
+        data = {"url": self.url, "filename": self.filename}
+        if self.failed_times:
+            data["failed_times"] = self.failed_times
+        if self.priority is not None:
+            data["priority"] = self.priority
+        if self.error:
+            data["error"] = self.error
+        if self.meta:
+            data.update(self.meta)
+        return data
+
+    def get(self, key, default=None):
+        """
+        兼容按dict使用任务的代码
+        """
+        if key in self.fields:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.meta.get(key, default) if self.meta else default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def failed(self, rs):
+        """
+        :param rs: 下载方法失败时返回的dict，或者json(自定义的下载方法)
+        :return: 失败后的任务
+        """
+        if not isinstance(rs, dict):
+            rs = json.loads(rs)
+        return Task(rs.get("url", self.url), rs.get("filename", self.filename),
+                    rs.get("failed_times", self.failed_times + 1),
+                    self.priority, rs.get("error", "other"), self.meta)
+
+    def __repr__(self):
+        return f"<Task {self.filename} of {self.url}>"
+
+
+class JsonCodec(object):
+    """
+    任务的编解码，各source和push_back使用
+    """
+    name = "json"
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    # 解析json格式的数据，如文件source中的任务
+    loads_json = staticmethod(json.loads)
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            warnings.warn("orjson codec depends on orjson, "
+                          "try: pip install orjson. ")
+            exit(1)
+        self.dumps = orjson.dumps
+        self.loads = self.loads_json = orjson.loads
+
+
+class MsgpackCodec(JsonCodec):
+    name = "msgpack"
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            warnings.warn("msgpack codec depends on msgpack, "
+                          "try: pip install msgpack. ")
+            exit(1)
+        self.packb = msgpack.packb
+        self.unpackb = msgpack.unpackb
+        try:
+            import orjson
+            self.loads_json = orjson.loads
+        except ImportError:
+            pass
+
+    def dumps(self, data):
+        return self.packb(data)
+
+    def loads(self, data):
+        # 兼容json格式的任务，msgpack编码的任务不会以{开头
+        if isinstance(data, str) or data[:1] == b"{":
+            return self.loads_json(data)
+        return self.unpackb(data)
+
+
+codecs = {codec.name: codec for codec in (JsonCodec, OrjsonCodec, MsgpackCodec)}
+
+
+def get_codec(name="json"):
+    """
+    :param name: json, orjson, msgpack
+    :return:
+    """
+    return codecs[name]()
@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+"""
+下载性能压测：启动本地注入故障的文件服务，使用不同的source、下载方式和worker数
+运行下载器，统计files/s、MB/s、CPU时间和内存峰值。
+每次运行都在独立的子进程中进行，以便准确统计CPU时间和内存峰值。
+    python -m async_downloader.test.benchmark --files 200 --size 65536 \\
+        --workers 1 8 32 --latency 0.05 --disconnect 0.05
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import subprocess
+
+from argparse import ArgumentParser
+
+from .server import FaultServer, content
+
+
+ENGINES = {
+    "engine": None,
+    "download": "async_downloader.download_engines.download",
+    "co_session_download":
+        "async_downloader.download_engines.co_session_download",
+}
+
+
+class Benchmark(object):
+    """
+    压测工具
+    """
+    def __init__(self, server, base_dir):
+        self.server = server
+        self.base_dir = base_dir
+        self.url = None
+        self.loop = asyncio.new_event_loop()
+
+    def __enter__(self):
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.url = self.loop.run_until_complete(self.server.start())
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        asyncio.run_coroutine_threadsafe(
+            self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def prepare(self, source, files, size, out_dir):
+        """
+        生成下载任务
+        :return: 下载器命令行中source相关的参数
+        """
+        if source == "cmdline":
+            return ["cmdline", "--url", f"{self.url}/{size}",
+                    "--filename", os.path.join(out_dir, "0")]
+        path = os.path.join(self.base_dir, "manifest.jsonl")
+        with open(path, "w") as f:
+            for i in range(files):
+                f.write(json.dumps({
+                    "url": f"{self.url}/{size}?n={i}",
+                    "filename": os.path.join(out_dir, str(i))}) + "\n")
+        return ["file", "--path", path]
+
+    def run(self, source, engine, workers, files, size, extra=()):
+        """
+        在子进程中运行一次下载
+        :return: 统计结果
+        """
+        out_dir = tempfile.mkdtemp(dir=self.base_dir)
+        files = 1 if source == "cmdline" else files
+        args = self.prepare(source, files, size, out_dir)
+        args += ["--workers", str(workers), "--proxy", ""]
+        if ENGINES[engine]:
+            args += ["--download", ENGINES[engine]]
+        args += list(extra)
+        started_at = time.time()
+        process = subprocess.Popen(
+            [sys.executable, "-c", "from async_downloader import main; main()"]
+            + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # 子进程结束后直接取得它的资源使用情况
+        _, _, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - started_at
+        completed = self.verify(out_dir, files, size)
+        shutil.rmtree(out_dir)
+        return {
+            "source": source,
+            "engine": engine,
+            "workers": workers,
+            "files": completed,
+            "failed": files - completed,
+            "seconds": elapsed,
+            "files/s": completed / elapsed,
+            "MB/s": completed * size / elapsed / 1024 / 1024,
+            "cpu": usage.ru_utime + usage.ru_stime,
+            # Linux下ru_maxrss的单位是KB
+            "rss(MB)": usage.ru_maxrss / 1024,
+        }
+
+    @staticmethod
+    def verify(out_dir, files, size):
+        """
+        :return: 内容正确的文件数
+        """
+        expected = content(0, size)
+        completed = 0
+        for i in range(files):
+            try:
+                with open(os.path.join(out_dir, str(i)), "rb") as f:
+                    completed += f.read() == expected
+            except OSError:
+                pass
+        return completed
+
+
+# 列名: 宽度
+COLUMNS = {"source": 9, "engine": 21, "workers": 9, "files": 7, "failed": 8,
+           "seconds": 9, "files/s": 9, "MB/s": 9, "cpu": 7, "rss(MB)": 9}
+
+
+def format_row(row):
+    return "".join(
+        (f"{row[k]:.2f}" if isinstance(row[k], float) else str(row[k])).rjust(
+            width) for k, width in COLUMNS.items())
+
+
+def main():
+    parser = ArgumentParser(description="Downloader benchmark. ")
+    parser.add_argument("--files", type=int, default=200,
+                        help="Count of files for file source. ")
+    parser.add_argument("--size", type=int, default=65536,
+                        help="Size of each file in bytes for file source. ")
+    parser.add_argument("--large-size", type=int, default=64 * 1024 * 1024,
+                        help="Size of the file in bytes for cmdline source. ")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--sources", nargs="+", default=["file", "cmdline"],
+                        choices=["file", "cmdline"])
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES),
+                        choices=list(ENGINES))
+    parser.add_argument("--extra", default="",
+                        help="Extra arguments for downloader, "
+                             "like: '--segments 4'. ")
+    parser.add_argument("--json", help="File to save results in json. ")
+    FaultServer.enrich_parser(parser)
+    args = parser.parse_args()
+
+    server = FaultServer(
+        args.latency, args.bandwidth, args.disconnect, args.error,
+        args.truncate, int(args.ranges))
+    base_dir = tempfile.mkdtemp(prefix="benchmark-")
+    results = []
+    print(format_row({k: k for k in COLUMNS}))
+    try:
+        with Benchmark(server, base_dir) as benchmark:
+            for source in args.sources:
+                for engine in args.engines:
+                    for workers in args.workers:
+                        result = benchmark.run(
+                            source, engine, workers, args.files,
+                            args.large_size if source == "cmdline"
+                            else args.size, args.extra.split())
+                        results.append(result)
+                        print(format_row(result))
+    finally:
+        shutil.rmtree(base_dir)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+"""
+用于压测的本地HTTP服务，/{size}返回size字节的确定内容，支持Range/Content-Range，
+并可以注入延迟、带宽限制、传输中断开连接和5xx错误，也可以模拟不支持Range的服务器。
+故障参数可以在启动时指定默认值，也可以通过url参数针对单个文件指定，如：
+/1048576?latency=0.1&bandwidth=1048576&disconnect=0.2&error=0.1&truncate=1000&ranges=0
+"""
+import re
+import random
+import asyncio
+
+from aiohttp import web
+from argparse import ArgumentParser
+
+
+PATTERN = bytes(range(256)) * 256
+
+
+def content(start, end):
+    """
+    返回[start, end)范围内的确定内容，第i个字节为i % 256。
+    :param start:
+    :param end:
+    :return:
+    """
+    offset = start % len(PATTERN)
+    return (PATTERN[offset:] + PATTERN * (-(-(end - start) // len(PATTERN))))[
+           :end - start]
+
+
+class FaultServer(object):
+    """
+    注入故障的文件服务
+    """
+    chunk_size = 65536
+
+    def __init__(self, latency=0, bandwidth=0, disconnect=0, error=0,
+                 truncate=-1, ranges=1):
+        """
+        :param latency: 返回响应头之前的延迟(秒)
+        :param bandwidth: 每个连接的带宽(字节/秒)，0表示不限制
+        :param disconnect: 传输到一半断开连接的概率
+        :param error: 返回503的概率
+        :param truncate: 每个响应最多发送多少字节后断开连接，-1表示不限制
+        :param ranges: 为0时忽略Range请求头，总是返回整个文件
+        """
+        self.defaults = {"latency": latency, "bandwidth": bandwidth,
+                         "disconnect": disconnect, "error": error,
+                         "truncate": truncate, "ranges": ranges}
+        self.runner = None
+
+    def option(self, request, name):
+        return float(request.query.get(name, self.defaults[name]))
+
+    async def handle(self, request):
+        size = int(request.match_info["size"])
+        await asyncio.sleep(self.option(request, "latency"))
+        if random.random() < self.option(request, "error"):
+            raise web.HTTPServiceUnavailable()
+        start, end, status = 0, size, 200
+        headers = {"ETag": f'"{size}"'}
+        ranges = self.option(request, "ranges")
+        if ranges:
+            headers["Accept-Ranges"] = "bytes"
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            raise web.HTTPNotModified(headers=headers)
+        mth = ranges and re.match(
+            r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if mth:
+            start = int(mth.group(1))
+            end = min(int(mth.group(2)) + 1 if mth.group(2) else size, size)
+            if start >= size:
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["Content-Length"] = str(end - start)
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        bandwidth = self.option(request, "bandwidth")
+        # 断开连接的位置
+        cut = end
+        if random.random() < self.option(request, "disconnect"):
+            cut = random.randint(start, end - 1)
+        truncate = int(self.option(request, "truncate"))
+        if 0 <= truncate < end - start:
+            cut = min(cut, start + truncate)
+        try:
+            while start < end:
+                stop = min(start + self.chunk_size, end)
+                if start <= cut < stop:
+                    await resp.write(content(start, cut))
+                    request.transport.close()
+                    return resp
+                await resp.write(content(start, stop))
+                if bandwidth:
+                    await asyncio.sleep((stop - start) / bandwidth)
+                start = stop
+            await resp.write_eof()
+        except ConnectionError:
+            # 客户端只读取部分内容(比如分段下载)时会主动断开连接
+            pass
+        return resp
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        :return: 服务的根url
+        """
+        app = web.Application()
+        app.router.add_get("/{size:\\d+}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    @staticmethod
+    def enrich_parser(parser):
+        parser.add_argument("--latency", type=float, default=0,
+                            help="Seconds to wait before response. ")
+        parser.add_argument("--bandwidth", type=float, default=0,
+                            help="Bytes per second per connection. ")
+        parser.add_argument("--disconnect", type=float, default=0,
+                            help="Probability to disconnect midway. ")
+        parser.add_argument("--error", type=float, default=0,
+                            help="Probability to respond 503. ")
+        parser.add_argument("--truncate", type=int, default=-1,
+                            help="Bytes to send before disconnecting, "
+                                 "-1 for unlimited. ")
+        parser.add_argument("--no-ranges", action="store_false", dest="ranges",
+                            help="Ignore Range header and respond whole file. ")
+
+
+def main():
+    parser = ArgumentParser(description="Fault injecting file server. ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    FaultServer.enrich_parser(parser)
+    args = parser.parse_args()
+    server = FaultServer(args.latency, args.bandwidth,
+                         args.disconnect, args.error, args.truncate,
+                         int(args.ranges))
+    loop = asyncio.get_event_loop()
+    print(f"Serving at {loop.run_until_complete(server.start(args.host, args.port))}")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.run_until_complete(server.stop())
+
+
+if __name__ == "__main__":
+    main()
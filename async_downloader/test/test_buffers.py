@@ -0,0 +1,111 @@
+# -*- coding:utf-8 -*-
+import os
+import asyncio
+
+import pytest
+
+from async_downloader import buffers
+from async_downloader.buffers import BufferPool, FileWriter
+
+
+class Stream(object):
+    """
+    按固定大小返回数据的aiohttp.StreamReader
+    """
+    def __init__(self, data, chunk_size=7, stall=False):
+        """
+        :param stall: 数据读完后是否一直等待
+        """
+        self.data = data
+        self.chunk_size = chunk_size
+        self.stall = stall
+
+    def exception(self):
+        return None
+
+    async def read(self, n):
+        if not self.data and self.stall:
+            await asyncio.Event().wait()
+        await asyncio.sleep(0)
+        block = self.data[:min(n, self.chunk_size)]
+        self.data = self.data[len(block):]
+        return block
+
+
+async def copy(writer, stream):
+    async with writer:
+        while await writer.read(stream):
+            pass
+
+
+def test_pool_limits_buffers():
+    async def run():
+        pool = BufferPool(4, 2)
+        first, second = await pool.acquire(), await pool.acquire()
+        waiting = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        pool.release(first)
+        return await waiting is first, pool.created, len(second)
+
+    assert asyncio.run(run()) == (True, 2, 4)
+
+
+def test_pwritev_partial_writes(tmp_path, monkeypatch):
+    pwritev = os.pwritev
+    # 每次最多写入3个字节
+    monkeypatch.setattr(buffers.os, "pwritev", lambda fd, bufs, offset: pwritev(
+        fd, [bytes(b"".join(bufs))[:3]], offset))
+    fd = os.open(tmp_path / "file", os.O_RDWR | os.O_CREAT)
+    try:
+        buffers._pwritev(fd, [memoryview(b"abcd"), memoryview(b"efg")], 2)
+    finally:
+        os.close(fd)
+    assert (tmp_path / "file").read_bytes() == b"\0\0abcdefg"
+
+
+def test_writer(tmp_path):
+    data = bytes(range(256)) * 4
+    written = []
+    fd = os.open(tmp_path / "file", os.O_RDWR | os.O_CREAT)
+    pool = BufferPool(100, 2)
+    try:
+        asyncio.run(copy(
+            FileWriter(fd, 10, pool, lambda offset, length:
+                       written.append((offset, length))), Stream(data)))
+    finally:
+        os.close(fd)
+    assert (tmp_path / "file").read_bytes() == b"\0" * 10 + data
+    assert sum(length for _, length in written) == len(data)
+    assert written[0][0] == 10
+    assert pool.free.qsize() == pool.created
+
+
+def test_write_errors_release_buffers(tmp_path):
+    """
+    写入失败时马上归还积压的缓冲区，共用缓冲区池的其它下载不会一直等待
+    """
+    failing = os.open(tmp_path / "failing", os.O_RDONLY | os.O_CREAT)
+    fd = os.open(tmp_path / "file", os.O_RDWR | os.O_CREAT)
+    pool = BufferPool(10, 2)
+
+    async def run():
+        # 写入失败后连接卡住，不会再提交缓冲区
+        stalled = asyncio.ensure_future(copy(
+            FileWriter(failing, 0, pool), Stream(b"x" * 20, stall=True)))
+        await asyncio.sleep(0.1)
+        try:
+            await asyncio.wait_for(copy(
+                FileWriter(fd, 0, pool), Stream(b"y" * 50)), 5)
+        finally:
+            stalled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await stalled
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(failing)
+        os.close(fd)
+    assert (tmp_path / "file").read_bytes() == b"y" * 50
+    assert pool.free.qsize() == pool.created
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import asyncio
+
+from async_downloader import cache
+from async_downloader.cache import Cache, Entry, link
+
+
+def entry(tmp_path, name, size=10, **kwargs):
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return Entry(f"http://a/{name}", f'"{name}"', None, size,
+                 path=str(path), **kwargs)
+
+
+def test_entry(tmp_path):
+    item = entry(tmp_path, "a")
+    assert item.conditions() == {"If-None-Match": '"a"'}
+    assert item.valid()
+    item.mtime = os.stat(item.path).st_mtime - 1
+    assert not item.valid()
+    os.unlink(item.path)
+    item.mtime = None
+    assert not item.valid()
+
+
+def test_link(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.write_bytes(b"data")
+    link(str(src), str(tmp_path / "sub" / "dst"))
+    assert os.path.samefile(src, tmp_path / "sub" / "dst")
+    # 已经是同一个文件时不做任何事
+    link(str(src), str(tmp_path / "sub" / "dst"))
+    assert not os.path.exists(tmp_path / "sub" / "dst.tmp")
+
+    def fail(src, dst):
+        raise OSError("Cross-device link. ")
+
+    monkeypatch.setattr(cache.os, "link", fail)
+    link(str(src), str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == b"data"
+    assert not os.path.samefile(src, tmp_path / "copy")
+
+
+def test_lookup(tmp_path):
+    async def run():
+        db = Cache(str(tmp_path / "cache.db"))
+        item = entry(tmp_path, "a", md5="abc")
+        await db.put(item)
+        by_url = await db.lookup(item.url, {})
+        by_hash = await db.lookup("http://b/other", {"md5": "ABC"})
+        missing = await db.lookup("http://b/other", {"md5": "def"})
+        # 文件在本地被修改后记录失效
+        with open(item.path, "ab") as f:
+            f.write(b"y")
+        modified = await db.lookup(item.url, {})
+        await db.close()
+        return by_url, by_hash, missing, modified
+
+    by_url, by_hash, missing, modified = asyncio.run(run())
+    assert (by_url.path, by_url.size, by_url.etag) == \
+           (str(tmp_path / "a"), 10, '"a"')
+    # 本次运行中下载的文件和哈希值一致的文件可以直接使用
+    assert by_url.fresh and by_hash.fresh and by_hash.url == "http://a/a"
+    assert missing is None and modified is None
+
+
+def test_reopen_after_close(tmp_path):
+    """
+    关闭后再次使用时重新创建线程池，不会因为线程池已关闭而失败
+    """
+    db = Cache(str(tmp_path / "cache.db"))
+
+    async def run(name):
+        await db.put(entry(tmp_path, name))
+        found = await db.lookup(f"http://a/{name}", {})
+        await db.close()
+        return found
+
+    for name in ("a", "b"):
+        assert asyncio.run(run(name)).url == f"http://a/{name}"
+    asyncio.run(db.close())
+
+
+def test_eviction(tmp_path):
+    path = str(tmp_path / "cache.db")
+
+    async def put(db, *entries):
+        for item in entries:
+            await db.put(item)
+        await db.close()
+
+    async def urls(db):
+        rs = [item.url for item in [
+            await db.lookup(f"http://a/{name}", {}) for name in "abc"] if item]
+        await db.close()
+        return rs
+
+    old, a, b = entry(tmp_path, "c"), entry(tmp_path, "a"), entry(tmp_path, "b")
+    asyncio.run(put(Cache(path), old, a, b))
+    # 按大小淘汰最久没有验证的记录
+    assert asyncio.run(urls(Cache(path, max_size=25))) == \
+           ["http://a/a", "http://a/b"]
+    time.sleep(0.2)
+    asyncio.run(put(Cache(path), entry(tmp_path, "b")))
+    assert asyncio.run(urls(Cache(path, max_age=0.1))) == ["http://a/b"]
+
+
+def test_lock(tmp_path):
+    db = Cache(str(tmp_path / "cache.db"))
+    order = []
+
+    async def task(name):
+        async with db.lock("http://a/a"):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    async def run():
+        await asyncio.gather(task(1), task(2))
+
+    asyncio.run(run())
+    assert order == ["1 start", "1 end", "2 start", "2 end"]
+    assert db.locks == {}
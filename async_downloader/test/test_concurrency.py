@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import logging
+
+from async_downloader.concurrency import AdaptiveConcurrency
+from async_downloader.metrics import Metrics
+
+
+def decide(concurrency, throughput=100, last_throughput=100, error_rate=0,
+           lag=0, busy=False, increased=False):
+    return concurrency.decide(throughput, last_throughput, error_rate, lag,
+                              busy, increased)
+
+
+def test_decide():
+    concurrency = AdaptiveConcurrency(8, min_limit=2, max_limit=10)
+    # 出错率或者事件循环延迟过高时按比例减少
+    assert decide(concurrency, error_rate=0.1)[0] == 6
+    assert decide(concurrency, lag=1)[0] == 6
+    # 都在工作且吞吐量没有下降时加一
+    assert decide(concurrency, busy=True) == (9, "all workers busy")
+    assert decide(concurrency, throughput=96, busy=True)[0] == 9
+    assert decide(concurrency, throughput=90, busy=True)[0] == 8
+    # 增加后吞吐量明显下降则退回
+    assert decide(concurrency, throughput=50, increased=True) == \
+           (7, "throughput dropped")
+    assert decide(concurrency) == (8, None)
+
+
+def test_limits():
+    concurrency = AdaptiveConcurrency(2, min_limit=2, max_limit=2)
+    assert decide(concurrency, error_rate=1)[0] == 2
+    assert decide(concurrency, busy=True)[0] == 2
+    # 上下限总是包括初始值
+    concurrency = AdaptiveConcurrency(4, min_limit=8, max_limit=2)
+    assert (concurrency.min_limit, concurrency.max_limit) == (4, 4)
+
+
+def test_adapt_on_errors():
+    metrics = Metrics()
+    concurrency = AdaptiveConcurrency(8, interval=0.05)
+
+    async def run():
+        adapting = asyncio.ensure_future(
+            concurrency.adapt(metrics, logging.getLogger(__name__)))
+        await asyncio.sleep(0.01)
+        # 一半的下载失败后等待重试
+        metrics.inc("downloads_total", 5, result="done")
+        metrics.inc("downloads_total", 5, result="retry")
+        await asyncio.sleep(0.15)
+        adapting.cancel()
+
+    asyncio.run(run())
+    assert concurrency.limit == 6
+    assert metrics.total("workers_limit") == 6
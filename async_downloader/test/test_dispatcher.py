@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+import pytest
+
+from async_downloader import dispatcher
+from async_downloader.dispatcher import Dispatcher
+from async_downloader.task import Task
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dispatcher.time, "monotonic", lambda: now[0])
+    return now
+
+
+def task(url, priority=None):
+    return Task(url, url.rsplit("/", 1)[-1], priority=priority)
+
+
+def drain(d):
+    rs = []
+    item = d.get()
+    while item:
+        rs.append(item[0])
+        d.done(item[1])
+        item = d.get()
+    return rs
+
+
+def test_round_robin(clock):
+    d = Dispatcher()
+    for name in ("a1", "a2", "a3"):
+        d.put(name, task(f"http://a/{name}"))
+    for name in ("b1", "b2"):
+        d.put(name, task(f"http://b/{name}"))
+    assert drain(d) == ["a1", "b1", "a2", "b2", "a3"]
+
+
+def test_host_workers(clock):
+    d = Dispatcher(host_workers=1)
+    for name in ("a1", "a2"):
+        d.put(name, task(f"http://a/{name}"))
+    d.put("b1", task("http://b/b1"))
+    raw, a1 = d.get()
+    assert raw == "a1"
+    assert d.get()[0] == "b1"
+    # a已经达到并发上限
+    assert d.get() is None
+    d.done(a1)
+    assert d.get()[0] == "a2"
+    assert len(d) == 0
+
+
+def test_priority(clock):
+    d = Dispatcher()
+    d.put("low", task("http://a/low"))
+    d.put("high", task("http://a/high", 5))
+    assert drain(d) == ["high", "low"]
+
+
+def test_aging(clock):
+    # 每分钟增加1
+    d = Dispatcher(aging=1 / 60)
+    d.put("old", task("http://a/old"))
+    clock[0] += 600
+    d.put("new", task("http://b/new", 5))
+    assert drain(d) == ["old", "new"]
+    d.put("old", task("http://a/old"))
+    clock[0] += 60
+    d.put("new", task("http://b/new", 5))
+    assert drain(d) == ["new", "old"]
+
+
+def test_clear(clock):
+    d = Dispatcher()
+    d.put("low", task("http://a/low"))
+    d.put("high", task("http://b/high", 1))
+    assert [raw for raw, _ in d.clear()] == ["high", "low"]
+    assert len(d) == 0 and d.get() is None
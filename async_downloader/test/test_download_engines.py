@@ -0,0 +1,274 @@
+# -*- coding:utf-8 -*-
+import gc
+import os
+import json
+import random
+import asyncio
+import hashlib
+
+import pytest
+
+from async_downloader.downloader import AsyncDownloader
+from async_downloader.download_engines import DownloaderEngine
+from async_downloader.journal import Journal
+from async_downloader.storage import Storage
+
+from .server import FaultServer, content
+
+
+class CountingServer(FaultServer):
+    """
+    记录请求次数的文件服务
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingServer, self).__init__(*args, **kwargs)
+        self.requests = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        return await super(CountingServer, self).handle(request)
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+async def download(tasks, **kwargs):
+    """
+    :return: [Result, ...]
+    """
+    kwargs = dict(workers=4, progress="none", proxy=[], retry_delay=0,
+                  log_level="ERROR", **kwargs)
+    downloader = AsyncDownloader(tasks, **kwargs)
+    return [result async for result in downloader.as_completed()]
+
+
+def test_resume_from_journal(tmp_path):
+    size = 3 * Journal.block_size + 100
+    filename = str(tmp_path / "file")
+    # 上次下载了第0块和第2块，第1块写到了一半
+    with open(Storage.temp(filename), "wb") as f:
+        f.write(content(0, Journal.block_size + 10))
+        f.seek(2 * Journal.block_size)
+        f.write(content(2 * Journal.block_size, 3 * Journal.block_size))
+
+    async def run():
+        server = CountingServer()
+        url = await server.start()
+        journal = Journal(filename, f"{url}/{size}")
+        journal.reset(size, {"ETag": f'"{size}"'})
+        journal.mark(0, Journal.block_size + 10)
+        journal.mark(2 * Journal.block_size, 3 * Journal.block_size)
+        await journal.close()
+        assert Journal.load(filename, journal.url).missing() == [
+            (Journal.block_size + 10, 2 * Journal.block_size),
+            (3 * Journal.block_size, size)]
+        try:
+            return await download([{"url": journal.url, "filename": filename}])
+        finally:
+            await server.stop()
+
+    results = asyncio.run(run())
+    assert [result.event for result in results] == ["done"]
+    with open(filename, "rb") as f:
+        assert f.read() == content(0, size)
+    assert not os.path.exists(Storage.temp(filename))
+
+
+def test_disconnect_without_progress_fails(tmp_path):
+    """
+    每个请求都在发送数据前断开时，不能从同一位置无限重试：
+    每次尝试中各段重试segment_tries_max次，连续segment_tries_max + 1次没有进展时失败，
+    每次调度尝试2次，失败3次后放弃
+    """
+    size = 300 * 1024
+
+    async def run():
+        server = CountingServer(truncate=0)
+        url = await server.start()
+        try:
+            results = await asyncio.wait_for(download(
+                [{"url": f"{url}/{size}", "filename": str(tmp_path / "file")}]
+            ), 30)
+        finally:
+            await server.stop()
+        return results, server.requests
+
+    results, requests = asyncio.run(run())
+    assert [(result.event, result.failed_times) for result in results] == \
+           [("failed", 4)]
+    tries = 3 + 1
+    assert requests == 4 * 2 * tries * tries
+
+
+def test_truncated_responses_resume_byte_precisely(tmp_path):
+    """
+    每个请求只返回1000字节时，每次都从断开的位置继续，不会丢弃写了一部分的数据块
+    """
+    size = 300 * 1024 + 1
+
+    async def run():
+        server = CountingServer(truncate=1000)
+        url = await server.start()
+        try:
+            results = await asyncio.wait_for(download(
+                [{"url": f"{url}/{size}", "filename": str(tmp_path / "file")}]
+            ), 30)
+        finally:
+            await server.stop()
+        return results, server.requests
+
+    results, requests = asyncio.run(run())
+    assert [result.event for result in results] == ["done"]
+    assert requests == -(-size // 1000)
+    with open(tmp_path / "file", "rb") as f:
+        assert f.read() == content(0, size)
+
+
+def test_disconnect_resumes_from_received_bytes(tmp_path):
+    random.seed(0)
+    size = 300 * 1024
+
+    async def run():
+        server = CountingServer(disconnect=0.5)
+        url = await server.start()
+        try:
+            return await asyncio.wait_for(download(
+                [{"url": f"{url}/{size}", "filename": str(tmp_path / "file")}]
+            ), 30)
+        finally:
+            await server.stop()
+
+    results = asyncio.run(run())
+    assert [result.event for result in results] == ["done"]
+    with open(tmp_path / "file", "rb") as f:
+        assert f.read() == content(0, size)
+
+
+def test_failed_downloads_close_files(tmp_path):
+    """
+    校验失败等异常不会泄露文件描述符
+    """
+    size = 64 * 1024
+    md5 = hashlib.md5(b"other").hexdigest()
+
+    async def run():
+        fds = open_fds()
+        server = CountingServer()
+        url = await server.start()
+        try:
+            results = await download([
+                {"url": f"{url}/{size}?n={i}",
+                 "filename": str(tmp_path / str(i)), "md5": md5}
+                for i in range(10)])
+        finally:
+            await server.stop()
+        return results, open_fds() - fds
+
+    results, leaked = asyncio.run(run())
+    assert [result.event for result in results] == ["failed"] * 10
+    assert leaked <= 0
+
+
+@pytest.mark.parametrize("ranges", [0, 1])
+def test_segments(tmp_path, ranges):
+    """
+    服务器支持Range时分段并发下载，忽略Range返回200时只用一个连接下载
+    """
+    size = 4 * Journal.block_size
+
+    async def run():
+        server = CountingServer(ranges=ranges)
+        url = await server.start()
+        try:
+            results = await asyncio.wait_for(download(
+                [{"url": f"{url}/{size}", "filename": str(tmp_path / "file")}],
+                segments=4, segment_threshold=0), 30)
+        finally:
+            await server.stop()
+        return results, server.requests
+
+    results, requests = asyncio.run(run())
+    assert [result.event for result in results] == ["done"]
+    assert requests == (4 if ranges else 1)
+    with open(tmp_path / "file", "rb") as f:
+        assert f.read() == content(0, size)
+
+
+def test_segment_errors_are_all_retrieved(tmp_path, monkeypatch):
+    """
+    多段同时失败时，所有段的异常都被取出
+    """
+    size = 4 * Journal.block_size
+    unretrieved = []
+
+    async def fetch_segment(self, url, filename, fd, journal, start, end,
+                            resp=None, route=None):
+        resp and resp.close()
+        route and route.close()
+        raise RuntimeError(f"Segment at {start} failed. ")
+
+    monkeypatch.setattr(
+        DownloaderEngine, "fetch_segment", fetch_segment)
+
+    async def run():
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: unretrieved.append(context))
+        server = CountingServer()
+        url = await server.start()
+        try:
+            return await asyncio.wait_for(download(
+                [{"url": f"{url}/{size}", "filename": str(tmp_path / "file")}],
+                segments=4, segment_threshold=0), 30)
+        finally:
+            await server.stop()
+            gc.collect()
+
+    results = asyncio.run(run())
+    assert [result.event for result in results] == ["failed"]
+    assert unretrieved == []
+
+
+async def fail(self, url, filename, failed_times=0):
+    raise ValueError(f"Can not download {url}. ")
+
+
+def test_extra_fields_kept_in_meta(tmp_path):
+    async def run():
+        server = CountingServer()
+        url = await server.start()
+        try:
+            return await download([{"url": f"{url}/100",
+                                    "filename": str(tmp_path / "file"),
+                                    "tag": "x"}])
+        finally:
+            await server.stop()
+
+    results = asyncio.run(run())
+    assert [result.event for result in results] == ["done"]
+    assert results[0].task.meta == {"tag": "x"}
+
+
+def test_download_errors_are_retried(tmp_path):
+    results = asyncio.run(download(
+        [{"url": "http://127.0.0.1/1", "filename": str(tmp_path / "file")}],
+        download=f"{__name__}.fail"))
+    assert [(result.event, result.error, result.failed_times)
+            for result in results] == [("failed", "other", 4)]
+
+
+@pytest.mark.parametrize("method", [
+    None, "async_downloader.download_engines.download",
+    "async_downloader.download_engines.co_session_download"])
+def test_abandoned_tasks_are_failures(tmp_path, method):
+    """
+    失败次数已经超过上限的任务不再下载，结果是失败并写入死信，而不是成功
+    """
+    dead_letter = tmp_path / "dead.jsonl"
+    results = asyncio.run(download(
+        [{"url": "http://127.0.0.1/1", "filename": str(tmp_path / "file"),
+          "failed_times": 4}],
+        download=method, dead_letter=str(dead_letter)))
+    assert [(result.event, result.error) for result in results] == \
+           [("failed", "abandoned")]
+    assert json.loads(dead_letter.read_text())["failed_times"] == 4
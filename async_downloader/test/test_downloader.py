@@ -0,0 +1,92 @@
+# -*- coding:utf-8 -*-
+import json
+import asyncio
+import logging
+
+import pytest
+
+from async_downloader.downloader import AsyncDownloader
+from async_downloader.sources import Source, DaemonSource, IterableSource
+
+
+def test_make_args():
+    downloader = AsyncDownloader([], workers=2, host_workers=1)
+    assert downloader.workers == 2
+    assert downloader.dispatcher.host_workers == 1
+    with pytest.raises(TypeError):
+        AsyncDownloader([], workers=2, unknown=1)
+    with pytest.raises(TypeError):
+        AsyncDownloader([])
+
+
+def test_idle():
+    assert not AsyncDownloader([], workers=1).idle
+    assert AsyncDownloader(IterableSource([]), workers=1, idle=True).idle
+    # 与daemon子命令一致，默认没有任务时继续等待
+    assert AsyncDownloader(DaemonSource(), workers=1).idle
+    assert not AsyncDownloader(DaemonSource(), workers=1, idle=False).idle
+
+
+def test_embedded_runs_do_not_add_handlers(tmp_path):
+    logger = logging.getLogger("AsyncDownloader")
+    handlers = list(logger.handlers)
+
+    async def run(**kwargs):
+        downloader = AsyncDownloader([], workers=1, progress="none", **kwargs)
+        return [result async for result in downloader.as_completed()]
+
+    for _ in range(3):
+        assert asyncio.run(run()) == []
+    asyncio.run(run(log_file=str(tmp_path / "log")))
+    assert "Process stopped. " in (tmp_path / "log").read_text()
+    assert not any(isinstance(handler, logging.StreamHandler)
+                   for handler in logger.handlers)
+    assert len(logger.handlers) <= len(handlers) + 1
+
+
+class RecordingSource(Source):
+    """
+    返回编码后的任务，记录退回和确认的数据，第一次失败后关闭下载器
+    """
+    def __init__(self, tasks):
+        self.tasks = [json.dumps(task) for task in tasks]
+        self.downloader = None
+        self.pushed = []
+        self.acked = []
+
+    async def __anext__(self):
+        return self.tasks.pop(0) if self.tasks else None
+
+    async def push_back(self, data):
+        self.pushed.append(data)
+
+    async def ack(self, data):
+        self.acked.append(data)
+
+    async def notify(self, data, event, result=None):
+        if event == "retry":
+            self.downloader.stop()
+
+
+def test_retrying_tasks_pushed_back_with_failures(tmp_path):
+    task = {"url": "http://127.0.0.1:1/a", "filename": str(tmp_path / "a"),
+            "md5": "x"}
+    source = RecordingSource([task])
+
+    async def run():
+        source.downloader = AsyncDownloader(
+            source, workers=1, progress="none", retry_delay=60,
+            log_level="ERROR")
+        return [result async for result in source.downloader.as_completed()]
+
+    results = asyncio.run(asyncio.wait_for(run(), 10))
+    assert [result.event for result in results] == ["cancelled"]
+    # 退回重新编码的任务，保留失败次数和错误类型，原始数据单独确认
+    [pushed] = source.pushed
+    assert json.loads(pushed) == dict(task, failed_times=1, error="connection")
+    assert source.acked == [json.dumps(task)]
+
+
+def test_embedded_progress_off_by_default():
+    assert AsyncDownloader([], workers=1).progress.mode == "none"
+    assert AsyncDownloader([], workers=1, progress="log").progress.mode == "log"
@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+import asyncio
+
+import pytest
+
+from async_downloader.journal import Journal
+from async_downloader.storage import Storage
+
+
+BLOCK = Journal.block_size
+
+
+@pytest.fixture(autouse=True)
+def no_autosave(monkeypatch):
+    # mark不在事件循环外保存日志，close时仍然会保存
+    monkeypatch.setattr(Journal, "save_interval", float("inf"))
+
+
+def test_missing_blocks():
+    journal = Journal("file", "url")
+    assert journal.missing() == [(0, None)]
+    journal.reset(3 * BLOCK + 10, {"ETag": "a"})
+    assert journal.count == 4
+    assert journal.missing() == [(0, 3 * BLOCK + 10)]
+    journal.mark(BLOCK, 2 * BLOCK)
+    assert journal.missing() == [(0, BLOCK), (2 * BLOCK, 3 * BLOCK + 10)]
+    assert journal.received == BLOCK
+    # 最后一块不满一块
+    journal.mark(3 * BLOCK, 3 * BLOCK + 10)
+    assert journal.received == BLOCK + 10
+    journal.mark(0, BLOCK)
+    journal.mark(2 * BLOCK, 3 * BLOCK)
+    assert journal.complete
+    assert journal.missing() == []
+
+
+def test_partial_block():
+    journal = Journal("file", "url")
+    journal.reset(2 * BLOCK, {})
+    journal.mark(0, 100)
+    assert not journal.done(0)
+    assert journal.received == 100
+    assert journal.missing() == [(100, 2 * BLOCK)]
+    # 从续传位置继续写入
+    journal.mark(100, BLOCK + 5)
+    assert journal.done(0)
+    assert journal.partial == {1: BLOCK + 5}
+    assert journal.missing() == [(BLOCK + 5, 2 * BLOCK)]
+    journal.mark(BLOCK + 5, 2 * BLOCK)
+    assert journal.complete and not journal.partial
+
+
+def test_partial_blocks_are_not_merged():
+    journal = Journal("file", "url")
+    journal.reset(4 * BLOCK, {})
+    journal.mark(0, 10)
+    journal.mark(2 * BLOCK, 2 * BLOCK + 20)
+    assert journal.missing() == [(10, 2 * BLOCK), (2 * BLOCK + 20, 4 * BLOCK)]
+
+
+def test_matches_and_reset():
+    journal = Journal("file", "url")
+    journal.reset(100, {"ETag": "a", "Last-Modified": "b"})
+    assert journal.validator == "a"
+    assert journal.matches(100, {"ETag": "a", "Last-Modified": "b"})
+    assert not journal.matches(100, {"ETag": "c", "Last-Modified": "b"})
+    assert not journal.matches(101, {"ETag": "a", "Last-Modified": "b"})
+    journal.mark(0, 50)
+    journal.reset(100, {})
+    assert journal.received == 0 and not journal.partial
+
+
+def test_save_and_load(tmp_path):
+    filename = str(tmp_path / "file")
+
+    async def save():
+        journal = Journal(filename, "url")
+        journal.reset(2 * BLOCK, {"ETag": "a"})
+        journal.mark(0, BLOCK + 7)
+        await journal.close()
+
+    asyncio.run(save())
+    # 临时文件不存在时不能续传
+    assert Journal.load(filename, "url").total is None
+    open(Storage.temp(filename), "wb").close()
+    journal = Journal.load(filename, "url")
+    assert journal.etag == "a"
+    assert journal.missing() == [(BLOCK + 7, 2 * BLOCK)]
+    # url不一致时不使用日志
+    assert Journal.load(filename, "other").total is None
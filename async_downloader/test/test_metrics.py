@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+import asyncio
+
+from async_downloader.metrics import Metrics
+from async_downloader.concurrency import AdaptiveConcurrency
+from async_downloader.downloader import AsyncDownloader
+
+from .server import FaultServer
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.inc("bytes_total", 10, host="a")
+    metrics.inc("bytes_total", 5, host="a")
+    metrics.observe("ttfb_seconds", 0.5, host="b")
+    metrics.observe("ttfb_seconds", 1.5, host="b")
+    text = metrics.prometheus()
+    assert 'downloader_bytes_total{host="a"} 15.0\n' in text
+    assert 'downloader_ttfb_seconds_count{host="b"} 2\n' in text
+    assert 'downloader_ttfb_seconds_sum{host="b"} 2.0\n' in text
+    assert "# TYPE downloader_ttfb_seconds summary\n" in text
+
+
+def test_label_values_escaped():
+    metrics = Metrics()
+    metrics.inc("cache_hits_total", reason='a\\b"c\nd')
+    assert 'downloader_cache_hits_total{reason="a\\\\b\\"c\\nd"} 1.0\n' in \
+           metrics.prometheus()
+
+
+def test_total_and_combine():
+    metrics = Metrics()
+    metrics.inc("downloads_total", result="done")
+    metrics.inc("downloads_total", 2, result="retry")
+    assert metrics.total("downloads_total") == 3
+    assert metrics.total("downloads_total", result="retry") == 2
+    other = Metrics()
+    other.inc("downloads_total", result="done")
+    other.observe("connect_seconds", 1, host="a")
+    metrics.combine([metrics.state(), other.state()])
+    assert metrics.total("downloads_total", result="done") == 2
+    assert metrics.summaries["connect_seconds", (("host", "a"),)] == [1, 1]
+
+
+def test_snapshot_rates():
+    metrics = Metrics()
+    metrics.reported_at -= 2
+    metrics.inc("bytes_total", 100, host="a")
+    metrics.inc("bytes_total", 300, host="b")
+    snapshot = metrics.snapshot()
+    assert round(snapshot["bytes_per_second"]) == 200
+    assert {host: round(rate) for host, rate in
+            snapshot["bytes_per_second_by_host"].items()} == {"a": 50, "b": 150}
+    assert snapshot["metrics"]["bytes_total"] == {"host=a": 100, "host=b": 300}
+    # 没有新的数据时速度为0
+    assert metrics.snapshot()["bytes_per_second"] == 0
+
+
+def test_retries_counted_apart_from_failures(tmp_path):
+    """
+    每次失败计入retry，只有最终放弃才计入failed，错误率仍然包括所有失败
+    """
+    async def run():
+        server = FaultServer(error=1)
+        url = await server.start()
+        try:
+            downloader = AsyncDownloader(
+                [{"url": f"{url}/100", "filename": str(tmp_path / "file")}],
+                workers=1, progress="none", retry_delay=0, log_level="ERROR")
+            [result async for result in downloader.as_completed()]
+        finally:
+            await server.stop()
+        return downloader.metrics
+
+    metrics = asyncio.run(run())
+    assert metrics.total("downloads_total", result="retry") == 3
+    assert metrics.total("downloads_total", result="failed") == 1
+    _, _, errors, requests = AdaptiveConcurrency.sample(metrics)
+    assert errors == requests
+    assert metrics.total("downloads_total") == 4
+    # 连接耗时按host统计
+    assert [labels for name, labels in metrics.summaries
+            if name == "connect_seconds"] == [(("host", "127.0.0.1"),)]
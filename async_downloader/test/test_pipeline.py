@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+import os
+import gzip
+import asyncio
+import hashlib
+import logging
+
+import pytest
+
+from async_downloader.pipeline import (
+    Pipeline, HashProcessor, DecompressProcessor, TeeProcessor, IntegrityError)
+from async_downloader.downloader import AsyncDownloader
+
+
+logger = logging.getLogger(__name__)
+DATA = b"0123456789" * 1000
+
+
+def test_hash():
+    processor = HashProcessor("md5", hashlib.md5(DATA).hexdigest().upper(),
+                              "file", logger)
+    processor.feed(DATA)
+    processor.finish()
+    assert processor.digest == hashlib.md5(DATA).hexdigest()
+    processor = HashProcessor("md5", "x", "file", logger)
+    processor.feed(DATA)
+    with pytest.raises(IntegrityError):
+        processor.finish()
+
+
+def test_feed_skips_repeated_data_and_catches_up(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(DATA)
+    processor = HashProcessor("sha256", None, "file", logger)
+    pipeline = Pipeline([processor])
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        pipeline.feed(fd, 0, [memoryview(DATA[:300])])
+        # 重复的数据被跳过，缺少的部分从文件中补齐
+        pipeline.feed(fd, 100, [memoryview(DATA[100:500])])
+        pipeline.feed(fd, 800, [memoryview(DATA[800:900])])
+        pipeline.finish(fd, len(DATA))
+    finally:
+        os.close(fd)
+    assert processor.digest == hashlib.sha256(DATA).hexdigest()
+    pipeline.reset()
+    assert (pipeline.position, processor.digest) == (0, None)
+
+
+def test_decompress_concatenated_streams(tmp_path):
+    processor = DecompressProcessor(str(tmp_path / "file.gz"))
+    data = gzip.compress(DATA[:5000]) + gzip.compress(DATA[5000:])
+    for i in range(0, len(data), 100):
+        processor.feed(data[i:i + 100])
+    processor.finish()
+    assert (tmp_path / "file").read_bytes() == DATA
+    assert not DecompressProcessor.supports("file.zip")
+
+
+def test_tee(tmp_path):
+    target = tmp_path / "copy"
+    processor = TeeProcessor(f"cat > {target}", "http://a/b", "b")
+    processor.feed(DATA)
+    processor.finish()
+    assert target.read_bytes() == DATA
+    processor = TeeProcessor("exit 3", "http://a/b", "b")
+    processor.feed(b"")
+    with pytest.raises(RuntimeError, match="exited with 3"):
+        processor.finish()
+
+
+async def save(self, url, filename, failed_times=0):
+    """
+    不使用处理器链的下载方法
+    """
+    with open(filename, "wb") as f:
+        f.write(gzip.compress(DATA, mtime=0))
+
+
+def download(tmp_path, md5, **kwargs):
+    async def run():
+        downloader = AsyncDownloader(
+            [{"url": "http://a/file.gz", "filename": str(tmp_path / "file.gz"),
+              "md5": md5}], workers=1, retry_delay=0, log_level="ERROR",
+            download=f"{__name__}.save", **kwargs)
+        return [(result.event, result.error)
+                async for result in downloader.as_completed()]
+
+    return asyncio.run(run())
+
+
+def test_custom_download_methods_use_pipeline(tmp_path):
+    md5 = hashlib.md5(gzip.compress(DATA, mtime=0)).hexdigest()
+    assert download(tmp_path, md5, decompress=True) == [("done", None)]
+    assert (tmp_path / "file").read_bytes() == DATA
+    assert download(tmp_path, "x") == [("failed", "other")]
@@ -0,0 +1,119 @@
+# -*- coding:utf-8 -*-
+import json
+import time
+import asyncio
+import logging
+
+import pytest
+
+from async_downloader.metrics import Metrics
+from async_downloader.profiler import Profiler
+
+
+@pytest.mark.parametrize("threshold, tick", [
+    (0.1, 0.025), (1, 0.25), (0.02, 0.01), (0.005, 0.005)])
+def test_tick(threshold, tick):
+    """
+    按阈值的1/4采样，不低于10ms，也不超过阈值
+    """
+    assert Profiler(block_threshold=threshold).tick == pytest.approx(tick)
+
+
+def test_disabled_records_nothing():
+    profiler = Profiler()
+    with profiler.span("fetch"), profiler.task("download"):
+        profiler.add("write", 0, 1)
+    assert profiler.events == []
+
+
+def test_tasks_take_free_lanes():
+    profiler = Profiler(enabled=True)
+    with profiler.span("fetch"):
+        pass
+    with profiler.task("a", url="1"):
+        profiler.add("write", 1, 2)
+        with profiler.task("b"):
+            profiler.add("write", 2, 3)
+    with profiler.task("c"):
+        pass
+    lanes = [(event["name"], event["tid"]) for event in profiler.events]
+    first = Profiler.LANE_WORKERS
+    assert lanes == [("fetch", Profiler.LANE_SOURCE), ("write", first),
+                     ("write", first + 1), ("b", first + 1), ("a", first),
+                     ("c", first)]
+    assert profiler.events[4]["args"] == {"url": "1"}
+    assert profiler.events[1]["dur"] == pytest.approx(1e6)
+
+
+def test_span_records_error():
+    profiler = Profiler(enabled=True)
+    with pytest.raises(ValueError):
+        with profiler.span("connect", host="a"):
+            raise ValueError("x")
+    assert profiler.events[0]["args"] == {"host": "a",
+                                          "error": "ValueError('x')"}
+
+
+def test_concurrent_segments_use_own_lanes():
+    profiler = Profiler(enabled=True)
+
+    async def segment(start):
+        await asyncio.sleep(0)
+        profiler.add("write", start, start + 1)
+
+    async def run():
+        with profiler.task("download"):
+            await asyncio.gather(*(profiler.run("segment", segment(i))
+                                   for i in range(2)))
+
+    asyncio.run(run())
+    lanes = {event["tid"] for event in profiler.events
+             if event["name"] == "write"}
+    assert lanes == {Profiler.LANE_WORKERS + 1, Profiler.LANE_WORKERS + 2}
+
+
+def test_export(tmp_path):
+    trace_file = tmp_path / "trace.json"
+    profiler = Profiler(trace_file=str(trace_file),
+                        logger=logging.getLogger(__name__))
+    with profiler.task("download"):
+        pass
+    profiler.export()
+    trace = json.loads(trace_file.read_text())
+    names = {event["tid"]: event["args"]["name"]
+             for event in trace["traceEvents"] if event["ph"] == "M"}
+    assert names == {Profiler.LANE_LOOP: "event loop",
+                     Profiler.LANE_SOURCE: "source",
+                     Profiler.LANE_PUSH_BACK: "push back",
+                     Profiler.LANE_WORKERS: "worker 0"}
+    assert [event["name"] for event in trace["traceEvents"]
+            if event["ph"] == "X"] == ["download"]
+
+
+def test_blocked_loop_detected(caplog):
+    profiler = Profiler(enabled=True, block_threshold=0.05,
+                        logger=logging.getLogger(__name__))
+    metrics = Metrics()
+
+    def block():
+        time.sleep(0.3)
+
+    async def run():
+        monitor = asyncio.ensure_future(profiler.monitor(metrics))
+        await asyncio.sleep(0.05)
+        block()
+        await asyncio.sleep(0.05)
+        monitor.cancel()
+        await asyncio.gather(monitor, return_exceptions=True)
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(run())
+    assert not profiler.watching
+    assert metrics.total("loop_blocks_total") == 1
+    blocked = [event for event in profiler.events
+               if event["name"] == "blocked"]
+    assert len(blocked) == 1
+    assert blocked[0]["tid"] == Profiler.LANE_LOOP
+    assert "in block" in blocked[0]["args"]["stack"]
+    assert "Event loop blocked" in caplog.text
+    assert metrics.summaries["loop_lag_seconds", ()][0] > 0
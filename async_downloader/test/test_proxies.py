@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+import random
+
+import aiohttp
+
+from async_downloader.proxies import ProxyPool, RouteStats, MB
+from async_downloader.retry import StatusError
+from async_downloader.metrics import Metrics
+
+
+def test_direct_first():
+    pool = ProxyPool(["http://p1", "http://p2"])
+    assert pool.choose("a").proxy is None
+    assert pool.choose("a", 1).proxy in ("http://p1", "http://p2")
+    # 本次任务中失败过的线路不再使用
+    assert pool.choose("a", 1, {"http://p1"}).proxy == "http://p2"
+    assert pool.choose("a", 1, {"http://p1", "http://p2"}).proxy in \
+           ("http://p1", "http://p2")
+    # 没有代理时总是直连
+    assert ProxyPool(direct="never").choose("a", 3).proxy is None
+
+
+def test_candidates():
+    proxies = ["http://p1", "http://p1", "http://p2"]
+    assert ProxyPool(proxies, direct="pool").candidates(0) == \
+           [None, "http://p1", "http://p2"]
+    assert ProxyPool(proxies, direct="never").candidates(0) == \
+           ["http://p1", "http://p2"]
+
+
+def test_score():
+    fast, slow = RouteStats(), RouteStats()
+    fast.latency, fast.throughput = 0.1, 10 * MB
+    slow.latency, slow.throughput = 0.1, MB
+    assert fast.score() > slow.score()
+    busy = RouteStats()
+    busy.latency, busy.throughput, busy.inflight = 0.1, 10 * MB, 1
+    assert busy.score() == fast.score() / 2
+    # 没有统计数据的线路优先尝试
+    assert RouteStats().score() > fast.score()
+
+
+def test_weighted_choice():
+    random.seed(0)
+    pool = ProxyPool(["http://fast", "http://slow"], direct="never")
+    pool.stats_of("http://fast", "a").latency = 0.1
+    pool.stats_of("http://slow", "a").latency = 1
+    chosen = []
+    for _ in range(200):
+        route = pool.choose("a")
+        chosen.append(route.proxy)
+        route.close()
+    assert chosen.count("http://fast") > 150
+
+
+def test_cooldown():
+    metrics = Metrics()
+    pool = ProxyPool(["http://p1", "http://p2"], direct="never",
+                     max_failures=2, metrics=metrics)
+    for _ in range(2):
+        route = pool.choose("a", 0, {"http://p2"})
+        assert route.proxy == "http://p1"
+        route.fail(aiohttp.ClientConnectionError())
+    assert metrics.total("proxy_cooldowns_total", proxy="http://p1") == 1
+    # 冷却中的线路不再使用，都在冷却时使用最先结束冷却的线路
+    assert {pool.choose("a").proxy for _ in range(20)} == {"http://p2"}
+    pool.stats_of("http://p2", "a").cooling_until = float("inf")
+    assert pool.choose("a").proxy == "http://p1"
+
+
+def test_client_errors_not_counted():
+    pool = ProxyPool(["http://p1"], direct="never")
+    route = pool.choose("a")
+    route.fail(StatusError(404, "Not found. "))
+    assert route.stats.success == 1 and route.stats.failures == 0
+    route = pool.choose("a")
+    route.fail(StatusError(407, "Proxy authentication required. "))
+    assert route.stats.failures == 1
+    # 已经结束的线路不会重复统计
+    route.fail()
+    route.done()
+    assert (route.stats.failures, route.stats.inflight) == (1, 0)
+
+
+def test_done_updates_stats():
+    pool = ProxyPool()
+    route = pool.choose("a")
+    route.responded()
+    route.responded_at -= 1
+    route.done(2 * MB)
+    stats = pool.stats_of(None, "a")
+    assert round(stats.throughput / MB) == 2
+    assert stats.latency is not None and stats.inflight == 0
+
+
+def test_auth(tmp_path):
+    path = tmp_path / "proxies"
+    path.write_text("# comment\nhttp://p1\n\nhttp://u:p@p2\n")
+    pool = ProxyPool.load(["", "http://p0"], str(path), ("user", "pass"),
+                          direct="never")
+    assert pool.proxies == ["http://p0", "http://p1", "http://u:p@p2"]
+    assert pool.choose("a", 0, {"http://p0", "http://p1"}).kwargs == \
+           {"proxy": "http://u:p@p2", "proxy_auth": None}
+    assert pool.choose("a", 0, {"http://p0", "http://u:p@p2"}).kwargs == \
+           {"proxy": "http://p1",
+            "proxy_auth": aiohttp.BasicAuth("user", "pass")}
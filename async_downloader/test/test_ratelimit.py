@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+import json
+import time
+import asyncio
+import logging
+
+import pytest
+
+from argparse import ArgumentParser
+
+from async_downloader.ratelimit import TokenBucket, RateLimiter
+from async_downloader.downloader import AsyncDownloader
+
+
+def test_token_bucket():
+    async def run():
+        bucket = TokenBucket(100000)
+        started_at = time.monotonic()
+        # 第一秒的令牌可以直接使用，透支的部分需要等待
+        await bucket.consume(100000)
+        await bucket.consume(50000)
+        return time.monotonic() - started_at
+
+    assert 0.4 < asyncio.run(run()) < 0.8
+
+
+def test_unlimited():
+    async def run():
+        await TokenBucket().consume(10 ** 12)
+
+    asyncio.run(asyncio.wait_for(run(), 1))
+    assert RateLimiter().throttle_for("a") is None
+
+
+def test_shares_and_update():
+    limiter = RateLimiter(rate=1000, host_rate=100, host_rates={"a": 400},
+                          shares=4)
+    assert limiter.total.rate == 250
+    assert limiter._bucket(limiter.hosts, "a", 400).rate == 100
+    limiter.update(host_rates={"a": 800}, rate=4000)
+    assert (limiter.total.rate, limiter.hosts["a"].rate) == (1000, 200)
+
+
+def test_host_rates_argument():
+    parser = ArgumentParser()
+    RateLimiter.enrich_parser(parser)
+    args = parser.parse_args(["--host-rates", "a=10", "--host-rates", "b=20"])
+    assert dict(args.host_rates) == {"a": 10, "b": 20}
+    for value in ("a", "a=", "=10", "a=x"):
+        with pytest.raises(SystemExit):
+            parser.parse_args(["--host-rates", value])
+    downloader = AsyncDownloader([], workers=1, host_rates={"a": 10})
+    assert downloader.limiter.host_rates == {"a": 10}
+
+
+def test_watch(tmp_path):
+    path = tmp_path / "limits.json"
+    path.write_text(json.dumps({"rate": 100, "host_rates": {"a": 10}}))
+
+    async def run():
+        limiter = RateLimiter()
+        watching = asyncio.ensure_future(limiter.watch(
+            str(path), logging.getLogger(__name__), 0.01))
+        await asyncio.sleep(0.05)
+        watching.cancel()
+        return limiter
+
+    limiter = asyncio.run(run())
+    assert (limiter.total.rate, limiter.host_rates) == (100, {"a": 10})
+    assert limiter.throttle_for("b") is not None
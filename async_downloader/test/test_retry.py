@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+import json
+import asyncio
+import logging
+
+import aiohttp
+
+from async_downloader.retry import RetryScheduler, StatusError, classify
+from async_downloader.task import Task
+
+
+logger = logging.getLogger(__name__)
+
+
+def test_classify():
+    assert classify(StatusError(404, "")) == "not_found"
+    assert classify(StatusError(503, "")) == "server"
+    assert classify(StatusError(429, "")) == "server"
+    assert classify(StatusError(403, "")) == "client"
+    assert classify(asyncio.TimeoutError()) == "timeout"
+    assert classify(aiohttp.ClientPayloadError()) == "connection"
+    assert classify(ConnectionResetError()) == "connection"
+    assert classify(ValueError()) == "other"
+
+
+def test_backoff():
+    scheduler = RetryScheduler(delay=1, max_delay=10)
+    for _ in range(20):
+        assert 0.5 <= scheduler.backoff(1, 1) <= 1
+        assert 2 <= scheduler.backoff(3, 1) <= 4
+        assert 5 <= scheduler.backoff(10, 1) <= 10
+
+
+def test_schedule_and_due():
+    scheduler = RetryScheduler(delay=0)
+    for i in range(3):
+        assert scheduler.schedule(
+            Task("u", str(i), 1, error="server"), logger, i)
+    assert len(scheduler) == 3
+    assert scheduler.wait() == 0
+    # 到期时间相同时按加入顺序
+    assert [raw for raw, _ in scheduler.due()] == [0, 1, 2]
+    assert scheduler.wait() is None
+
+
+def test_clear():
+    scheduler = RetryScheduler(delay=100)
+    scheduler.schedule(Task("u", "a", 1, error="timeout"), logger, "a")
+    assert scheduler.due() == []
+    assert 0 < scheduler.wait() <= 200
+    assert [raw for raw, _ in scheduler.clear()] == ["a"]
+    assert not scheduler
+
+
+def test_dead_letter(tmp_path):
+    path = tmp_path / "dead.jsonl"
+    scheduler = RetryScheduler(delay=0, dead_letter=str(path))
+    # 客户端错误不重试
+    assert not scheduler.schedule(
+        Task("u", "a", 1, error="client", meta={"id": "1"}), logger)
+    # 超过重试次数
+    assert scheduler.schedule(Task("u", "b", 3, error="server"), logger)
+    assert not scheduler.schedule(Task("u", "b", 4, error="server"), logger)
+    # 资源不存在时只再试一次
+    assert scheduler.schedule(Task("u", "c", 1, error="not_found"), logger)
+    assert not scheduler.schedule(Task("u", "c", 2, error="not_found"), logger)
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert lines == [
+        {"url": "u", "filename": "a", "failed_times": 1, "error": "client",
+         "id": "1"},
+        {"url": "u", "filename": "b", "failed_times": 4, "error": "server"},
+        {"url": "u", "filename": "c", "failed_times": 2,
+         "error": "not_found"}]
+
+
+def test_abandoned_tasks_are_not_retried(tmp_path):
+    path = tmp_path / "dead.jsonl"
+    scheduler = RetryScheduler(delay=0, dead_letter=str(path))
+    assert not scheduler.schedule(Task("u", "a", 4, error="abandoned"), logger)
+    assert json.loads(path.read_text())["error"] == "abandoned"
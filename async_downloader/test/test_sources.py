@@ -0,0 +1,354 @@
+# -*- coding:utf-8 -*-
+import json
+import asyncio
+
+import aiohttp
+import pytest
+
+from async_downloader.sources import FileSource, DaemonSource, RedisSource
+
+
+def write_tasks(path, count):
+    """
+    :return: 各行的开始位置
+    """
+    offsets, offset = [], 0
+    with open(path, "w") as f:
+        for i in range(count):
+            line = json.dumps({"url": f"http://a/{i}", "filename": str(i)})
+            f.write(line + "\n")
+            offsets.append(offset)
+            offset += len(line) + 1
+    return offsets
+
+
+async def read_all(source):
+    """
+    :return: [((通道, 行开始位置), 任务), ...]
+    """
+    rs = []
+    async with source:
+        item = await source.__anext__()
+        while item:
+            rs.append(item)
+            item = await source.__anext__()
+    return rs
+
+
+def test_shards_cover_each_line_once(tmp_path):
+    path = str(tmp_path / "tasks.jsonl")
+    offsets = write_tasks(path, 100)
+    seen = []
+    for index in range(3):
+        source = FileSource(path)
+        source.shard(index, 3)
+        # 小块读取，覆盖行跨块的情况
+        source.block_size = 64
+        items = asyncio.run(read_all(source))
+        for (_, offset), data in items:
+            assert offsets[int(data["filename"])] == offset
+        seen += [data["filename"] for _, data in items]
+    assert sorted(seen, key=int) == [str(i) for i in range(100)]
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "tasks.jsonl")
+    checkpoint = str(tmp_path / "checkpoint")
+    offsets = write_tasks(path, 10)
+
+    async def run():
+        source = FileSource(path, checkpoint=checkpoint)
+        async with source:
+            items = [await source.__anext__() for _ in range(5)]
+            # 确认0、1、3，退回2，4没有完成
+            for raw, _ in items[:2] + items[3:4]:
+                await source.ack(raw)
+            await source.push_back(items[2][0])
+            await source.ack(items[2][0])
+
+    asyncio.run(run())
+    with open(checkpoint) as f:
+        assert json.load(f) == {path: offsets[2]}
+    items = asyncio.run(read_all(FileSource(path, checkpoint=checkpoint)))
+    assert [data["filename"] for _, data in items] == \
+           [str(i) for i in range(2, 10)]
+
+
+def test_sharded_checkpoint_files(tmp_path):
+    source = FileSource(str(tmp_path / "tasks.jsonl"),
+                        checkpoint=str(tmp_path / "checkpoint"))
+    source.shard(1, 4)
+    assert source.checkpoint == str(tmp_path / "checkpoint") + ".1-4"
+
+
+def test_line_with_several_objects(tmp_path):
+    path = str(tmp_path / "tasks.jsonl")
+    with open(path, "w") as f:
+        f.write('{"url": "a", "filename": "a"}\n'
+                '{"url": "b", "filename": "b"},{"url": "c", "filename": "c"}\n'
+                '{"url": "d", "filename": "d"}\n')
+    with pytest.raises(ValueError, match="at 30 of"):
+        asyncio.run(read_all(FileSource(path)))
+
+
+def test_lanes_by_priority(tmp_path):
+    low, high = str(tmp_path / "low"), str(tmp_path / "high")
+    write_tasks(low, 2)
+    write_tasks(high, 2)
+    items = asyncio.run(read_all(FileSource(lanes=[(low, "1"), (high, "5")])))
+    assert [(lane, data["priority"]) for (lane, _), data in items] == \
+           [(0, 5), (0, 5), (1, 1), (1, 1)]
+
+
+def test_daemon_cancels_queued_tasks_on_exit(tmp_path):
+    socket = str(tmp_path / "daemon.sock")
+
+    async def run():
+        source = DaemonSource(socket=socket)
+        await source.__aenter__()
+
+        async def submit():
+            async with aiohttp.ClientSession(
+                    connector=aiohttp.UnixConnector(socket)) as session:
+                async with session.post(
+                        "http://localhost/tasks",
+                        json=[{"url": "u", "filename": str(i)}
+                              for i in range(3)]) as resp:
+                    return [json.loads(line) async for line in resp.content]
+
+        client = asyncio.ensure_future(submit())
+        while source.queue.qsize() < 3:
+            await asyncio.sleep(0.01)
+        # 没有开始的任务通知客户端取消，事件流结束后马上关闭
+        await asyncio.wait_for(source.__aexit__(None, None, None), 5)
+        return await asyncio.wait_for(client, 5)
+
+    events = asyncio.run(run())
+    assert [(event["filename"], event["event"]) for event in events] == \
+           [("0", "cancelled"), ("1", "cancelled"), ("2", "cancelled")]
+
+
+class RecordingDaemon(DaemonSource):
+    """
+    记录处理请求时抛出的异常
+    """
+    errors = []
+
+    async def submit(self, request):
+        try:
+            return await super(RecordingDaemon, self).submit(request)
+        except Exception as e:
+            self.errors.append(e)
+            raise
+
+
+def test_daemon_drops_disconnected_clients(tmp_path):
+    socket = str(tmp_path / "daemon.sock")
+
+    async def run():
+        source = RecordingDaemon(socket=socket)
+        async with source:
+            async with aiohttp.ClientSession(
+                    connector=aiohttp.UnixConnector(socket)) as session:
+                resp = await session.post(
+                    "http://localhost/tasks",
+                    json=[{"url": "u", "filename": str(i)} for i in range(2)])
+                (raw, _), _ = [await source.__anext__() for _ in range(2)]
+                await source.notify(raw, "retry")
+                await resp.content.readline()
+                resp.close()
+            # 客户端断开后继续通知
+            while source.clients:
+                await source.notify(raw, "retry")
+                await asyncio.sleep(0.01)
+        return source.errors
+
+    assert asyncio.run(asyncio.wait_for(run(), 5)) == []
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """
+    RedisSource连接到同一个fakeredis
+    :return: 测试中检查数据用的连接
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis.asyncio
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio, "Redis",
+        lambda **kwargs: fakeredis.FakeAsyncRedis(server=server))
+    return lambda: fakeredis.FakeAsyncRedis(server=server)
+
+
+def redis_source(**kwargs):
+    return RedisSource("localhost", 6379, "tasks", **kwargs)
+
+
+def test_redis_batches(redis):
+    async def run():
+        conn = redis()
+        await conn.rpush("tasks", *[f"t{i}" for i in range(5)])
+        source = redis_source(redis_batch_size=2)
+        async with source:
+            items = [await source.__anext__() for _ in range(6)]
+            # 取出第一批后队列中只剩下没有取的任务
+            await source.push_back(items[0])
+        return items, await conn.lrange("tasks", 0, -1)
+
+    items, left = asyncio.run(run())
+    assert items == [b"t0", b"t1", b"t2", b"t3", b"t4", None]
+    assert left == [b"t0"]
+
+
+def test_redis_returns_unstarted_tasks_on_exit(redis):
+    async def run():
+        conn = redis()
+        await conn.rpush("tasks", "t0", "t1", "t2")
+        async with redis_source(redis_batch_size=3) as source:
+            await source.__anext__()
+        return await conn.lrange("tasks", 0, -1)
+
+    assert asyncio.run(run()) == [b"t1", b"t2"]
+
+
+class BrokenPipeline(object):
+    """
+    提交事务时连接断开
+    """
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+    async def execute(self):
+        raise ConnectionError("Connection lost. ")
+
+
+def test_redis_push_failures_keep_tasks(redis, monkeypatch):
+    async def run():
+        conn = redis()
+        source = redis_source(lease_timeout=10)
+        pipeline = source.redis_conn.pipeline
+        monkeypatch.setattr(source.redis_conn, "pipeline",
+                            lambda **kwargs: BrokenPipeline())
+        with pytest.warns(UserWarning, match="Connection lost"):
+            await source.push_back(b"t0")
+            await source.ack(b"t1")
+            await asyncio.wait([source.pushing])
+            # 等待回调输出警告
+            await asyncio.sleep(0)
+        with pytest.raises(ConnectionError):
+            await source.flush()
+        assert (source.pushed, source.acked) == ([b"t0"], [b"t1"])
+        # 恢复后再次提交
+        monkeypatch.setattr(source.redis_conn, "pipeline", pipeline)
+        await conn.zadd("tasks:processing", {"t1": 1})
+        await source.flush()
+        return (source.pushed, source.acked,
+                await conn.lrange("tasks", 0, -1),
+                await conn.zrange("tasks:processing", 0, -1))
+
+    assert asyncio.run(run()) == ([], [], [b"t0"], [])
+
+
+async def leases(conn):
+    """
+    :return: {任务: 租约剩余的秒数}
+    """
+    now = await conn.time()
+    now = now[0] + now[1] / 1000000
+    return {task: round(score - now) for task, score in
+            await conn.zrange("tasks:processing", 0, -1, withscores=True)}
+
+
+def test_redis_claim_and_ack(redis):
+    async def run():
+        conn = redis()
+        await conn.rpush("tasks", "t0", "t1", "t2")
+        async with redis_source(lease_timeout=60, redis_batch_size=2) as source:
+            items = [await source.__anext__() for _ in range(2)]
+            claimed = await leases(conn), await conn.lrange("tasks", 0, -1)
+            await source.ack(items[0])
+            await source.push_back(items[1])
+            await source.ack(items[1])
+            await source.flush()
+            acked = await leases(conn), await conn.lrange("tasks", 0, -1)
+        return claimed, acked
+
+    claimed, acked = asyncio.run(run())
+    assert claimed == ({b"t0": 60, b"t1": 60}, [b"t2"])
+    # 退回的任务在队列尾部，没有开始的任务退回队列头部
+    assert acked == ({}, [b"t2", b"t1"])
+
+
+def test_redis_renew_and_reap(redis):
+    async def run():
+        conn = redis()
+        async with redis_source(lease_timeout=60) as source:
+            await conn.rpush("tasks", "t0")
+            await source.__anext__()
+            # 其它节点已经挂掉，租约过期的任务
+            await conn.zadd("tasks:processing", {"crashed": 0})
+            await source.renew(keys=["tasks:processing"],
+                               args=[120, *source.leases, "acked"])
+            renewed = await leases(conn)
+            reaped = await source.reap(
+                keys=["tasks", "tasks:processing"], args=[10])
+            await source.ack(b"t0")
+            await source.flush()
+            return renewed, reaped, await leases(conn), \
+                await conn.lrange("tasks", 0, -1)
+
+    renewed, reaped, left, queue = asyncio.run(run())
+    # 只续约还在processing中的任务
+    assert renewed[b"t0"] == 120 and b"acked" not in renewed
+    assert (reaped, left, queue) == (1, {}, [b"crashed"])
+
+
+def test_redis_priority_claim_and_reap(redis):
+    tasks = {json.dumps({"url": "u", "filename": str(i), "priority": i}): i
+             for i in range(10000)}
+
+    async def run():
+        conn = redis()
+        await conn.zadd("tasks", tasks)
+        async with redis_source(lease_timeout=60, redis_priority=True,
+                                redis_batch_size=9000) as source:
+            # 超过lua中unpack的参数个数限制
+            items = [await source.__anext__() for _ in range(9000)]
+            # 模拟本节点挂掉，租约全部过期
+            await conn.zadd("tasks:processing", {item: 0 for item in items})
+            left = await conn.zcard("tasks")
+            reaped = await source.reap(
+                keys=["tasks", "tasks:processing"], args=[10])
+            source.tasks.clear()
+            source.leases.clear()
+            return items, left, reaped, \
+                await conn.zrevrange("tasks", 0, 9, withscores=True)
+
+    items, left, reaped, top = asyncio.run(run())
+    assert [json.loads(item)["priority"] for item in items] == \
+           list(range(9999, 999, -1))
+    assert (left, reaped) == (1000, 10)
+    # 过期的任务按priority退回
+    assert [score for _, score in top] == \
+           sorted([score for _, score in top], reverse=True)
+    assert all(json.loads(task)["priority"] == score for task, score in top)
+
+
+def test_redis_duplicated_tasks_warn(redis):
+    async def run():
+        conn = redis()
+        await conn.rpush("tasks", "t0", "t0")
+        async with redis_source(lease_timeout=60) as source:
+            with pytest.warns(UserWarning, match="share one lease"):
+                await source.__anext__()
+            for _ in range(2):
+                await source.ack(b"t0")
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+import os
+import asyncio
+
+import pytest
+
+from async_downloader import storage
+from async_downloader.storage import Storage
+
+
+def write(store, filename, data, offset=0, total=None):
+    fd = store.open(filename, offset, total)
+    try:
+        os.pwrite(fd, data, offset)
+        asyncio.run(store.commit(fd, filename))
+    finally:
+        os.close(fd)
+
+
+def test_commit_replaces_file(tmp_path):
+    filename = str(tmp_path / "file")
+    with open(filename, "wb") as f:
+        f.write(b"old")
+    store = Storage()
+    fd = store.open(filename, total=10)
+    try:
+        os.pwrite(fd, b"new", 0)
+        # 完成前原有的文件不受影响，临时文件已经预分配
+        assert (tmp_path / "file").read_bytes() == b"old"
+        assert os.path.getsize(Storage.temp(filename)) == 10
+    finally:
+        os.close(fd)
+    write(store, filename, b"0123456789")
+    assert (tmp_path / "file").read_bytes() == b"0123456789"
+    assert not os.path.exists(Storage.temp(filename))
+
+
+def test_resume_keeps_written_data(tmp_path):
+    filename = str(tmp_path / "file")
+    store = Storage()
+    fd = store.open(filename, total=10)
+    os.pwrite(fd, b"01234", 0)
+    os.close(fd)
+    write(store, filename, b"56789", 5)
+    assert (tmp_path / "file").read_bytes() == b"0123456789"
+
+
+def test_open_breaks_hard_links(tmp_path):
+    filename = str(tmp_path / "file")
+    cached = tmp_path / "cached"
+    cached.write_bytes(b"cached")
+    os.link(cached, Storage.temp(filename))
+    write(Storage(), filename, b"new")
+    assert cached.read_bytes() == b"cached"
+
+
+@pytest.mark.parametrize("fsync, syncs", [("none", 0), ("commit", 2),
+                                          ("every", 2)])
+def test_fsync(tmp_path, monkeypatch, fsync, syncs):
+    calls = []
+    fsync_ = os.fsync
+    monkeypatch.setattr(storage.os, "fsync",
+                        lambda fd: calls.append(fd) or fsync_(fd))
+    store = Storage(fsync, 1)
+    assert store.sync_every == (1024 * 1024 if fsync == "every" else 0)
+    write(store, str(tmp_path / "file"), b"data")
+    # 文件和所在目录各落盘一次
+    assert len(calls) == syncs
+
+
+def test_discard(tmp_path):
+    filename = str(tmp_path / "file")
+    store = Storage()
+    os.close(store.open(filename))
+    store.discard(filename)
+    assert not os.path.exists(Storage.temp(filename))
+    store.discard(filename)
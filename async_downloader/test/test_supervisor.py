@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+import sys
+import json
+import asyncio
+import logging
+import threading
+import multiprocessing
+
+from types import SimpleNamespace
+
+from async_downloader.metrics import Metrics
+from async_downloader.progress import Progress
+from async_downloader.supervisor import Supervisor
+from async_downloader.downloader import AsyncDownloader
+
+from .server import FaultServer, content
+
+
+def worker():
+    """
+    :return: 只有Supervisor.report需要的属性的worker进程
+    """
+    metrics = Metrics()
+    return SimpleNamespace(metrics=metrics,
+                           progress=Progress(metrics, mode="none"))
+
+
+def test_report_sends_final_state(monkeypatch):
+    """
+    定时发送统计数据，取消时再发送一次最终结果
+    """
+    monkeypatch.setattr(Supervisor, "interval", 0.01)
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    downloader = worker()
+
+    async def run():
+        report = asyncio.ensure_future(Supervisor.report(downloader, writer))
+        await asyncio.sleep(0.05)
+        downloader.metrics.inc("bytes_total", 10)
+        downloader.progress.received = 10
+        report.cancel()
+        await asyncio.gather(report, return_exceptions=True)
+
+    asyncio.run(run())
+    writer.close()
+    states = []
+    try:
+        while True:
+            states.append(reader.recv())
+    except EOFError:
+        pass
+    assert len(states) > 2
+    (values, _), files, received = states[-1]
+    assert values == {("bytes_total", ()): 10}
+    assert (files, received) == ({}, 10)
+
+
+def test_collect_combines_processes():
+    """
+    汇总各进程最近一次的统计数据，进程退出后保留其最终结果
+    """
+    metrics = Metrics()
+    supervisor = Supervisor(SimpleNamespace(
+        logger=logging.getLogger(__name__), metrics=metrics,
+        progress=Progress(metrics, mode="none")))
+    writers = []
+    for _ in range(2):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        supervisor.conns.append(reader)
+        writers.append(writer)
+    first, second = Metrics(), Metrics()
+    first.inc("bytes_total", 1)
+    writers[0].send((first.state(), {"a": [1, 10]}, 1))
+    first.inc("bytes_total", 2)
+    writers[0].send((first.state(), {"a": [3, 10]}, 3))
+    writers[0].close()
+    second.inc("bytes_total", 5)
+    second.observe("ttfb_seconds", 1)
+    writers[1].send((second.state(), {"b": [5, 5]}, 5))
+    supervisor.collect()
+    assert supervisor.conns[0] is None
+    assert metrics.total("bytes_total") == 8
+    assert metrics.summaries["ttfb_seconds", ()] == [1, 1]
+    assert supervisor.progress.files == {"a": [3, 10], "b": [5, 5]}
+    assert supervisor.progress.received == 8
+    writers[1].close()
+    supervisor.collect()
+    assert supervisor.conns == [None, None]
+    assert metrics.total("bytes_total") == 8
+
+
+def test_processes_download_shards(tmp_path, monkeypatch):
+    """
+    各进程下载source的一份任务，主进程汇总统计
+    """
+    loop = asyncio.new_event_loop()
+    server = FaultServer()
+    url = loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    sizes = [1000 * (i + 1) for i in range(8)]
+    tasks = tmp_path / "tasks.jsonl"
+    tasks.write_text("".join(
+        json.dumps({"url": f"{url}/{size}",
+                    "filename": str(tmp_path / str(size))}) + "\n"
+        for size in sizes))
+    monkeypatch.setattr(sys, "argv", [
+        "async-downloader", "file", "--path", str(tasks), "--processes", "2",
+        "--workers", "2", "--progress", "none", "--log-level", "ERROR"])
+    try:
+        downloader = AsyncDownloader()
+        downloader.start()
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    for size in sizes:
+        assert (tmp_path / str(size)).read_bytes() == content(0, size)
+    assert downloader.metrics.total("downloads_total", result="done") == 8
+    assert downloader.metrics.total("bytes_total") == sum(sizes)
+    assert downloader.progress.received == sum(sizes)
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+import json
+
+import pytest
+
+from async_downloader.task import Task, JsonCodec, get_codec
+
+
+DATA = {"url": "http://a/1", "filename": "1", "failed_times": 2,
+        "priority": 3, "md5": "x", "tag": "y"}
+
+
+def test_task_fields_and_meta():
+    task = Task.from_dict(DATA)
+    assert (task.url, task.filename, task.failed_times, task.priority) == \
+           ("http://a/1", "1", 2, 3)
+    assert task.meta == {"md5": "x", "tag": "y"}
+    assert task.get("md5") == "x" and task["tag"] == "y"
+    assert task.get("error", "none") == "none"
+    with pytest.raises(KeyError):
+        task["id"]
+    assert task.to_dict() == DATA
+    assert Task.from_dict({"url": "u", "filename": "f"}).meta is None
+
+
+def test_task_failed():
+    task = Task.from_dict(DATA)
+    failed = task.failed({"error": "server"})
+    assert (failed.failed_times, failed.error, failed.priority) == \
+           (3, "server", 3)
+    assert failed.meta is task.meta
+    # 自定义的下载方法可以返回json
+    failed = task.failed(json.dumps({"failed_times": 5}))
+    assert (failed.failed_times, failed.error) == (5, "other")
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgpack"])
+def test_codecs(name):
+    if name != "json":
+        pytest.importorskip(name)
+    codec = get_codec(name)
+    assert codec.name == name
+    assert codec.loads(codec.dumps(DATA)) == DATA
+    # json格式的任务总是可以解析
+    assert codec.loads(json.dumps(DATA)) == DATA
+    assert codec.loads(json.dumps(DATA).encode()) == DATA
+    assert codec.loads_json(b'{"url": "u"}') == {"url": "u"}
+
+
+def test_default_codec():
+    assert isinstance(get_codec(), JsonCodec)
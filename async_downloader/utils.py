@@ -1,9 +1,14 @@
 # -*- coding:utf-8 -*-
 import os
 import sys
+import queue
+import asyncio
+import logging
+import warnings
 
 from functools import wraps
-from argparse import Action, _SubParsersAction
+from logging.handlers import QueueHandler, QueueListener
+from argparse import Action, ArgumentTypeError, _SubParsersAction
 
 
 class ArgparseHelper(Action):
@@ -64,19 +69,82 @@ def cache_property(func):
     return wrapper
 
 
-async def readexactly(steam, n):
-    if steam._exception is not None:
-        raise steam._exception
+def setup_logger(name, level="INFO", filename=None, stdout=True):
+    """
+    日志只放入队列，由后台线程输出，避免在事件循环中进行同步IO
+    :param name:
+    :param level:
+    :param filename: 日志文件，None表示输出到stdout
+    :param stdout: 没有指定日志文件时是否输出到stdout，不输出时由使用者自行配置日志
+    :return: (logger, listener)，结束时需要调用close_logger以输出剩余的日志，
+    没有输出时listener为None
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if not (filename or stdout):
+        # 作为库使用时没有配置日志也不输出到stderr
+        if not any(isinstance(handler, logging.NullHandler)
+                   for handler in logger.handlers):
+            logger.addHandler(logging.NullHandler())
+        return logger, None
+    handler = logging.FileHandler(filename) if filename \
+        else logging.StreamHandler(sys.stdout)
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler)
+    listener.start()
+    logger.addHandler(QueueHandler(records))
+    return logger, listener
+
+
+def close_logger(logger, listener):
+    """
+    输出队列中剩余的日志，并移除setup_logger添加的handler，
+    同一进程中多次使用时handler不会累积
+    :param logger:
+    :param listener: setup_logger返回的listener
+    :return:
+    """
+    if listener is None:
+        return
+    listener.stop()
+    for handler in logger.handlers[:]:
+        if isinstance(handler, QueueHandler) and \
+                handler.queue is listener.queue:
+            logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.close()
 
-    blocks = []
-    while n > 0:
-        block = await steam.read(n)
-        if not block:
-            break
-        blocks.append(block)
-        n -= len(block)
 
-    return b''.join(blocks)
+def open_file(filename, offset=0):
+    """
+    打开文件用于按位置写入，从头写入时清空原有内容，
+    断点续传时处理器链需要读取已下载的部分，所以同时可读
+    :param filename:
+    :param offset: 开始写入的位置，不为0时保留原有内容用于断点续传
+    :return: 文件描述符
+    """
+    flags = os.O_RDWR | os.O_CREAT
+    if not offset:
+        flags |= os.O_TRUNC
+        # 缓存复用的文件可能是硬链接，从头写入前断开，避免修改其它文件
+        try:
+            os.stat(filename).st_nlink > 1 and os.unlink(filename)
+        except FileNotFoundError:
+            pass
+    return os.open(filename, flags, 0o644)
+
+
+def preallocate(fd, size):
+    """
+    为文件预先分配空间，不支持posix_fallocate时退化为ftruncate
+    :param fd: 文件描述符
+    :param size:
+    :return:
+    """
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
 
 
 def find_source():
@@ -89,4 +157,49 @@ def find_source():
                 sources[k] = getattr(source, k)
         return sources
     except ImportError:
-        pass
\ No newline at end of file
+        pass
+
+
+def parse_shard(value):
+    """
+    :param value: i/N，从0开始的第i份，共N份
+    :return: (i, N)
+    """
+    try:
+        index, count = map(int, value.split("/"))
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid shard: {value}, expect i/N. ")
+    if not 0 <= index < count:
+        raise ArgumentTypeError(f"Invalid shard: {value}, expect 0 <= i < N. ")
+    return index, count
+
+
+def parse_host_rate(value):
+    """
+    :param value: host=rate，rate为每秒字节数
+    :return: (host, rate)
+    """
+    host, sep, rate = value.partition("=")
+    try:
+        rate = int(rate)
+    except ValueError:
+        sep = ""
+    if not (host and sep):
+        raise ArgumentTypeError(
+            f"Invalid host rate: {value}, expect host=rate. ")
+    return host, rate
+
+
+def new_event_loop(use_uvloop=False):
+    """
+    :param use_uvloop: 使用uvloop代替默认的事件循环
+    :return:
+    """
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            warnings.warn("--uvloop depends on uvloop, try: pip install uvloop. ")
+            exit(1)
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
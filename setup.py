@@ -50,6 +50,7 @@ setup(
     entry_points={
         'console_scripts': [
             'a-download = async_downloader:main',
+            'a-download-client = async_downloader.client:main',
         ],
     },
     keywords="download async",
@@ -59,6 +60,7 @@ setup(
     license="MIT",
     packages=find_packages(),
     install_requires=install_requires(),
+    extras_require={"uvloop": ["uvloop"], "test": ["pytest", "fakeredis[lua]"]},
     include_package_data=True,
     zip_safe=True,
 )